@@ -0,0 +1,139 @@
+from scraper import advisory_cache
+from debug import logger
+from StringIO import StringIO
+import gzip
+import json
+import threading
+
+
+# gzip level for the full list; it is compressed once per snapshot, so the
+# best ratio is affordable
+DUMP_COMPRESSION = 9
+
+
+def advisory_country(country, snapshot=None):
+    """
+    This function returns the advisory summary of a country from the
+    in-memory snapshot.
+
+    :param country: A country name, slug or alias
+    :param snapshot: The AdvisorySnapshot to read, or None for the current
+        one
+    :return: {} or None
+    """
+    snapshot = snapshot or advisory_cache.get()
+    key = snapshot.index.lookup(country)
+
+    return snapshot.countries[key] if key is not None else None
+
+
+def advisory_countries(countries, snapshot=None):
+    """
+    This function returns the advisory summaries of several countries at
+    once, from a single snapshot.
+
+    :param countries: A list of country names, slugs or aliases
+    :param snapshot: The AdvisorySnapshot to read, or None for the current
+        one
+    :return: ({country as given: {}}, [countries not found])
+    """
+    snapshot = snapshot or advisory_cache.get()
+    found = {}
+    missing = []
+
+    for country in countries:
+        key = snapshot.index.lookup(country)
+
+        if key is None:
+            missing.append(country)
+        else:
+            found[country] = snapshot.countries[key]
+
+    return found, missing
+
+
+def current_snapshot():
+    """
+    This function returns the snapshot served right now. A response should
+    read its data and its version (the ETag, which changes whenever any
+    advisory does) from the same snapshot.
+
+    :return: AdvisorySnapshot
+    """
+    return advisory_cache.get()
+
+
+class AdvisoryDump(object):
+    """
+    This class holds the full list of country advisories serialized to JSON,
+    both plain and gzipped, for the current snapshot. The list only changes
+    when the snapshot does, so it is serialized and compressed once per
+    snapshot instead of once per request.
+
+    Attributes:
+        _dump - (the AdvisorySnapshot it was built from, JSON str, gzipped
+            JSON str)
+
+    High Level Usage:
+        version, body, compressed = advisory_dump.get()
+    """
+
+    def __init__(self):
+        self._dump = (None, None, None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        This function returns the serialized full list for the current
+        snapshot.
+
+        :return: (snapshot version, JSON str, gzipped JSON str)
+        """
+        snapshot = advisory_cache.get()
+        dumped, body, compressed = self._dump
+
+        if dumped is not snapshot:
+            dumped, body, compressed = self.build(None, snapshot)
+
+        return dumped.version, body, compressed
+
+    def build(self, previous, snapshot):
+        """
+        This function serializes and compresses the full list of a snapshot.
+
+        :param previous: The snapshot replaced by this one, or None
+        :param snapshot: An AdvisorySnapshot
+        :return: (snapshot, JSON str, gzipped JSON str)
+        """
+        with self._lock:
+            if self._dump[0] is snapshot:
+                return self._dump
+
+            body = json.dumps({"version": snapshot.version, "countries": snapshot.countries}, separators=(",", ":"))
+            self._dump = (snapshot, body, compress(body))
+
+            ###
+            logger.info("Serialized advisory list: %d bytes, %d gzipped.", len(body), len(self._dump[2]))
+            ###
+
+            return self._dump
+
+
+def compress(body):
+    """
+    This function gzips a response body.
+
+    :param body: str
+    :return: str
+    """
+    buf = StringIO()
+
+    # a fixed mtime keeps the bytes, and so the ETag, stable
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=DUMP_COMPRESSION, mtime=0) as f:
+        f.write(body)
+
+    return buf.getvalue()
+
+
+advisory_dump = AdvisoryDump()
+advisory_cache.add_listener(advisory_dump.build)
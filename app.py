@@ -1,6 +1,6 @@
 #!bin/python
 
-from flask import (Flask, jsonify, abort, make_response)
+from flask import (Flask, jsonify, abort, make_response, request)
 
 import api
 
@@ -9,10 +9,47 @@ app = Flask(__name__)
 @app.route("/", methods=["GET"])
 def index():
     return jsonify({
-        "country_advisory": "http://localhost:5000/api/1/advisory/{country}"
+        "country_advisory": "http://localhost:5000/api/1/advisory/{country}",
+        "country_advisories": "http://localhost:5000/api/1/advisory?countries={country},{country}",
+        "all_advisories": "http://localhost:5000/api/1/advisory"
     })
 
 
+@app.route("/api/1/advisory", methods=["GET"])
+def get_advisory():
+    """
+    This function returns the advisories of the countries listed in the
+    countries parameter, or of every country if there is none. The full list
+    is gzipped for clients that accept it.
+
+    :return: response
+    """
+    countries = request.args.get("countries")
+
+    if countries is None:
+        version, body, compressed = api.advisory_dump.get()
+
+        if request.accept_encodings["gzip"]:
+            response = make_response(compressed)
+            response.headers["Content-Encoding"] = "gzip"
+            # a strong ETag belongs to one encoding of the body
+            version += "-gzip"
+        else:
+            response = make_response(body)
+
+        response.mimetype = "application/json"
+        response.vary.add("Accept-Encoding")
+
+        return conditional(response, version)
+
+    # the data and the ETag come from the same snapshot, even if a refresh
+    # publishes a new one in between
+    snapshot = api.current_snapshot()
+    found, missing = api.advisory_countries([country.strip() for country in countries.split(",") if country.strip()], snapshot)
+
+    return conditional(jsonify({"version": snapshot.version, "countries": found, "missing": missing}), snapshot.version)
+
+
 @app.route("/api/1/advisory/<string:country>", methods=["GET"])
 def get_advisory_country(country):
     """
@@ -20,12 +57,29 @@ def get_advisory_country(country):
     :param country:
     :return:
     """
-    country_data = api.advisory_country(country.lower())
+    snapshot = api.current_snapshot()
+    country_data = api.advisory_country(country.lower(), snapshot)
 
     if not bool(country_data):
         abort(404)
 
-    return jsonify(country_data)
+    return conditional(jsonify(country_data), snapshot.version)
+
+
+def conditional(response, version):
+    """
+    This function tags a response with the snapshot version it was built
+    from, and turns it into a 304 if the client already has that version.
+
+    :param response: A response
+    :param version: The snapshot version
+    :return: response
+    """
+    response.set_etag(version)
+    # clients may keep the body, but must check it is still current
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
 
 
 @app.errorhandler(404)
@@ -0,0 +1,574 @@
+#!bin/python
+
+"""
+Benchmarks for the bot's hot paths. Each benchmark prints a small table and
+can be pointed at real data where it makes sense.
+
+    python benchmark.py parse [saved-advisories.html]
+    python benchmark.py tokens [lookups] [senders]
+    python benchmark.py startup [runs] [upstream delay in seconds]
+    python benchmark.py notify [subscribers] [Send API latency in seconds]
+    python benchmark.py replay [messages] [concurrency] [payloads.jsonl] [saved-advisories.html]
+    python benchmark.py destinations [countries] [upstream delay in seconds]
+
+notify needs a Redis at REDIS_URL; it only touches keys under benchmark-subs.
+
+replay runs the whole webhook pipeline offline: the Graph API, Wit and the
+advisory page are local stand-ins, and Redis is REDIS_URL if set, else
+fakeredis if installed, else the in-process session store. Without a
+payloads file, it replays synthetic traffic. WEBHOOK_MODE and friends apply
+as usual.
+
+destinations fetches synthetic destination pages from a local stand-in with
+DestinationScraper, cold and then with one row changed.
+"""
+
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from time import time, sleep
+
+from standins import FixtureServer, SendAPIServer, WitServer, synthetic_advisories_page, synthetic_destination_page
+
+
+def bench_parse(path=None, repeat=20):
+    """
+    This function compares the "soup" and "stream" advisory parsers on a saved
+    copy of the general advisory page. Each parser runs in its own process so
+    that peak memory is measured independently.
+
+    :param path: Path to a saved copy of the page (synthetic if None)
+    :param repeat: Number of parses to time per parser
+    :return: None
+    """
+    synthetic = path is None
+
+    if synthetic:
+        handle, path = tempfile.mkstemp(suffix=".html")
+        os.write(handle, synthetic_advisories_page())
+        os.close(handle)
+
+    print "{:<8} {:>12} {:>16} {:>8}".format("parser", "ms/parse", "peak delta (KB)", "rows")
+
+    try:
+        for parser in ("soup", "stream"):
+            output = subprocess.check_output([sys.executable, __file__, "_parse", parser, path, str(repeat)])
+            print output.strip()
+    finally:
+        if synthetic:
+            os.remove(path)
+
+
+def _parse_child(parser, path, repeat):
+    from scraper import parse_general
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = 0.0
+    countries = {}
+
+    for _ in range(repeat):
+        with open(path, "rb") as source:
+            start = time()
+            countries = parse_general(source, parser)
+            elapsed += time() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+    print "{:<8} {:>12.2f} {:>16} {:>8}".format(parser, elapsed / repeat * 1000, peak, len(countries))
+
+
+def bench_tokens(lookups=200000, senders=1000):
+    """
+    This function measures session token derivation throughput: the
+    unkeyed triple hash and the HMAC derivation on every call, and the
+    memoized get_session_token path for a fixed population of senders.
+
+    :param lookups: Number of token lookups per variant
+    :param senders: Number of distinct sender IDs cycled through
+    :return: None
+    """
+    from session import FacebookBotRedisSessionManager
+
+    ids = [str(1000000000000000 + i) for i in range(senders)]
+    plain = FacebookBotRedisSessionManager(None, token_key=None)
+    keyed = FacebookBotRedisSessionManager(None, token_key="benchmark-secret")
+
+    variants = [
+        ("triple sha224", plain._generate_session_token),
+        ("hmac sha224", keyed._generate_session_token),
+        ("memoized", plain.get_session_token)
+    ]
+
+    print "{:<14} {:>14} {:>10}".format("derivation", "lookups/sec", "hit rate")
+
+    for name, derive in variants:
+        start = time()
+
+        for i in xrange(lookups):
+            derive(ids[i % senders])
+
+        elapsed = time() - start
+        hit_rate = plain.token_cache_stats()["hit_rate"] if name == "memoized" else 0.0
+
+        print "{:<14} {:>14.0f} {:>10.3f}".format(name, lookups / elapsed, hit_rate)
+
+
+def bench_startup(runs=5, delay=0.5):
+    """
+    This function measures a worker's time to first answer: from a fresh
+    process importing the scraper to its first advisory lookup, with and
+    without a snapshot file to start from. The advisory page is served by a
+    local stand-in that answers after `delay` seconds.
+
+    :param runs: Number of worker starts per variant
+    :param delay: Seconds the stand-in takes to answer
+    :return: None
+    """
+    server = FixtureServer({"/advisories": synthetic_advisories_page()}, delay=delay).start()
+    handle, path = tempfile.mkstemp(suffix=".snapshot")
+    os.close(handle)
+    os.remove(path)
+
+    print "{:<10} {:>12} {:>12} {:>8}".format("start", "mean ms", "min ms", "scrapes")
+
+    try:
+        for variant, snapshot_path in (("scrape", ""), ("snapshot", path)):
+            if snapshot_path:
+                # the first worker scrapes and writes the file
+                _start_worker(server.url("/advisories"), snapshot_path)
+
+            del server.requests[:]
+            elapsed = [_start_worker(server.url("/advisories"), snapshot_path) for _ in range(runs)]
+
+            print "{:<10} {:>12.1f} {:>12.1f} {:>8}".format(variant, sum(elapsed) / runs * 1000, min(elapsed) * 1000, len(server.requests))
+    finally:
+        server.stop()
+
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _start_worker(url, snapshot_path):
+    env = dict(os.environ, ADVISORY_SNAPSHOT_PATH=snapshot_path)
+    output = subprocess.check_output([sys.executable, __file__, "_startup", url], env=env, stderr=open(os.devnull, "w"))
+
+    return float(output)
+
+
+def _startup_child(url):
+    start = time()
+
+    import scraper
+
+    scraper.urls["general"] = url
+    scraper.advisory_general("name")
+
+    print time() - start
+
+
+def bench_notify(subscribers=20000, latency=0.02):
+    """
+    This function load tests the fan-out of one advisory change to
+    `subscribers` subscribers, against a local Send API stand-in answering
+    after `latency` seconds. While the fan-out runs, an interactive reply is
+    sent every 50ms, to check that notifications do not hold up answers.
+
+    :param subscribers: Number of subscribers to the changed country
+    :param latency: Seconds the Send API stand-in takes per call
+    :return: None
+    """
+    server = SendAPIServer(latency=latency).start()
+    os.environ["FB_API_ENDPOINT"] = server.endpoint()
+    os.environ.setdefault("FB_API_VERSION", "2.6")
+    os.environ.setdefault("FB_ACCESS_TOKEN", "benchmark")
+
+    import redis
+    import threading
+    from scraper import AdvisorySnapshot, general_advisory
+    from send import attachment_message, send_message, send_serialized, serialize_message, scheduler_stats, PRIORITY_BULK
+    from subscriptions import AdvisoryNotifier, SubscriptionStore, NOTIFY_WORKERS
+
+    ds = redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+    store = SubscriptionStore(ds, name="benchmark-subs")
+    render = lambda advisory: serialize_message(attachment_message(advisory["name"], advisory["advisory"], "", ""))
+    notifier = AdvisoryNotifier(store, render, lambda recipient, message: send_serialized(recipient, message, PRIORITY_BULK))
+
+    previous = AdvisorySnapshot({"mexico": general_advisory("MX", "Mexico", "/destinations/mexico", "Exercise a high degree of caution", "2017-01-01 10:00:00")})
+    snapshot = AdvisorySnapshot({"mexico": general_advisory("MX", "Mexico", "/destinations/mexico", "Avoid non-essential travel", "2017-02-01 10:00:00")}, changed=set(["mexico"]))
+
+    for start in range(0, subscribers, 1000):
+        ds.sadd(u"benchmark-subs:mexico", *[str(1000000000000000 + i) for i in range(start, min(start + 1000, subscribers))])
+
+    replies = []
+    done = threading.Event()
+
+    def interactive():
+        while not done.is_set():
+            began = time()
+            send_message("interactive", "Hello")
+            replies.append(time() - began)
+            done.wait(0.05)
+
+    thread = threading.Thread(target=interactive)
+    thread.start()
+
+    try:
+        start = time()
+        sent, failed = notifier.notify(previous, snapshot)[0].result()
+        elapsed = time() - start
+    finally:
+        done.set()
+        thread.join()
+        ds.delete(u"benchmark-subs:mexico", "benchmark-subs:notified:{}:{}".format(previous.version, snapshot.version))
+        server.stop()
+
+    replies.sort()
+
+    print "{:<28} {:>12}".format("subscribers", subscribers)
+    print "{:<28} {:>12}".format("notify workers", NOTIFY_WORKERS)
+    print "{:<28} {:>12.0f}".format("Send API latency (ms)", latency * 1000)
+    print "{:<28} {:>12}".format("sent / failed", "{} / {}".format(sent, failed))
+    print "{:<28} {:>12.2f}".format("fan-out (s)", elapsed)
+    print "{:<28} {:>12.0f}".format("notifications/sec", sent / elapsed)
+    print "{:<28} {:>12.1f}".format("interactive p50 (ms)", replies[len(replies) // 2] * 1000)
+    print "{:<28} {:>12.1f}".format("interactive max (ms)", replies[-1] * 1000)
+
+    for stats in scheduler_stats().itervalues():
+        print "{:<28} {:>12.1f}".format("send rate limit (/s)", stats["rate"])
+
+        for name in ("interactive", "bulk"):
+            print "{:<28} {:>12.1f}".format(name + " mean wait (ms)", stats[name]["mean_wait"] * 1000)
+            print "{:<28} {:>12}".format(name + " dropped", stats[name]["dropped"])
+
+
+def bench_destinations(countries=230, delay=0.05):
+    """
+    This function fetches the destination page of every country in a
+    synthetic advisory table from a local stand-in answering after `delay`
+    seconds, then refreshes again after changing one row, which should fetch
+    that one page only.
+
+    :param countries: Number of countries
+    :param delay: Seconds the stand-in takes per page
+    :return: None
+    """
+    from StringIO import StringIO
+    from scraper import parse_general
+    from destinations import DestinationScraper, DESTINATION_PER_HOST, DESTINATION_WORKERS
+
+    table = parse_general(StringIO(synthetic_advisories_page(countries)))
+    pages = dict((advisory["url"], synthetic_destination_page(advisory["name"])) for advisory in table.itervalues())
+    server = FixtureServer(pages, delay=delay).start()
+
+    try:
+        scraper = DestinationScraper(server.url("/destinations/"))
+
+        start = time()
+        fetched = scraper.refresh(table, wait=True)
+        cold = time() - start
+
+        parsed = sum(1 for key in table if (scraper.get(key) or {}).get("entry_exit"))
+
+        key = sorted(table)[0]
+        table[key] = dict(table[key], last_updated=u"2018-01-01 10:00:00")
+        requests = len(server.requests)
+
+        start = time()
+        refetched = scraper.refresh(table, wait=True)
+        warm = time() - start
+
+        requested = len(server.requests) - requests
+    finally:
+        server.stop()
+
+    print "{:<28} {:>12}".format("countries", countries)
+    print "{:<28} {:>12.0f}".format("upstream delay (ms)", delay * 1000)
+    print "{:<28} {:>12}".format("workers / per host", "{} / {}".format(DESTINATION_WORKERS, DESTINATION_PER_HOST))
+    print "{:<28} {:>12}".format("pages fetched / parsed", "{} / {}".format(fetched, parsed))
+    print "{:<28} {:>12.2f}".format("cold refresh (s)", cold)
+    print "{:<28} {:>12.2f}".format("one at a time (s)", countries * delay)
+    print "{:<28} {:>12}".format("refetched after 1 change", "{} / {}".format(refetched, requested))
+    print "{:<28} {:>12.1f}".format("refresh after 1 change (ms)", warm * 1000)
+
+
+def bench_replay(messages=2000, concurrency=4, path=None, page=None, send_latency=0.03, wit_latency=0.15):
+    """
+    This function replays webhook calls against listen.app through Flask's
+    test client, from `concurrency` threads, with every outside service
+    replaced by a local stand-in. It reports the latency of the webhook
+    calls, the messages handled per second, and the time spent in each stage
+    of the pipeline.
+
+    :param messages: Number of synthetic text messages (ignored with a
+        payloads file)
+    :param concurrency: Number of threads posting webhook calls
+    :param path: A JSON-lines file of recorded webhook bodies, one per line
+    :param page: Path to a saved copy of the general advisory page
+        (synthetic if None)
+    :param send_latency: Seconds the Send API stand-in takes per call
+    :param wit_latency: Seconds the Wit stand-in takes per call
+    :return: None
+    """
+    if page is None:
+        pages = {"/advisories": synthetic_advisories_page()}
+    else:
+        with open(page, "rb") as f:
+            pages = {"/advisories": f.read()}
+
+    fixtures = FixtureServer(pages).start()
+    send_api = SendAPIServer(latency=send_latency).start()
+    wit_api = WitServer(latency=wit_latency).start()
+
+    os.environ.update({
+        "FB_API_ENDPOINT": send_api.endpoint(),
+        "WIT_URL": wit_api.url(),
+        "ADVISORY_SNAPSHOT_PATH": ""
+    })
+
+    for key in ("FB_API_VERSION", "FB_ACCESS_TOKEN", "FB_CALLBACK_TOKEN", "FB_VERIFICATION_TOKEN", "WIT_API_KEY"):
+        os.environ.setdefault(key, "2.6" if key == "FB_API_VERSION" else "benchmark")
+
+    redis_backend = _replay_redis()
+
+    import scraper
+
+    scraper.urls["general"] = fixtures.url("/advisories")
+    names = [advisory["name"] for advisory in scraper.advisory_general("name")]
+    scraper.advisory_cache.get().index.warm()
+
+    import bot
+    import listen
+    import send
+
+    if path is None:
+        bodies = _synthetic_webhooks(names, messages)
+    else:
+        with open(path, "rb") as f:
+            bodies = [json.loads(line) for line in f if line.strip()]
+
+    stages = _StageTimer()
+    stages.wrap(listen, "load_sessions", "sessions")
+    stages.wrap(bot, "extract_countries", "gazetteer")
+    stages.wrap(listen.wit, "message", "nlu (cached)")
+    stages.wrap(listen.wit._client, "message", "wit api")
+    stages.wrap(bot, "advisory_candidates", "matching")
+    stages.wrap(send, "post", "send api")
+
+    url = listen.ROOT.format(listen.FB_CALLBACK)
+    pending = [json.dumps(body) for body in reversed(bodies)]
+    latencies = []
+    lock = threading.Lock()
+
+    def replay():
+        client = listen.app.test_client()
+
+        while True:
+            with lock:
+                if not pending:
+                    return
+                body = pending.pop()
+
+            began = time()
+            client.post(url, data=body, content_type="application/json")
+            elapsed = time() - began
+
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=replay) for _ in range(concurrency)]
+    start = time()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    answered = elapsed = time() - start
+
+    if listen.event_queue is not None:
+        # the webhook was answered before the events were handled
+        elapsed = _wait_until_quiet(send_api) - start
+    events = [event for body in bodies for entry in body["entry"] for event in entry.get("messaging", [])]
+    texts = len([event for event in events if "message" in event])
+
+    fixtures.stop()
+    send_api.stop()
+    wit_api.stop()
+
+    latencies.sort()
+
+    print "{:<28} {:>12}".format("webhook mode", listen.WEBHOOK_MODE)
+    print "{:<28} {:>12}".format("redis", redis_backend)
+    print "{:<28} {:>12}".format("webhook calls", len(bodies))
+    print "{:<28} {:>12}".format("events / messages", "{} / {}".format(len(events), texts))
+    print "{:<28} {:>12}".format("concurrency", concurrency)
+    print "{:<28} {:>12.0f}".format("Send API latency (ms)", send_latency * 1000)
+    print "{:<28} {:>12.0f}".format("Wit latency (ms)", wit_latency * 1000)
+    print "{:<28} {:>12.2f}".format("answered in (s)", answered)
+    print "{:<28} {:>12.2f}".format("handled in (s)", elapsed)
+    print "{:<28} {:>12.0f}".format("messages/sec", texts / elapsed)
+
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print "{:<28} {:>12.1f}".format("webhook {} (ms)".format(name), _percentile(latencies, q) * 1000)
+
+    print "{:<28} {:>12}".format("Send API / Wit calls", "{} / {}".format(len(send_api.received), len(wit_api.received)))
+    print "{:<28} {:>12}".format("duplicates dropped", listen.deduplicator.stats()["duplicates"])
+    print
+    print "{:<16} {:>8} {:>12} {:>10}".format("stage", "calls", "total (s)", "mean ms")
+
+    for name, calls, total in stages.report():
+        print "{:<16} {:>8} {:>12.2f} {:>10.2f}".format(name, calls, total, total / calls * 1000 if calls else 0.0)
+
+
+def _replay_redis():
+    if os.environ.get("REDIS_URL"):
+        return "REDIS_URL"
+
+    try:
+        import fakeredis
+    except ImportError:
+        return "none"
+
+    import redis
+
+    fake = fakeredis.FakeStrictRedis()
+    redis.from_url = lambda *args, **kwargs: fake
+    os.environ["REDIS_URL"] = "redis://fakeredis"
+
+    return "fakeredis"
+
+
+def _synthetic_webhooks(names, messages, senders=200, seed=1):
+    """
+    This function makes up webhook bodies resembling the bot's traffic: one
+    to three events each, mostly messages naming a country exactly (answered
+    without Wit), some with a typo in a sentence (sent to Wit), greetings,
+    and delivery and read receipts.
+    """
+    rng = random.Random(seed)
+    greetings = [u"hi", u"hello", u"what can you do?", u"thanks"]
+    bodies = []
+    count = 0
+
+    while count < messages:
+        events = []
+
+        for _ in range(rng.randint(1, 3)):
+            sender = str(1000000000000000 + rng.randrange(senders))
+            kind = rng.random()
+            name = rng.choice(names)
+
+            if kind < 0.15:
+                events.append({"sender": {"id": sender}, "recipient": {"id": "page"}, "timestamp": 1, "delivery": {"mids": ["mid.{}".format(count)], "watermark": len(bodies)}})
+                continue
+            elif kind < 0.25:
+                events.append({"sender": {"id": sender}, "recipient": {"id": "page"}, "timestamp": 1, "read": {"watermark": len(bodies)}})
+                continue
+            elif kind < 0.65:
+                text = name
+            elif kind < 0.9:
+                i = rng.randrange(len(name))
+                text = u"travel advisory for {}?".format(name[:i] + name[i + 1:])
+            else:
+                text = rng.choice(greetings)
+
+            events.append({"sender": {"id": sender}, "recipient": {"id": "page"}, "timestamp": 1, "message": {"mid": "mid.{}".format(count), "seq": count, "text": text}})
+            count += 1
+
+        bodies.append({"object": "page", "entry": [{"id": "page", "time": 1, "messaging": events}]})
+
+    return bodies
+
+
+def _wait_until_quiet(server, quiet=1.0):
+    """
+    This function waits until a stand-in has received no call for `quiet`
+    seconds, and returns when it last received one.
+    """
+    calls = len(server.received)
+    last = time()
+
+    while True:
+        sleep(quiet)
+
+        if len(server.received) == calls:
+            return last
+
+        calls = len(server.received)
+        last = time()
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class _StageTimer(object):
+    """
+    This class times calls to module or object attributes, by replacing them
+    with a wrapper that adds up calls and time per stage name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = []
+        self._totals = {}
+
+    def wrap(self, owner, attribute, name):
+        function = getattr(owner, attribute)
+        self._stages.append(name)
+        self._totals[name] = [0, 0.0]
+
+        def timed(*args, **kwargs):
+            start = time()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time() - start
+
+                with self._lock:
+                    self._totals[name][0] += 1
+                    self._totals[name][1] += elapsed
+
+        setattr(owner, attribute, timed)
+
+    def report(self):
+        with self._lock:
+            return [(name, self._totals[name][0], self._totals[name][1]) for name in self._stages]
+
+
+def main():
+    args = sys.argv[1:]
+
+    if not args:
+        print __doc__
+    elif args[0] == "parse":
+        bench_parse(*args[1:2])
+    elif args[0] == "tokens":
+        bench_tokens(*[int(arg) for arg in args[1:3]])
+    elif args[0] == "startup":
+        bench_startup(*[cast(arg) for cast, arg in zip((int, float), args[1:3])])
+    elif args[0] == "notify":
+        bench_notify(*[cast(arg) for cast, arg in zip((int, float), args[1:3])])
+    elif args[0] == "replay":
+        bench_replay(*[cast(arg) for cast, arg in zip((int, int, str, str), args[1:5])])
+    elif args[0] == "destinations":
+        bench_destinations(*[cast(arg) for cast, arg in zip((int, float), args[1:3])])
+    elif args[0] == "_parse":
+        _parse_child(args[1], args[2], int(args[3]))
+    elif args[0] == "_startup":
+        _startup_child(args[1])
+    else:
+        print __doc__
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,318 @@
 from wit import Wit
-from scraper import advisory_country
-from session import FacebookBotRedisSessionManager
-from send import send_message, send_attachment
+from nlu import CachedWitClient
+from scraper import advisory_cache, advisory_candidates, extract_countries, share_advisories
+from destinations import destination_details
+from sessions import create_session_manager
+from subscriptions import SubscriptionStore, AdvisoryNotifier, SUBSCRIBE, UNSUBSCRIBE
+from send import send_message, send_serialized, attachment_message, serialize_message, PRIORITY_BULK
+from functools import partial
 from debug import logger
+from metrics import timer
 import os
+import re
 import redis
+import threading
 
 
-redis_store = redis.from_url(os.environ.get("REDIS_URL"))
-session_manager = FacebookBotRedisSessionManager(redis_store)
+# without Redis, sessions are kept in process memory
+redis_store = redis.from_url(os.environ["REDIS_URL"]) if os.environ.get("REDIS_URL") else None
+session_manager = create_session_manager(redis_store)
+
+# one process scrapes for everyone sharing the Redis
+if redis_store is not None:
+    share_advisories(redis_store)
+
+# subscriptions to advisory changes need Redis
+subscriptions = SubscriptionStore(redis_store) if redis_store is not None else None
 
 
 ACCESS_TOKEN = os.environ["WIT_API_KEY"]
 
+# "details mexico", "details for Cuba?"
+DETAILS_COMMAND = re.compile(r"^\s*details?\s+(?:(?:for|on|about)\s+)?(.+?)[\s.!?]*$", re.IGNORECASE | re.UNICODE)
+# section titles of the destination page details, in the order sent
+DETAILS_TITLES = (
+    ("regional_advisories", "Regional advisories"),
+    ("entry_exit", "Entry and exit requirements"),
+    ("health", "Health")
+)
+# Messenger cuts text messages off at this many characters
+MESSAGE_LENGTH = 640
+
+# "unsubscribe", "stop mexico", "unsubscribe from Cuba!"; anything after the
+# word has to be exactly a country for the message to be a command
+UNSUBSCRIBE_COMMAND = re.compile(r"^\s*(?:unsubscribe|stop)\b(?:\s+(?:from\s+)?(.*?))?[\s.!]*$", re.IGNORECASE | re.UNICODE)
+
 
-def send(session_id, country):
+def send(session_id, country, session=None):
     """
     This function sends messages from Wit to Messenger.
 
     :param session_id:
     :param country:
+    :param session: The session object, if the caller already has it
     :return: True
     """
-    id_ = session_manager.get_session(session_id)["id"]
+    if session is None:
+        session = session_manager.get_session(session_id)
+
+    id_ = session["id"]
 
     # check if the country is missing
     if country is None:
 
         # at some point, I should add the text to the context in get_travel_advisory so I can access it here
         ###
-        logger.error("{}, Country: Missing".format(id_))
+        logger.error("%s, Country: Missing", id_, extra={"sender": id_, "token": session_id})
         ###
 
         send_message(id_, "Where? I'm still getting the hang of this. Try and make sure the country is spelled correctly.")
-    else:
+        return True
+
+    ###
+    logger.info(u"%s, Country: %s", id_, country, extra={"sender": id_, "token": session_id})
+    ###
+
+    # find the closest matching countries
+    with timer("matching"):
+        candidates = advisory_candidates(country)
+
+    if not candidates:
 
         ###
-        logger.info("{}, Country: {}".format(id_, country))
+        logger.error("%s, Country: Unknown", id_, extra={"sender": id_, "token": session_id})
         ###
 
-        # get advisory
-        advisory = advisory_country(country)
-
-        # prepare image
-        image = "static/adv-cat-{}.png".format(advisory["advisory_code"])
-        indicator = "This is a category {} warning (out of 4)".format(advisory["advisory_code"])
-        url = "https://travel.gc.ca{}".format(advisory["url"])
+        send_message(id_, "Where? I'm still getting the hang of this. Try and make sure the country is spelled correctly.")
+    elif len(candidates) > 1 and candidates[0][1] == candidates[1][1]:
+        # several equally close matches, let the user pick
+        names = [advisory["name"] for advisory, distance in candidates if distance == candidates[0][1]]
 
-        send_attachment(id_, "{}: {}".format(country, advisory["advisory"]), indicator, image, url)
+        send_message(id_, u"Did you mean {}?".format(u" or ".join(names)))
+    else:
+        # get advisory, already serialized
+        send_serialized(id_, prepared_replies.get(candidates[0][0]))
 
     return True
 
 
+def advisory_reply(advisory, notification=False):
+    """
+    This function builds the attachment message answering with a country
+    advisory, or telling a subscriber it changed.
+
+    :param advisory: A country advisory dictionary
+    :param notification: Build the change notification instead
+    :return: message object
+    """
+    key = advisory["name"].lower()
+
+    # prepare image
+    image = "static/adv-cat-{}.png".format(advisory["advisory_code"])
+    indicator = "This is a category {} warning (out of 4)".format(advisory["advisory_code"])
+    url = "https://travel.gc.ca{}".format(advisory["url"])
+    title = u"{}: {}".format(advisory["name"], advisory["advisory"])
+
+    if subscriptions is None:
+        postbacks = []
+    elif notification:
+        title = u"Updated! " + title
+        postbacks = [("Unsubscribe", UNSUBSCRIBE + key)]
+    else:
+        postbacks = [("Subscribe", SUBSCRIBE + key)]
+
+    return attachment_message(title, indicator, image, url, postbacks)
+
+
+def handle_subscription(sender, payload):
+    """
+    This function handles the subscribe and unsubscribe buttons.
+
+    :param sender: Facebook ID
+    :param payload: The postback payload, SUBSCRIBE or UNSUBSCRIBE followed
+        by a country key
+    :return: None
+    """
+    subscribe = payload.startswith(SUBSCRIBE)
+    key = payload[len(SUBSCRIBE if subscribe else UNSUBSCRIBE):]
+    advisory = advisory_cache.get().countries.get(key)
+
+    if subscriptions is None or advisory is None:
+        send_message(sender, "Sorry, I can't do that right now.")
+        return
+
+    ###
+    logger.info(u"%s, %s: %s", sender, "Subscribed" if subscribe else "Unsubscribed", key, extra={"sender": sender})
+    ###
+
+    if subscribe:
+        subscriptions.subscribe(key, sender)
+        send_message(sender, u"Got it! I'll message you whenever the travel advisory for {} changes. Say \"stop\" to unsubscribe.".format(advisory["name"]))
+    else:
+        subscriptions.unsubscribe(key, sender)
+        send_message(sender, u"OK, no more updates about {}.".format(advisory["name"]))
+
+
+def exact_country(country):
+    """
+    This function returns the advisory of the one country a name, slug,
+    alias or code refers to exactly, without typo correction.
+
+    :param country: a string that represents a country name
+    :return: {} or None
+    """
+    candidates = advisory_candidates(country)
+
+    if not candidates or candidates[0][1] != 0 or (len(candidates) > 1 and candidates[1][1] == 0):
+        return None
+
+    return candidates[0][0]
+
+
+def handle_details(sender, advisory):
+    """
+    This function sends the sections of a country's destination page
+    (regional advisories, entry requirements, health), one message each.
+
+    :param sender: Facebook ID
+    :param advisory: A country advisory dictionary
+    :return: None
+    """
+    details = destination_details(advisory["name"]) or {}
+    found = [(title, details[key]) for key, title in DETAILS_TITLES if details.get(key)]
+
+    ###
+    logger.info(u"%s, Details: %s (%d sections)", sender, advisory["name"], len(found), extra={"sender": sender})
+    ###
+
+    if not found:
+        send_message(sender, u"Sorry, I couldn't get the details for {}. Try the Read More link.".format(advisory["name"]))
+        return
+
+    for title, text in found:
+        message = u"{}: {}".format(title, text)
+
+        if len(message) > MESSAGE_LENGTH:
+            message = message[:MESSAGE_LENGTH - 1] + u"\u2026"
+
+        send_message(sender, message)
+
+
+def handle_unsubscribe(sender, advisory):
+    """
+    This function handles the unsubscribe text command, for one country or
+    for every country. It needs subscriptions.
+
+    :param sender: Facebook ID
+    :param advisory: The advisory of the country named in the command, or
+        None for every country
+    :return: None
+    """
+    if advisory is not None:
+        handle_subscription(sender, UNSUBSCRIBE + advisory["name"].lower())
+        return
+
+    keys = subscriptions.unsubscribe_all(advisory_cache.get().countries.keys(), sender)
+
+    ###
+    logger.info(u"%s, Unsubscribed: %s", sender, u", ".join(keys) or "nothing", extra={"sender": sender})
+    ###
+
+    if keys:
+        send_message(sender, "OK, no more updates from me.")
+    else:
+        send_message(sender, "You aren't getting updates about any country.")
+
+
+class PreparedReplies(object):
+    """
+    This class holds the advisory reply of every country, serialized to JSON,
+    for the current advisory snapshot. A country's reply only changes when its
+    row does, so replies are built when a snapshot is published rather than
+    for every message, and only the recipient is added at send time.
+
+    Attributes:
+        _prepared - (the AdvisorySnapshot the replies were built from,
+            {country key: JSON str})
+
+    High Level Usage:
+        advisory_cache.add_listener(prepared_replies.prepare)
+        send_serialized(recipient, prepared_replies.get(advisory))
+    """
+
+    def __init__(self):
+        self._prepared = (None, {})
+        self._lock = threading.Lock()
+
+    def get(self, advisory):
+        """
+        This function returns the serialized reply for a country advisory.
+
+        :param advisory: A country advisory dictionary
+        :return: JSON str
+        """
+        snapshot = advisory_cache.get()
+        prepared, replies = self._prepared
+
+        if prepared is not snapshot:
+            prepared, replies = self.prepare(None, snapshot)
+
+        reply = replies.get(advisory["name"].lower())
+
+        if reply is None:
+            reply = serialize_message(advisory_reply(advisory))
+
+        return reply
+
+    def prepare(self, previous, snapshot):
+        """
+        This function serializes the replies for a snapshot. Replies of the
+        countries that did not change since `previous` are carried over.
+
+        :param previous: The snapshot replaced by this one, or None
+        :param snapshot: An AdvisorySnapshot
+        :return: (snapshot, {country key: JSON str})
+        """
+        with self._lock:
+            prepared, replies = self._prepared
+
+            if prepared is snapshot:
+                return self._prepared
+
+            if previous is None or prepared is not previous or snapshot.changed is None:
+                replies = {}
+
+            changed = snapshot.changed or ()
+            built = {}
+
+            for key, advisory in snapshot.countries.iteritems():
+                reply = replies.get(key) if key not in changed else None
+                built[key] = reply if reply is not None else serialize_message(advisory_reply(advisory))
+
+            self._prepared = (snapshot, built)
+
+            ###
+            logger.info("Prepared %d advisory replies.", len(built))
+            ###
+
+            return self._prepared
+
+
+prepared_replies = PreparedReplies()
+advisory_cache.add_listener(prepared_replies.prepare)
+
+
+def notification(advisory):
+    return serialize_message(advisory_reply(advisory, notification=True))
+
+
+if subscriptions is not None:
+    notifier = AdvisoryNotifier(subscriptions, notification, partial(send_serialized, priority=PRIORITY_BULK))
+    advisory_cache.add_listener(notifier.notify)
+else:
+    notifier = None
+
+
 def first_entity_value(entities, entity):
     """
     This function returns the first entity value if the entity exists.
@@ -71,12 +332,13 @@ def first_entity_value(entities, entity):
     return value["value"] if isinstance(value, dict) else value
 
 
-def handle_message(response, session_id):
+def handle_message(response, session_id, session=None):
     """
     This function handles all text responses
 
     :param response: A Wit response context
     :param session_id
+    :param session: The session object, if the caller already has it
     :return: None
     """
     # get all entities
@@ -84,11 +346,73 @@ def handle_message(response, session_id):
     # see if country entity present
     country = first_entity_value(entities, "country")
 
-    send(session_id, country)
+    send(session_id, country, session)
+
+
+def handle_text(client, text, session_id, session=None):
+    """
+    This function handles a text message. If the message names exactly one
+    country, it is answered straight away; otherwise Wit is asked to find
+    the country. If Wit cannot be reached, the reply is the same as when no
+    country is found. "unsubscribe" or "stop", alone or followed by a
+    country, and "details" followed by a country are handled as commands.
+
+    :param client: A Wit client
+    :param text: The message text
+    :param session_id:
+    :param session: The session object, if the caller already has it
+    :return: None
+    """
+    command = DETAILS_COMMAND.match(text)
+    advisory = exact_country(command.group(1)) if command else None
+
+    if advisory is not None:
+        if session is None:
+            session = session_manager.get_session(session_id)
+
+        handle_details(session["id"], advisory)
+        return
+
+    command = UNSUBSCRIBE_COMMAND.match(text) if subscriptions is not None else None
+    advisory = exact_country(command.group(1)) if command and command.group(1) else None
+
+    # "stop over in Mexico, is it safe?" is a question, not a command
+    if command and (advisory is not None or not command.group(1)):
+        if session is None:
+            session = session_manager.get_session(session_id)
+
+        handle_unsubscribe(session["id"], advisory)
+        return
+
+    with timer("gazetteer"):
+        countries = extract_countries(text)
+
+    if len(countries) == 1:
+
+        ###
+        logger.info(u"Country found without Wit: %s", countries[0]["name"], extra={"token": session_id})
+        ###
+
+        send(session_id, countries[0]["name"], session)
+        return
+
+    try:
+        with timer("nlu"):
+            response = client.message(msg=text, context={"session_id": session_id})
+    except Exception:
+
+        ###
+        logger.exception("Wit message failed.", extra={"token": session_id})
+        ###
+
+        send(session_id, None, session)
+        return
+
+    handle_message(response, session_id, session)
 
 
 def create_client():
-    return Wit(access_token=ACCESS_TOKEN)
+    return CachedWitClient(Wit(access_token=ACCESS_TOKEN), redis_store)
 
 
 def main():
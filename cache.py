@@ -0,0 +1,178 @@
+import threading
+import time
+
+
+# fields of a linked list entry
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """
+    This class is a thread-safe, size-bounded, least-recently-used cache with
+    optional expiry. It keeps hit/miss/eviction counters so callers can report
+    how well it is doing.
+
+    Args:
+        maxsize - The maximum number of entries. The least recently used entry
+            is evicted to make room for a new one.
+        ttl - Seconds an entry lives after it is set, or None for no expiry.
+        refresh_on_get - Restart an entry's ttl every time it is read, which
+            makes the ttl an idle timeout.
+
+    Attributes:
+        _data - A dictionary of key -> linked list entry.
+        _root - The sentinel of a circular doubly linked list of
+            [prev, next, key, value, expires_at] entries, least recently used
+            first. This is the layout functools.lru_cache uses; it is much
+            cheaper per hit than an OrderedDict on Python 2.
+
+    High Level Usage:
+        tokens = LRUCache(10000)
+        token = tokens.get(id_)
+        if token is None:
+            tokens.set(id_, derive(id_))
+    """
+
+    def __init__(self, maxsize, ttl=None, refresh_on_get=False):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._refresh_on_get = refresh_on_get
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        This function returns the value cached for a key and marks it as most
+        recently used.
+
+        :param key: A hashable key
+        :param default: The value to return on a miss
+        :return: the cached value or default
+        """
+        with self._lock:
+            link = self._data.get(key)
+
+            if link is None:
+                self.misses += 1
+                return default
+
+            if link[_EXPIRES] is not None:
+                now = time.time()
+
+                if link[_EXPIRES] <= now:
+                    self._unlink(link)
+                    self.expirations += 1
+                    self.misses += 1
+                    return default
+
+                if self._refresh_on_get:
+                    link[_EXPIRES] = now + self._ttl
+
+            # move to the most recently used end
+            link[_PREV][_NEXT] = link[_NEXT]
+            link[_NEXT][_PREV] = link[_PREV]
+            last = self._root[_PREV]
+            last[_NEXT] = self._root[_PREV] = link
+            link[_PREV] = last
+            link[_NEXT] = self._root
+
+            self.hits += 1
+
+            return link[_VALUE]
+
+    def set(self, key, value):
+        """
+        This function caches a value for a key, evicting the least recently
+        used entry if the cache is full.
+
+        :param key: A hashable key
+        :param value: The value to cache
+        :return: None
+        """
+        expires_at = time.time() + self._ttl if self._ttl is not None else None
+
+        with self._lock:
+            link = self._data.get(key)
+
+            if link is not None:
+                self._unlink(link)
+
+            last = self._root[_PREV]
+            link = [last, self._root, key, value, expires_at]
+            last[_NEXT] = self._root[_PREV] = self._data[key] = link
+
+            while len(self._data) > self._maxsize:
+                self._unlink(self._root[_NEXT])
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        This function removes a key from the cache.
+
+        :param key: A hashable key
+        :param default: The value to return if the key is not cached
+        :return: the cached value or default
+        """
+        with self._lock:
+            link = self._data.get(key)
+
+            if link is None:
+                return default
+
+            self._unlink(link)
+
+        return link[_VALUE]
+
+    def expire(self):
+        """
+        This function drops every expired entry. Expired entries are otherwise
+        only dropped when they are read or evicted.
+
+        :return: the number of entries dropped
+        """
+        if self._ttl is None:
+            return 0
+
+        now = time.time()
+
+        with self._lock:
+            expired = [link for link in self._data.itervalues() if link[_EXPIRES] <= now]
+
+            for link in expired:
+                self._unlink(link)
+
+            self.expirations += len(expired)
+
+        return len(expired)
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+        del self._data[link[_KEY]]
+
+    def stats(self):
+        """
+        This function returns the cache counters.
+
+        :return: {}
+        """
+        lookups = self.hits + self.misses
+
+        return {
+            "size": len(self._data),
+            "maxsize": self._maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def __len__(self):
+        return len(self._data)
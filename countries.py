@@ -0,0 +1,661 @@
+import re
+import threading
+import unicodedata
+
+
+# common ways of naming a country -> the (normalized) name travel.gc.ca uses.
+# Aliases whose target is not in the advisory table are ignored.
+aliases = {
+    "us": "united states",
+    "usa": "united states",
+    "united states of america": "united states",
+    "america": "united states",
+    "uk": "united kingdom",
+    "gb": "united kingdom",
+    "gbr": "united kingdom",
+    "great britain": "united kingdom",
+    "britain": "united kingdom",
+    "england": "united kingdom",
+    "scotland": "united kingdom",
+    "wales": "united kingdom",
+    "northern ireland": "united kingdom",
+    "uae": "united arab emirates",
+    "emirates": "united arab emirates",
+    "dubai": "united arab emirates",
+    "mex": "mexico",
+    "holland": "netherlands",
+    "burma": "myanmar",
+    "czechia": "czech republic",
+    "ivory coast": "cote divoire",
+    "cote d ivoire": "cote divoire",
+    "korea": "south korea",
+    "republic of korea": "south korea",
+    "dprk": "north korea",
+    "prc": "china",
+    "mainland china": "china",
+    "hong kong": "hong kong sar",
+    "macau": "macao sar",
+    "macao": "macao sar",
+    "russian federation": "russia",
+    "viet nam": "vietnam",
+    "lao": "laos",
+    "east timor": "timor leste",
+    "swaziland": "eswatini",
+    "cape verde": "cabo verde",
+    "vatican": "vatican city",
+    "holy see": "vatican city",
+    "st lucia": "saint lucia",
+    "st kitts": "saint kitts and nevis",
+    "st vincent": "saint vincent and the grenadines",
+    "st martin": "saint martin",
+    "st barts": "saint barthelemy",
+    "drc": "democratic republic of congo",
+    "congo kinshasa": "democratic republic of congo",
+    "congo brazzaville": "republic of congo",
+    "dominican rep": "dominican republic",
+    "bosnia": "bosnia and herzegovina",
+    "trinidad": "trinidad and tobago",
+    "tobago": "trinidad and tobago",
+    "antigua": "antigua and barbuda",
+    "png": "papua new guinea",
+    "nz": "new zealand",
+    "aus": "australia",
+    "deutschland": "germany",
+    "espana": "spain",
+    "nippon": "japan",
+    "persia": "iran",
+    "siam": "thailand",
+    "ceylon": "sri lanka",
+    "turkiye": "turkey"
+}
+
+# ISO 3166-1 alpha-2 code -> (alpha-3 code, names the country may go by on
+# travel.gc.ca, normalized, tried in order). Kosovo's code is user-assigned
+# but widely used. Codes only ever match a whole query: many of them ("and",
+# "per", "can") are ordinary words, so they are never picked out of a
+# message or used to correct a misspelling.
+iso_codes = {
+    "ad": ("and", ("andorra",)),
+    "ae": ("are", ("united arab emirates",)),
+    "af": ("afg", ("afghanistan",)),
+    "ag": ("atg", ("antigua and barbuda",)),
+    "ai": ("aia", ("anguilla",)),
+    "al": ("alb", ("albania",)),
+    "am": ("arm", ("armenia",)),
+    "ao": ("ago", ("angola",)),
+    "aq": ("ata", ("antarctica",)),
+    "ar": ("arg", ("argentina",)),
+    "as": ("asm", ("american samoa",)),
+    "at": ("aut", ("austria",)),
+    "au": ("aus", ("australia",)),
+    "aw": ("abw", ("aruba",)),
+    "ax": ("ala", ("aland islands",)),
+    "az": ("aze", ("azerbaijan",)),
+    "ba": ("bih", ("bosnia and herzegovina",)),
+    "bb": ("brb", ("barbados",)),
+    "bd": ("bgd", ("bangladesh",)),
+    "be": ("bel", ("belgium",)),
+    "bf": ("bfa", ("burkina faso",)),
+    "bg": ("bgr", ("bulgaria",)),
+    "bh": ("bhr", ("bahrain",)),
+    "bi": ("bdi", ("burundi",)),
+    "bj": ("ben", ("benin",)),
+    "bl": ("blm", ("saint barthelemy",)),
+    "bm": ("bmu", ("bermuda",)),
+    "bn": ("brn", ("brunei", "brunei darussalam")),
+    "bo": ("bol", ("bolivia",)),
+    "bq": ("bes", ("bonaire sint eustatius and saba", "bonaire")),
+    "br": ("bra", ("brazil",)),
+    "bs": ("bhs", ("bahamas",)),
+    "bt": ("btn", ("bhutan",)),
+    "bv": ("bvt", ("bouvet island",)),
+    "bw": ("bwa", ("botswana",)),
+    "by": ("blr", ("belarus",)),
+    "bz": ("blz", ("belize",)),
+    "ca": ("can", ("canada",)),
+    "cc": ("cck", ("cocos keeling islands", "cocos islands")),
+    "cd": ("cod", ("democratic republic of congo", "democratic republic of the congo", "congo kinshasa")),
+    "cf": ("caf", ("central african republic",)),
+    "cg": ("cog", ("republic of congo", "republic of the congo", "congo brazzaville", "congo")),
+    "ch": ("che", ("switzerland",)),
+    "ci": ("civ", ("cote divoire", "ivory coast")),
+    "ck": ("cok", ("cook islands",)),
+    "cl": ("chl", ("chile",)),
+    "cm": ("cmr", ("cameroon",)),
+    "cn": ("chn", ("china",)),
+    "co": ("col", ("colombia",)),
+    "cr": ("cri", ("costa rica",)),
+    "cu": ("cub", ("cuba",)),
+    "cv": ("cpv", ("cabo verde", "cape verde")),
+    "cw": ("cuw", ("curacao",)),
+    "cx": ("cxr", ("christmas island",)),
+    "cy": ("cyp", ("cyprus",)),
+    "cz": ("cze", ("czech republic", "czechia")),
+    "de": ("deu", ("germany",)),
+    "dj": ("dji", ("djibouti",)),
+    "dk": ("dnk", ("denmark",)),
+    "dm": ("dma", ("dominica",)),
+    "do": ("dom", ("dominican republic",)),
+    "dz": ("dza", ("algeria",)),
+    "ec": ("ecu", ("ecuador",)),
+    "ee": ("est", ("estonia",)),
+    "eg": ("egy", ("egypt",)),
+    "eh": ("esh", ("western sahara",)),
+    "er": ("eri", ("eritrea",)),
+    "es": ("esp", ("spain",)),
+    "et": ("eth", ("ethiopia",)),
+    "fi": ("fin", ("finland",)),
+    "fj": ("fji", ("fiji",)),
+    "fk": ("flk", ("falkland islands", "falkland islands malvinas")),
+    "fm": ("fsm", ("micronesia", "federated states of micronesia", "micronesia fsm")),
+    "fo": ("fro", ("faroe islands",)),
+    "fr": ("fra", ("france",)),
+    "ga": ("gab", ("gabon",)),
+    "gb": ("gbr", ("united kingdom",)),
+    "gd": ("grd", ("grenada",)),
+    "ge": ("geo", ("georgia",)),
+    "gf": ("guf", ("french guiana",)),
+    "gg": ("ggy", ("guernsey",)),
+    "gh": ("gha", ("ghana",)),
+    "gi": ("gib", ("gibraltar",)),
+    "gl": ("grl", ("greenland",)),
+    "gm": ("gmb", ("gambia",)),
+    "gn": ("gin", ("guinea",)),
+    "gp": ("glp", ("guadeloupe",)),
+    "gq": ("gnq", ("equatorial guinea",)),
+    "gr": ("grc", ("greece",)),
+    "gs": ("sgs", ("south georgia and the south sandwich islands",)),
+    "gt": ("gtm", ("guatemala",)),
+    "gu": ("gum", ("guam",)),
+    "gw": ("gnb", ("guinea bissau",)),
+    "gy": ("guy", ("guyana",)),
+    "hk": ("hkg", ("hong kong sar", "hong kong")),
+    "hm": ("hmd", ("heard island and mcdonald islands",)),
+    "hn": ("hnd", ("honduras",)),
+    "hr": ("hrv", ("croatia",)),
+    "ht": ("hti", ("haiti",)),
+    "hu": ("hun", ("hungary",)),
+    "id": ("idn", ("indonesia",)),
+    "ie": ("irl", ("ireland",)),
+    "il": ("isr", ("israel", "israel the west bank and the gaza strip")),
+    "im": ("imn", ("isle of man",)),
+    "in": ("ind", ("india",)),
+    "io": ("iot", ("british indian ocean territory",)),
+    "iq": ("irq", ("iraq",)),
+    "ir": ("irn", ("iran",)),
+    "is": ("isl", ("iceland",)),
+    "it": ("ita", ("italy",)),
+    "je": ("jey", ("jersey",)),
+    "jm": ("jam", ("jamaica",)),
+    "jo": ("jor", ("jordan",)),
+    "jp": ("jpn", ("japan",)),
+    "ke": ("ken", ("kenya",)),
+    "kg": ("kgz", ("kyrgyzstan",)),
+    "kh": ("khm", ("cambodia",)),
+    "ki": ("kir", ("kiribati",)),
+    "km": ("com", ("comoros",)),
+    "kn": ("kna", ("saint kitts and nevis",)),
+    "kp": ("prk", ("north korea",)),
+    "kr": ("kor", ("south korea",)),
+    "kw": ("kwt", ("kuwait",)),
+    "ky": ("cym", ("cayman islands",)),
+    "kz": ("kaz", ("kazakhstan",)),
+    "la": ("lao", ("laos",)),
+    "lb": ("lbn", ("lebanon",)),
+    "lc": ("lca", ("saint lucia",)),
+    "li": ("lie", ("liechtenstein",)),
+    "lk": ("lka", ("sri lanka",)),
+    "lr": ("lbr", ("liberia",)),
+    "ls": ("lso", ("lesotho",)),
+    "lt": ("ltu", ("lithuania",)),
+    "lu": ("lux", ("luxembourg",)),
+    "lv": ("lva", ("latvia",)),
+    "ly": ("lby", ("libya",)),
+    "ma": ("mar", ("morocco",)),
+    "mc": ("mco", ("monaco",)),
+    "md": ("mda", ("moldova",)),
+    "me": ("mne", ("montenegro",)),
+    "mf": ("maf", ("saint martin",)),
+    "mg": ("mdg", ("madagascar",)),
+    "mh": ("mhl", ("marshall islands",)),
+    "mk": ("mkd", ("north macedonia", "macedonia")),
+    "ml": ("mli", ("mali",)),
+    "mm": ("mmr", ("myanmar", "burma")),
+    "mn": ("mng", ("mongolia",)),
+    "mo": ("mac", ("macao sar", "macao", "macau")),
+    "mp": ("mnp", ("northern mariana islands",)),
+    "mq": ("mtq", ("martinique",)),
+    "mr": ("mrt", ("mauritania",)),
+    "ms": ("msr", ("montserrat",)),
+    "mt": ("mlt", ("malta",)),
+    "mu": ("mus", ("mauritius",)),
+    "mv": ("mdv", ("maldives",)),
+    "mw": ("mwi", ("malawi",)),
+    "mx": ("mex", ("mexico",)),
+    "my": ("mys", ("malaysia",)),
+    "mz": ("moz", ("mozambique",)),
+    "na": ("nam", ("namibia",)),
+    "nc": ("ncl", ("new caledonia",)),
+    "ne": ("ner", ("niger",)),
+    "nf": ("nfk", ("norfolk island",)),
+    "ng": ("nga", ("nigeria",)),
+    "ni": ("nic", ("nicaragua",)),
+    "nl": ("nld", ("netherlands",)),
+    "no": ("nor", ("norway",)),
+    "np": ("npl", ("nepal",)),
+    "nr": ("nru", ("nauru",)),
+    "nu": ("niu", ("niue",)),
+    "nz": ("nzl", ("new zealand",)),
+    "om": ("omn", ("oman",)),
+    "pa": ("pan", ("panama",)),
+    "pe": ("per", ("peru",)),
+    "pf": ("pyf", ("french polynesia",)),
+    "pg": ("png", ("papua new guinea",)),
+    "ph": ("phl", ("philippines",)),
+    "pk": ("pak", ("pakistan",)),
+    "pl": ("pol", ("poland",)),
+    "pm": ("spm", ("saint pierre and miquelon",)),
+    "pn": ("pcn", ("pitcairn islands", "pitcairn")),
+    "pr": ("pri", ("puerto rico",)),
+    "ps": ("pse", ("west bank and gaza", "palestinian territories", "palestine", "israel the west bank and the gaza strip")),
+    "pt": ("prt", ("portugal",)),
+    "pw": ("plw", ("palau",)),
+    "py": ("pry", ("paraguay",)),
+    "qa": ("qat", ("qatar",)),
+    "re": ("reu", ("reunion",)),
+    "ro": ("rou", ("romania",)),
+    "rs": ("srb", ("serbia",)),
+    "ru": ("rus", ("russia",)),
+    "rw": ("rwa", ("rwanda",)),
+    "sa": ("sau", ("saudi arabia",)),
+    "sb": ("slb", ("solomon islands",)),
+    "sc": ("syc", ("seychelles",)),
+    "sd": ("sdn", ("sudan",)),
+    "se": ("swe", ("sweden",)),
+    "sg": ("sgp", ("singapore",)),
+    "sh": ("shn", ("saint helena", "saint helena ascension and tristan da cunha")),
+    "si": ("svn", ("slovenia",)),
+    "sj": ("sjm", ("svalbard and jan mayen", "svalbard")),
+    "sk": ("svk", ("slovakia",)),
+    "sl": ("sle", ("sierra leone",)),
+    "sm": ("smr", ("san marino",)),
+    "sn": ("sen", ("senegal",)),
+    "so": ("som", ("somalia",)),
+    "sr": ("sur", ("suriname",)),
+    "ss": ("ssd", ("south sudan",)),
+    "st": ("stp", ("sao tome and principe",)),
+    "sv": ("slv", ("el salvador",)),
+    "sx": ("sxm", ("sint maarten",)),
+    "sy": ("syr", ("syria",)),
+    "sz": ("swz", ("eswatini", "swaziland")),
+    "tc": ("tca", ("turks and caicos islands", "turks and caicos")),
+    "td": ("tcd", ("chad",)),
+    "tf": ("atf", ("french southern territories", "french southern and antarctic lands")),
+    "tg": ("tgo", ("togo",)),
+    "th": ("tha", ("thailand",)),
+    "tj": ("tjk", ("tajikistan",)),
+    "tk": ("tkl", ("tokelau",)),
+    "tl": ("tls", ("timor leste", "east timor")),
+    "tm": ("tkm", ("turkmenistan",)),
+    "tn": ("tun", ("tunisia",)),
+    "to": ("ton", ("tonga",)),
+    "tr": ("tur", ("turkey", "turkiye")),
+    "tt": ("tto", ("trinidad and tobago",)),
+    "tv": ("tuv", ("tuvalu",)),
+    "tw": ("twn", ("taiwan",)),
+    "tz": ("tza", ("tanzania",)),
+    "ua": ("ukr", ("ukraine",)),
+    "ug": ("uga", ("uganda",)),
+    "um": ("umi", ("united states minor outlying islands",)),
+    "us": ("usa", ("united states",)),
+    "uy": ("ury", ("uruguay",)),
+    "uz": ("uzb", ("uzbekistan",)),
+    "va": ("vat", ("vatican city", "holy see")),
+    "vc": ("vct", ("saint vincent and the grenadines",)),
+    "ve": ("ven", ("venezuela",)),
+    "vg": ("vgb", ("british virgin islands", "virgin islands british")),
+    "vi": ("vir", ("us virgin islands", "united states virgin islands", "virgin islands us")),
+    "vn": ("vnm", ("vietnam",)),
+    "vu": ("vut", ("vanuatu",)),
+    "wf": ("wlf", ("wallis and futuna",)),
+    "ws": ("wsm", ("samoa",)),
+    "xk": ("xkx", ("kosovo",)),
+    "ye": ("yem", ("yemen",)),
+    "yt": ("myt", ("mayotte",)),
+    "za": ("zaf", ("south africa",)),
+    "zm": ("zmb", ("zambia",)),
+    "zw": ("zwe", ("zimbabwe",))
+}
+
+_PARENTHESES = re.compile(r"\s*\(([^)]*)\)\s*")
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_SEPARATORS = re.compile(r"[\s\-_/.,]+", re.UNICODE)
+
+
+def normalize(name):
+    """
+    This function reduces a country name to the form used as an index key:
+    lowercase, accents and punctuation removed, "&" spelled out, whitespace
+    collapsed and a leading "the" dropped.
+
+    :param name: A country name (str or unicode)
+    :return: unicode
+    """
+    if isinstance(name, str):
+        name = name.decode("utf-8", "replace")
+
+    name = unicodedata.normalize("NFKD", name)
+    name = u"".join(c for c in name if not unicodedata.combining(c))
+    name = name.lower().replace(u"&", u" and ")
+    name = _SEPARATORS.sub(u" ", name)
+    name = _PUNCTUATION.sub(u"", name).strip()
+
+    if name.startswith(u"the "):
+        name = name[4:]
+
+    return name
+
+
+def edit_distance(a, b, limit):
+    """
+    This function computes the optimal string alignment distance between two
+    strings (insertions, deletions, substitutions and adjacent
+    transpositions), giving up as soon as it must exceed `limit`.
+
+    :param a: A string
+    :param b: A string
+    :param limit: The largest distance of interest
+    :return: the distance, or limit + 1 if it is larger than limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous2 = None
+    previous = range(len(b) + 1)
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        best = i
+
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+
+            best = min(best, current[j])
+
+        if best > limit:
+            return limit + 1
+
+        previous2, previous = previous, current
+
+    return min(previous[-1], limit + 1)
+
+
+def _deletes(term, distance):
+    """
+    This function returns every string obtained by deleting up to `distance`
+    characters from term, term included.
+
+    :param term: A string
+    :param distance: The maximum number of deletions
+    :return: set
+    """
+    variants = set([term])
+    frontier = [term]
+
+    for _ in range(distance):
+        next_frontier = []
+
+        for word in frontier:
+            for i in range(len(word)):
+                variant = word[:i] + word[i + 1:]
+
+                if variant not in variants:
+                    variants.add(variant)
+                    next_frontier.append(variant)
+
+        frontier = next_frontier
+
+    return variants
+
+
+# shorter terms ("us", "uk", two-letter slugs) are too likely to be ordinary
+# words to be matched inside a sentence
+GAZETTEER_MIN_LENGTH = 3
+
+
+def max_distance(query):
+    """
+    This function returns how many typos are tolerated for a query of a
+    given length. Short queries are too easy to match by accident.
+
+    :param query: A normalized query
+    :return: int
+    """
+    if len(query) < 4:
+        return 0
+    if len(query) < 8:
+        return 1
+    return 2
+
+
+class CountryIndex(object):
+    """
+    This class resolves free-form country names to the keys of an advisory
+    snapshot. It is built once per snapshot, so that every lookup is a few
+    dictionary hits.
+
+    Every country is indexed under its normalized name, its slug (the first
+    cell of its row), the name without any parenthesised part, the
+    parenthesised part itself, and any matching entries in `aliases`. ISO
+    3166 alpha-2 and alpha-3 codes (see `iso_codes`) are matched too, but
+    only as a whole query.
+    Misspellings are matched through a precomputed table of deletions
+    (the symmetric delete method), so fuzzy lookups never scan the countries.
+
+    Names and aliases (not slugs) are also loaded into a trie of words, so
+    that country names can be picked out of a whole message in one pass.
+
+    Args:
+        countries - A dictionary of country advisories keyed by lowercase
+            country name.
+
+    Attributes:
+        _terms - {normalized term: set of country keys}
+        _codes - {lowercase ISO code: set of country keys}, for codes of
+            countries in the table that are not already terms.
+        _deletes - {term with up to MAX_DISTANCE characters deleted: set of
+            terms}, built on the first fuzzy lookup since it is by far the
+            most expensive part of the index and exact lookups never need
+            it.
+        _trie - Nested dictionaries of words; the None key of a node holds
+            the country keys of the term ending there.
+
+    High Level Usage:
+        index = CountryIndex(advisory_general())
+        index.resolve("the Bahamas")  # [(u"bahamas", 0)]
+    """
+
+    MAX_DISTANCE = 2
+
+    def __init__(self, countries):
+        self._terms = {}
+        self._codes = {}
+        self._deletes = None
+        self._trie = {}
+        self._lock = threading.Lock()
+
+        for key, country in countries.iteritems():
+            # the slug is looked up exactly, but never searched for in a message
+            self._terms.setdefault(normalize(country["slug"]), set()).add(key)
+
+            for term in self._country_terms(country):
+                self._terms.setdefault(term, set()).add(key)
+                self._add_phrase(term, key)
+
+        for alias, target in aliases.iteritems():
+            if target in self._terms:
+                self._terms.setdefault(normalize(alias), set()).update(self._terms[target])
+
+                for key in self._terms[target]:
+                    self._add_phrase(normalize(alias), key)
+
+        for alpha2, (alpha3, names) in iso_codes.iteritems():
+            target = next((name for name in names if name in self._terms), None)
+
+            if target is None:
+                continue
+
+            for code in (alpha2, alpha3):
+                # a name, slug or alias spelled like a code wins
+                if code not in self._terms:
+                    self._codes.setdefault(code, set()).update(self._terms[target])
+
+    def warm(self):
+        """
+        This function builds the table used for fuzzy lookups now, rather
+        than on the first fuzzy lookup.
+
+        :return: None
+        """
+        self._build_deletes()
+
+    def _build_deletes(self):
+        with self._lock:
+            if self._deletes is None:
+                deletes = {}
+
+                for term in self._terms:
+                    for variant in _deletes(term, self.MAX_DISTANCE):
+                        deletes.setdefault(variant, set()).add(term)
+
+                self._deletes = deletes
+
+        return self._deletes
+
+    def _add_phrase(self, term, key):
+        if len(term) < GAZETTEER_MIN_LENGTH:
+            return
+
+        node = self._trie
+
+        for word in term.split():
+            node = node.setdefault(word, {})
+
+        node.setdefault(None, set()).add(key)
+
+    @staticmethod
+    def _country_terms(country):
+        name = country["name"]
+        terms = set([normalize(name)])
+
+        # "Cote d'Ivoire (Ivory Coast)" is also "Cote d'Ivoire" and "Ivory Coast"
+        for inner in _PARENTHESES.findall(name):
+            terms.add(normalize(inner))
+        terms.add(normalize(_PARENTHESES.sub(u" ", name)))
+
+        # "Korea, South" is also "South Korea"
+        if u"," in name:
+            head, tail = name.rsplit(u",", 1)
+            terms.add(normalize(tail + u" " + head))
+
+        terms.discard(u"")
+
+        return terms
+
+    def resolve(self, query, limit=3):
+        """
+        This function returns the countries best matching a query, closest
+        first. An exact hit on any indexed term or ISO code has distance 0.
+
+        :param query: A country name, alias, slug, ISO code or misspelling
+        :param limit: The maximum number of candidates
+        :return: [(country key, distance)]
+        """
+        query = normalize(query)
+
+        if not query:
+            return []
+
+        exact = self._terms.get(query) or self._codes.get(query)
+
+        if exact:
+            return [(key, 0) for key in sorted(exact)][:limit]
+
+        distance = max_distance(query)
+        deletes = self._deletes if self._deletes is not None else self._build_deletes()
+        candidates = set()
+        best = {}
+
+        for variant in _deletes(query, distance):
+            candidates.update(deletes.get(variant, ()))
+
+        for term in candidates:
+            d = edit_distance(query, term, distance)
+
+            if d > distance:
+                continue
+
+            for key in self._terms[term]:
+                if d < best.get(key, distance + 1):
+                    best[key] = d
+
+        return sorted(best.iteritems(), key=lambda item: (item[1], item[0]))[:limit]
+
+    def extract(self, text):
+        """
+        This function finds the countries named in a message. The message is
+        scanned word by word, always taking the longest name that matches, so
+        "north korea" is not also read as "korea".
+
+        :param text: A message
+        :return: list of country keys, in order of appearance, without
+            duplicates
+        """
+        words = normalize(text).split()
+        found = []
+        i = 0
+
+        while i < len(words):
+            node = self._trie
+            match = None
+
+            for j in range(i, len(words)):
+                node = node.get(words[j])
+
+                if node is None:
+                    break
+
+                if None in node:
+                    match = (j, node[None])
+
+            if match is None:
+                i += 1
+                continue
+
+            for key in sorted(match[1]):
+                if key not in found:
+                    found.append(key)
+
+            i = match[0] + 1
+
+        return found
+
+    def lookup(self, query):
+        """
+        This function returns the country an exact term (name, slug, alias or
+        ISO code) refers to, or None.
+
+        :param query: A country name, alias, slug or ISO code
+        :return: country key or None
+        """
+        query = normalize(query)
+        keys = self._terms.get(query) or self._codes.get(query)
+
+        if not keys or len(keys) > 1:
+            return None
+
+        return next(iter(keys))
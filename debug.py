@@ -1,3 +1,245 @@
+"""
+Logging for the bot. Records are handed to a queue on the calling thread and
+written by a listener thread, so a slow stdout (Heroku's log drain under
+load) never holds up answering a webhook. Messages should use lazy %s
+arguments, so nothing is formatted for records that are filtered out.
+
+    LOG_LEVEL        the root level (INFO)
+    LOG_FORMAT       "text", or "json" for one JSON object per line
+    LOG_QUEUE        "1" to write from a listener thread, "0" to write inline
+    LOG_QUEUE_SIZE   records waiting to be written; more are dropped, not
+                     waited for
+    LOG_SAMPLE_RATE  the fraction of per-event lines (MESSAGE RECEIVED,
+                     DELIVERED, READ) that are kept
+
+Fields passed with extra= (sender, token, timings...) are included in JSON
+records. Pass extra={"sampled": True} to make a line subject to
+LOG_SAMPLE_RATE.
+"""
+
+import atexit
+import json
 import logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
\ No newline at end of file
+import os
+import random
+import sys
+import threading
+from datetime import datetime
+from Queue import Queue, Full
+
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_QUEUE = os.environ.get("LOG_QUEUE", "1") == "1"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# attributes every LogRecord has; anything else came from extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys() + ["message", "asctime", "sampled"])
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    This class formats a record as one line of JSON: time, level, logger,
+    message, the fields passed with extra=, and the traceback if any.
+    """
+
+    def format(self, record):
+        data = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        for key, value in vars(record).iteritems():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+
+        return json.dumps(data, default=repr)
+
+
+class SampleFilter(logging.Filter):
+    """
+    This class keeps a fraction of the records logged with
+    extra={"sampled": True}, and every other record.
+
+    Args:
+        rate - The fraction of sampled records kept, from 0 to 1.
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or self.rate >= 1:
+            return True
+
+        if random.random() < self.rate:
+            return True
+
+        self.dropped += 1
+        return False
+
+
+class QueueHandler(logging.Handler):
+    """
+    This class hands records to a QueueListener instead of writing them. It
+    is the Python 3 logging.handlers.QueueHandler, which Python 2 lacks, made
+    to drop records rather than block when the queue is full.
+
+    The message is merged with its arguments, and the traceback rendered,
+    before a record is queued, like QueueHandler.prepare in Python 3. By the
+    time the listener gets to it, mutable arguments may have changed and
+    the frames may be gone. Records dropped by a level or a filter are never
+    formatted at all.
+
+    Args:
+        listener - The QueueListener writing the records.
+
+    Attributes:
+        dropped - The number of records dropped because the queue was full.
+    """
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.dropped = 0
+        self._formatter = logging.Formatter()
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        # a worker forked after import has the queue but not the thread
+        self.listener.ensure_started()
+
+        try:
+            self.listener.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """
+    This class writes the records queued by a QueueHandler to its handlers,
+    from a daemon thread. Like logging.handlers.QueueListener in Python 3.
+
+    Args:
+        handlers - The handlers that write the records.
+        maxsize - The maximum number of records waiting.
+
+    High Level Usage:
+        listener = QueueListener([logging.StreamHandler()])
+        logging.getLogger().addHandler(QueueHandler(listener))
+        listener.ensure_started()
+    """
+
+    _STOP = None
+
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE):
+        self.queue = Queue(maxsize)
+        self.handlers = handlers
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """
+        This function starts the listener thread, unless it is running in
+        this process already.
+
+        :return: None
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="log-listener")
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stop(self, timeout=5):
+        """
+        This function writes out whatever is still queued and stops the
+        thread.
+
+        :param timeout: Seconds to wait for the queue to drain
+        :return: None
+        """
+        if self._pid != os.getpid():
+            return
+
+        self.queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+
+            if record is self._STOP:
+                break
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def log_stats():
+    """
+    This function returns the number of log records dropped, because the
+    queue was full or by sampling.
+
+    :return: {}
+    """
+    return {
+        "queue_full": queue_handler.dropped if queue_handler is not None else 0,
+        "sampled_out": sampler.dropped
+    }
+
+
+def _configure():
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+    if LOG_QUEUE:
+        listener = QueueListener([stream])
+        handler = QueueHandler(listener)
+        listener.ensure_started()
+        atexit.register(listener.stop)
+    else:
+        handler = stream
+
+    # sampled records are dropped before they are queued
+    handler.addFilter(sampler)
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    return handler if LOG_QUEUE else None
+
+
+sampler = SampleFilter(LOG_SAMPLE_RATE)
+queue_handler = _configure()
+logger = logging.getLogger(__name__)
@@ -0,0 +1,185 @@
+from cache import LRUCache
+from debug import logger
+import hashlib
+import os
+import threading
+
+
+# Facebook retries an unanswered webhook for hours; an event is remembered
+# for longer than that
+DEDUP_TTL = int(os.environ.get("DEDUP_TTL", 24 * 60 * 60))
+# events remembered in process, in front of Redis
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", 10000))
+
+
+def event_key(event):
+    """
+    This function returns what identifies a messaging event across
+    redeliveries: the message ID for messages, and the sender, timestamp and
+    payload (or watermark) for everything else.
+
+    :param event: A messaging event from a webhook callback
+    :return: str, or None if the event cannot be told apart from others
+    """
+    sender = event.get("sender", {}).get("id")
+
+    if "message" in event and event["message"].get("mid"):
+        return "mid:{}".format(event["message"]["mid"])
+    elif "postback" in event:
+        payload = hashlib.sha1(event["postback"].get("payload", "").encode("utf-8")).hexdigest()[:16]
+        return "postback:{}:{}:{}".format(sender, event.get("timestamp"), payload)
+    elif "delivery" in event:
+        return "delivery:{}:{}".format(sender, event["delivery"].get("watermark"))
+    elif "read" in event:
+        return "read:{}:{}".format(sender, event["read"].get("watermark"))
+
+    return None
+
+
+class WebhookDeduplicator(object):
+    """
+    This class drops messaging events that were already handled, so that a
+    webhook Facebook redelivers (because we answered slowly) does not run
+    Wit, the advisory lookup and the Send API again.
+
+    Each event is claimed with an atomic SET NX EX in Redis, so only one
+    process handles it even when the redelivery reaches another worker. The
+    claims of one webhook are made in a single pipelined round trip, and an
+    in-process LRU in front of Redis answers redeliveries to the same worker
+    without one. Without Redis, or while it fails, only the LRU is used.
+
+    Args:
+        ds - A Redis instance, or None.
+        ttl - Seconds an event is remembered.
+        size - The number of events remembered in process.
+        name - The Redis key prefix.
+
+    Attributes:
+        _seen - An LRUCache of the event keys claimed or seen here.
+        _stats - Counters of events checked and duplicates found per tier.
+
+    High Level Usage:
+        deduplicator = WebhookDeduplicator(redis_store)
+        events = deduplicator.filter(events)
+    """
+
+    def __init__(self, ds=None, ttl=DEDUP_TTL, size=DEDUP_CACHE_SIZE, name="dedup"):
+        self._ds = ds
+        self._ttl = ttl
+        self._name = name
+        self._seen = LRUCache(size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "local_duplicates": 0, "shared_duplicates": 0}
+
+    def filter(self, events):
+        """
+        This function returns the events of a webhook that have not been
+        handled before, claiming them. Events that cannot be identified are
+        always kept.
+
+        :param events: A list of messaging events
+        :return: list of events, in the same order
+        """
+        keys = [event_key(event) for event in events]
+        fresh = {}
+        local = shared = 0
+
+        for key in keys:
+            if key is None:
+                continue
+
+            if key in fresh or self._seen.get(key) is not None:
+                local += 1
+            else:
+                fresh[key] = True
+
+        claimed = self._claim(fresh.keys())
+
+        for key in fresh:
+            self._seen.set(key, True)
+
+            if not claimed[key]:
+                shared += 1
+
+        with self._lock:
+            self._stats["checked"] += len([key for key in keys if key is not None])
+            self._stats["local_duplicates"] += local
+            self._stats["shared_duplicates"] += shared
+
+        kept = []
+
+        for event, key in zip(events, keys):
+            if key is None:
+                kept.append(event)
+            elif fresh.get(key) and claimed[key]:
+                kept.append(event)
+                # a key repeated in the same webhook is only kept once
+                fresh[key] = False
+
+        if len(kept) < len(events):
+            ###
+            logger.info("Dropped %d duplicate events.", len(events) - len(kept))
+            ###
+
+        return kept
+
+    def forget(self, events):
+        """
+        This function releases the claims on events, so that a redelivery is
+        handled again. It is used when handling them failed.
+
+        :param events: A list of messaging events
+        :return: None
+        """
+        keys = [key for key in (event_key(event) for event in events) if key is not None]
+
+        for key in keys:
+            self._seen.pop(key)
+
+        if self._ds is None or not keys:
+            return
+
+        try:
+            self._ds.delete(*[self._key(key) for key in keys])
+        except Exception:
+            ###
+            logger.exception("Could not release deduplication claims.")
+            ###
+
+    def stats(self):
+        """
+        This function returns the number of events checked, the duplicates
+        found in process and in Redis, and the duplicate rate.
+
+        :return: {}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        duplicates = stats["local_duplicates"] + stats["shared_duplicates"]
+
+        stats["duplicates"] = duplicates
+        stats["duplicate_rate"] = float(duplicates) / stats["checked"] if stats["checked"] else 0.0
+
+        return stats
+
+    def _claim(self, keys):
+        if self._ds is None or not keys:
+            return dict((key, True) for key in keys)
+
+        try:
+            pipe = self._ds.pipeline(transaction=False)
+
+            for key in keys:
+                pipe.set(self._key(key), os.getpid(), ex=self._ttl, nx=True)
+
+            return dict((key, bool(claimed)) for key, claimed in zip(keys, pipe.execute()))
+        except Exception:
+            ###
+            logger.exception("Could not reach Redis to deduplicate events, using the local cache only.")
+            ###
+
+            return dict((key, True) for key in keys)
+
+    def _key(self, key):
+        return "{}:{}".format(self._name, key)
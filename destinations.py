@@ -0,0 +1,187 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from urlparse import urljoin, urlparse
+from debug import logger
+from scraper import urls, advisory_cache, FETCH_TIMEOUT
+from workers import WorkerPool
+import os
+import threading
+import urllib2
+
+
+# element ids of the sections kept from each destination page
+sections = {
+    "regional_advisories": "advisories",
+    "entry_exit": "entry-exit",
+    "health": "health"
+}
+
+DESTINATION_WORKERS = int(os.environ.get("DESTINATION_WORKERS", 8))
+DESTINATION_PER_HOST = int(os.environ.get("DESTINATION_PER_HOST", 4))
+# fetch every changed destination page whenever the advisory snapshot changes,
+# instead of waiting for the first request for it
+DESTINATION_PREFETCH = os.environ.get("DESTINATION_PREFETCH", "0") == "1"
+
+
+def parse_destination(data):
+    """
+    This function pulls the interesting sections out of a raw destination
+    page. Only the elements with the ids in `sections` are parsed into a tree.
+
+    :param data: The raw HTML of a destination page
+    :return: {section: text or None}
+    """
+    soup = BeautifulSoup(data, "html.parser", parse_only=SoupStrainer(id=sections.values()))
+    details = {}
+
+    for key, id_ in sections.iteritems():
+        element = soup.find(id=id_)
+        details[key] = element.get_text("\n", strip=True) if element is not None else None
+
+    return details
+
+
+class DestinationScraper(object):
+    """
+    This class fetches and caches the country destination pages linked from
+    the general advisory table. Each cached page is keyed by the last updated
+    value of its row, so a page is only fetched again once its row changes.
+
+    Fetches run on a bounded WorkerPool, and no more than `per_host` of them
+    hit any one host at a time.
+
+    Args:
+        base_url - The URL the country pages live under.
+        workers - The number of fetch threads.
+        per_host - The maximum number of concurrent fetches per host.
+
+    Attributes:
+        _cache - {country key: (last_updated, details)}
+        _pending - {country key: (last_updated, Task)} for fetches in flight,
+            so a page is never fetched twice at once.
+        _hosts - {host: BoundedSemaphore}
+
+    High Level Usage:
+        scraper = DestinationScraper()
+        scraper.refresh(advisory_general(), wait=True)
+        details = scraper.get("mexico")
+    """
+
+    def __init__(self, base_url=urls["specific"], workers=DESTINATION_WORKERS, per_host=DESTINATION_PER_HOST):
+        self._base_url = base_url
+        self._per_host = per_host
+        self._pool = WorkerPool(workers, "destination")
+        self._cache = {}
+        self._pending = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def url(self, country):
+        """
+        This function returns the destination page URL for a country.
+
+        :param country: A country advisory dictionary
+        :return: URL string
+        """
+        return urljoin(self._base_url, country["url"].rstrip("/").rsplit("/", 1)[-1])
+
+    def get(self, key, country=None):
+        """
+        This function returns the cached details for a country. If a country
+        advisory is given and the cache is missing or stale, the page is
+        fetched first.
+
+        :param key: The lowercase country name
+        :param country: The country advisory dictionary, or None
+        :return: {section: text or None} or None
+        """
+        cached = self._cache.get(key)
+
+        if country is not None and (cached is None or cached[0] != country["last_updated"]):
+            self._submit(key, country).wait()
+            cached = self._cache.get(key)
+
+        return cached[1] if cached is not None else None
+
+    def refresh(self, countries, wait=False):
+        """
+        This function fetches the page of every country whose row changed
+        since its page was cached.
+
+        :param countries: A dictionary of country advisories
+        :param wait: Block until every fetch has finished
+        :return: the number of pages fetched
+        """
+        tasks = []
+
+        for key, country in countries.iteritems():
+            cached = self._cache.get(key)
+
+            if cached is None or cached[0] != country["last_updated"]:
+                tasks.append(self._submit(key, country))
+
+        if wait:
+            for task in tasks:
+                task.wait()
+
+        return len(tasks)
+
+    def _submit(self, key, country):
+        with self._lock:
+            pending = self._pending.get(key)
+
+            if pending is not None and pending[0] == country["last_updated"]:
+                return pending[1]
+
+            task = self._pool.submit(self._fetch, key, country)
+            self._pending[key] = (country["last_updated"], task)
+
+        return task
+
+    def _fetch(self, key, country):
+        url = self.url(country)
+
+        try:
+            with self._host_semaphore(urlparse(url).netloc):
+                data = urllib2.urlopen(url, timeout=FETCH_TIMEOUT).read()
+
+            self._cache[key] = (country["last_updated"], parse_destination(data))
+        except Exception:
+            ###
+            logger.exception("Could not fetch destination page: %s", url)
+            ###
+        finally:
+            with self._lock:
+                if self._pending.get(key, (None,))[0] == country["last_updated"]:
+                    del self._pending[key]
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self._per_host)
+
+            return self._hosts[host]
+
+
+destination_scraper = DestinationScraper()
+
+
+def destination_details(country):
+    """
+    This function returns the destination page details for a country,
+    fetching the page only if its advisory row changed since it was cached.
+
+    :param country: a string that represents a country name
+    :return: {section: text or None} or None
+    """
+    key = country.lower()
+
+    return destination_scraper.get(key, advisory_cache.get().countries.get(key))
+
+
+def _prefetch(previous, snapshot):
+    # unchanged rows are skipped by the cache check in refresh
+    destination_scraper.refresh(snapshot.countries)
+
+
+if DESTINATION_PREFETCH:
+    advisory_cache.add_listener(_prefetch)
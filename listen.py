@@ -15,26 +15,43 @@
 # never change, it should be eternally once.
 
 from flask import (Flask, jsonify, request, make_response, render_template)
+from collections import OrderedDict
+import hashlib
+import hmac
 import os
-import redis
+import threading
+import time
 
-from bot import create_client, handle_message
-from send import send_typing, send_message, send_mark_seen
-from debug import logger
-from session import FacebookBotRedisSessionManager
+from bot import create_client, handle_text, handle_subscription, notifier, redis_store, session_manager
+from metrics import add_collector, increment, registry, timer
+from scraper import advisory_cache
+from subscriptions import SUBSCRIBE, UNSUBSCRIBE
+from send import send_typing, send_message, send_mark_seen, scheduler_stats, sender_actions
+from debug import logger, log_stats
+from dedup import WebhookDeduplicator
+from workers import EventQueue, RedisEventQueue, KeyedWorkerPool
 
 
 app = Flask(__name__, static_folder="static")
 
-redis_store = redis.from_url(os.environ.get("REDIS_URL"))
-session_manager = FacebookBotRedisSessionManager(redis_store)
 wit = create_client()
 
+# "inline" handles events one after another before answering the webhook,
+# "concurrent" handles different senders in parallel before answering, and
+# "queue" answers right away and leaves them to a pool of workers
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "inline")
+# "memory" or "redis"
+WEBHOOK_QUEUE = os.environ.get("WEBHOOK_QUEUE", "memory")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+
 
 ROOT = "/canadian_travel_advisory_bot/{}/"
 FB_CALLBACK = os.environ["FB_CALLBACK_TOKEN"]
 FB_VERIFY_TOKEN = os.environ["FB_VERIFICATION_TOKEN"]
 FB_ACCESS_TOKEN = os.environ["FB_ACCESS_TOKEN"]
+# /metrics answers only requests carrying "Authorization: Bearer <token>",
+# and does not exist at all without one
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
 
 
 @app.route("/")
@@ -62,7 +79,7 @@ def verify_token():
         else:
 
             ###
-            logger.error("Validation token sent does not match: {}".format(request.args["hub.verify_token"]))
+            logger.error("Validation token sent does not match: %s", request.args["hub.verify_token"])
             ###
 
             return make_response("Failed validation. Make sure the validation tokens match.", 403)
@@ -71,108 +88,414 @@ def verify_token():
 @app.route(ROOT.format(FB_CALLBACK), methods=["POST"])
 def webhook_callback():
     ###
-    logger.info("MESSAGING EVENT RECEIVED.")
+    logger.info("MESSAGING EVENT RECEIVED.", extra={"sampled": True})
     ###
 
-    data = request.json
+    with timer("webhook_parse"):
+        data = request.json
 
     # ensure that callback came from a "page" object
     if data["object"] == "page":
-        # go through each entry
-        for entry in data["entry"]:
-            # only if messaging
-            if "messaging" in entry:
-                # go through each messaging event
-                for event in entry["messaging"]:
-                    # check if we have a new message
-                    if "message" in event:
-
-                        ###
-                        logger.info("MESSAGE RECEIVED.")
-                        ###
-
-                        # get sender
-                        sender = event["sender"]["id"]
-                        # get session token
-                        token = session_manager.get_session_token(sender)
-                        # try and find session
-                        existing_session = session_manager.get_session(token)
-                        # get message
-                        message = event["message"]
-                        # check to see if this is a new user/session
-                        if existing_session is None:
-                            ###
-                            logger.info("New session: {}".format(sender))
-                            ###
-
-                            # mark seen
-                            send_mark_seen(sender)
-
-                            session_manager.create_session(sender, **{
-                                "context": {},
-                                "lang": 0
-                            })
-                        # check to see if it is a message or attachment
-                        elif "attachments" in message:
-
-                            ###
-                            logger.info("Attachment received from: {}".format(sender))
-                            ###
-
-                            # typing...
-                            send_typing(sender)
-                            # cannot process attachments
-                            send_message(sender, "I can't do much with that, but if you send me a name of a country, I can tell you the travel advisory for it.")
-                        elif "text" in message:
-
-                            ###
-                            logger.info("Text received from: {}".format(sender))
-                            ###
-
-                            # typing...
-                            send_typing(sender)
-                            # get session ID
-                            session_id = session_manager.get_session_token(sender)
-                            # converse
-                            response = wit.message(msg=message["text"], context={"session_id": session_id})
-                            # respond
-                            handle_message(response, session_id)
-                    # check if we have a message delivered
-                    elif "delivery" in event:
-                        ###
-                        logger.info("MESSAGE DELIVERED.")
-                        ###
-                    # check if a message was read
-                    elif "read" in event:
-                        ###
-                        logger.info("MESSAGE READ.")
-                        ###
-                    # check if we have a postback
-                    elif "postback" in event:
-                        ###
-                        logger.info("POSTBACK RECEIVED.")
-                        ###
-
-                        # get sender
-                        sender = event["sender"]["id"]
-                        # get postback data
-                        postback = event["postback"]
-                        payload = postback["payload"]
-                        # what do I do?
-                        if payload == "WHAT_DO_I_DO":
-                            # typing...
-                            send_typing(sender)
-                            # cannot process attachments
-                            send_message(sender, "I want you to help you stay informed when travelling abroad. Ask me something like \"What is the current travel advisory for the Brazil?\".")
-                    else:
-
-                        ###
-                        logger.error("UKNOWN MESSAGING EVENT.")
-                        ###
+        # go through each entry, only if messaging
+        events = [event for entry in data["entry"] for event in entry.get("messaging", [])]
+
+        for event in events:
+            increment("webhook_events_total", kind=event_kind(event))
+
+        # redeliveries of events already handled stop here, before any
+        # outside call
+        with timer("dedup"):
+            events = deduplicator.filter(events)
+
+        if event_queue is None:
+            try:
+                wall_time, event_time = process_batch(events)
+            except BatchFailed as e:
+                # Facebook will deliver the whole batch again; only the
+                # senders that failed should be handled then
+                deduplicator.forget(e.events)
+                raise
+            except Exception:
+                deduplicator.forget(events)
+                raise
+
+            response = make_response(jsonify({}), 200)
+            response.headers["X-Batch-Wall-Time"] = "{:.2f}".format(wall_time * 1000)
+            response.headers["X-Batch-Event-Time"] = "{:.2f}".format(event_time * 1000)
+
+            return response
+
+        # handled after we respond, in order per sender
+        for event in events:
+            event_queue.put(event["sender"]["id"], event)
 
     return make_response(jsonify({}), 200)
 
 
+@app.route("/metrics")
+def metrics():
+    """
+    This function serves the metrics in the Prometheus text format, to
+    scrapers presenting METRICS_TOKEN. They reveal page token digests, queue
+    depths and traffic, so the route is hidden when no token is set.
+
+    :return: response
+    """
+    if not METRICS_TOKEN:
+        return make_response(jsonify({"error": "Not Found"}), 404)
+
+    given = hashlib.sha256(request.headers.get("Authorization", u"").encode("utf-8")).digest()
+    expected = hashlib.sha256("Bearer " + METRICS_TOKEN).digest()
+
+    if not hmac.compare_digest(given, expected):
+        response = make_response("Missing or wrong metrics token.", 401)
+        response.headers["WWW-Authenticate"] = "Bearer"
+
+        return response
+
+    response = make_response(registry.render(), 200)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+
+    return response
+
+
+def event_kind(event):
+    for kind in ("message", "delivery", "read", "postback"):
+        if kind in event:
+            return kind
+
+    return "unknown"
+
+
+class BatchStats(object):
+    """
+    This class accumulates, over every webhook batch handled before
+    answering, the wall time of the batch and the summed time of its
+    senders' events. The closer the two are, the less there was to gain
+    from handling senders in parallel.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "events": 0, "wall_time": 0.0, "event_time": 0.0}
+
+    def record(self, events, wall_time, event_time):
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["events"] += events
+            self._stats["wall_time"] += wall_time
+            self._stats["event_time"] += event_time
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+batch_stats = BatchStats()
+
+
+class BatchFailed(Exception):
+    """
+    This exception is raised when some senders' events in a concurrently
+    handled batch failed, after every sender has finished.
+
+    Attributes:
+        events - The events of the senders that failed.
+        errors - The exceptions they raised.
+    """
+
+    def __init__(self, events, errors):
+        super(BatchFailed, self).__init__("{} of the batch's senders failed: {!r}".format(len(errors), errors[0]))
+        self.events = events
+        self.errors = errors
+
+
+def process_batch(events):
+    """
+    This function handles a batch of messaging events before the webhook is
+    answered. In "concurrent" mode, each sender's events go to a
+    KeyedWorkerPool lane, so one sender's events stay in order while
+    different senders proceed in parallel.
+
+    :param events: A list of messaging events from a webhook callback
+    :return: (wall time, summed time of every sender's events) in seconds
+    :raises BatchFailed: in "concurrent" mode, if any sender's events
+        failed, once the other senders are done; in "inline" mode, the
+        first error is raised as is
+    """
+    start = time.time()
+    failed = []
+    errors = []
+    sessions = load_sessions(events)
+
+    if sender_pool is None:
+        process_events(events, sessions)
+        wall_time = event_time = time.time() - start
+    else:
+        by_sender = OrderedDict()
+
+        for event in events:
+            by_sender.setdefault(event["sender"]["id"], []).append(event)
+
+        tasks = [(group, sender_pool.submit(sender, timed_process_events, group, sessions)) for sender, group in by_sender.iteritems()]
+        event_time = 0.0
+
+        for group, task in tasks:
+            try:
+                event_time += task.result()
+            except Exception as e:
+                # already logged by the task; raised once every sender is done
+                failed.extend(group)
+                errors.append(e)
+
+        wall_time = time.time() - start
+
+    batch_stats.record(len(events), wall_time, event_time)
+    registry.observe("stage_seconds", wall_time, stage="batch")
+
+    ###
+    logger.info("Batch of %d events: %.1fms wall, %.1fms summed.", len(events), wall_time * 1000, event_time * 1000, extra={
+        "stage": "batch",
+        "events": len(events),
+        "wall_ms": round(wall_time * 1000, 2),
+        "event_ms": round(event_time * 1000, 2)
+    })
+    ###
+
+    if errors:
+        raise BatchFailed(failed, errors)
+
+    return wall_time, event_time
+
+
+def load_sessions(events):
+    """
+    This function looks up the sessions of every message sender in a list of
+    events in one round trip.
+
+    :param events: A list of messaging events
+    :return: A dictionary of session token -> session object (or None)
+    """
+    senders = set(event["sender"]["id"] for event in events if "message" in event)
+
+    with timer("session_lookup"):
+        tokens = [session_manager.get_session_token(sender) for sender in senders]
+
+        return dict(zip(tokens, session_manager.get_sessions(tokens)))
+
+
+def process_events(events, sessions=None):
+    """
+    This function handles a list of messaging events, in order.
+
+    :param events: A list of messaging events from a webhook callback
+    :param sessions: The result of load_sessions for these events, if the
+        caller already has it
+    :return: None
+    """
+    if sessions is None:
+        sessions = load_sessions(events)
+
+    # go through each messaging event
+    for event in events:
+        process_event(event, sessions)
+
+
+def timed_process_events(events, sessions):
+    start = time.time()
+    process_events(events, sessions)
+
+    return time.time() - start
+
+
+def process_event(event, sessions):
+    """
+    This function handles a single messaging event.
+
+    :param event: A messaging event from a webhook callback
+    :param sessions: A dictionary of session token -> session object (or
+        None) covering at least this event's sender. New sessions are added
+        to it.
+    :return: None
+    """
+    # check if we have a new message
+    if "message" in event:
+
+        ###
+        logger.info("MESSAGE RECEIVED.", extra={"sampled": True, "sender": event["sender"]["id"]})
+        ###
+
+        # get sender
+        sender = event["sender"]["id"]
+        # get session token
+        token = session_manager.get_session_token(sender)
+        # try and find session
+        existing_session = sessions.get(token)
+        # get message
+        message = event["message"]
+        # check to see if this is a new user/session
+        if existing_session is None:
+            ###
+            logger.info("New session: %s", sender, extra={"sender": sender, "token": token})
+            ###
+
+            # mark seen
+            send_mark_seen(sender)
+
+            with timer("session_create"):
+                sessions[token] = session_manager.create_session(sender, **{
+                    "context": {},
+                    "lang": 0
+                })
+        # check to see if it is a message or attachment
+        elif "attachments" in message:
+
+            ###
+            logger.info("Attachment received from: %s", sender, extra={"sender": sender, "token": token})
+            ###
+
+            # typing...
+            send_typing(sender)
+            # cannot process attachments
+            send_message(sender, "I can't do much with that, but if you send me a name of a country, I can tell you the travel advisory for it.")
+        elif "text" in message:
+
+            ###
+            logger.info("Text received from: %s", sender, extra={"sender": sender, "token": token})
+            ###
+
+            # typing...
+            send_typing(sender)
+            # converse and respond
+            handle_text(wit, message["text"], token, existing_session)
+    # check if we have a message delivered
+    elif "delivery" in event:
+        ###
+        logger.info("MESSAGE DELIVERED.", extra={"sampled": True, "sender": event["sender"]["id"]})
+        ###
+    # check if a message was read
+    elif "read" in event:
+        ###
+        logger.info("MESSAGE READ.", extra={"sampled": True, "sender": event["sender"]["id"]})
+        ###
+    # check if we have a postback
+    elif "postback" in event:
+        ###
+        logger.info("POSTBACK RECEIVED.", extra={"sender": event["sender"]["id"]})
+        ###
+
+        # get sender
+        sender = event["sender"]["id"]
+        # get postback data
+        postback = event["postback"]
+        payload = postback["payload"]
+        # what do I do?
+        if payload == "WHAT_DO_I_DO":
+            # typing...
+            send_typing(sender)
+            # cannot process attachments
+            send_message(sender, "I want you to help you stay informed when travelling abroad. Ask me something like \"What is the current travel advisory for the Brazil?\", or \"details Brazil\" for its regional advisories, entry requirements and health advice.")
+        # (un)subscribe to a country's advisory changes
+        elif payload.startswith((SUBSCRIBE, UNSUBSCRIBE)):
+            handle_subscription(sender, payload)
+    else:
+
+        ###
+        logger.error("UKNOWN MESSAGING EVENT.")
+        ###
+
+
+def process_queued_event(event):
+    process_events([event])
+
+
+if WEBHOOK_MODE == "queue" and WEBHOOK_QUEUE == "redis" and redis_store is not None:
+    event_queue = RedisEventQueue(redis_store, process_queued_event, WEBHOOK_WORKERS)
+elif WEBHOOK_MODE == "queue":
+    event_queue = EventQueue(process_queued_event, WEBHOOK_WORKERS)
+else:
+    event_queue = None
+
+sender_pool = KeyedWorkerPool(WEBHOOK_WORKERS, "senders") if WEBHOOK_MODE == "concurrent" else None
+
+deduplicator = WebhookDeduplicator(redis_store)
+
+
+def collect_stats():
+    """
+    This function reads the counters the other modules keep into metric
+    samples, at every /metrics scrape.
+
+    :return: generator of (name, type, labels, value)
+    """
+    nlu = wit.stats()
+
+    for outcome in ("local_hits", "shared_hits", "misses"):
+        yield "nlu_cache_total", "counter", {"outcome": outcome}, nlu[outcome]
+
+    yield "nlu_cache_time_saved_seconds_total", "counter", {}, nlu["time_saved"]
+    yield "nlu_wit_seconds_total", "counter", {}, nlu["wit_time"]
+
+    tokens = session_manager.token_cache_stats()
+
+    for outcome in ("hits", "misses"):
+        yield "session_token_cache_total", "counter", {"outcome": outcome}, tokens[outcome]
+
+    # the in-memory and tiered managers keep sessions in process
+    if hasattr(session_manager, "session_cache_stats"):
+        cached = session_manager.session_cache_stats()
+
+        for outcome in ("hits", "misses", "evictions", "expirations"):
+            yield "session_cache_total", "counter", {"outcome": outcome}, cached[outcome]
+
+        yield "session_cache_size", "gauge", {}, cached["size"]
+
+    actions = sender_actions.stats()
+
+    for outcome in ("sent", "saved_typing_on", "saved_mark_seen"):
+        yield "sender_actions_total", "counter", {"outcome": outcome}, actions[outcome]
+
+    for page, stats in scheduler_stats().iteritems():
+        yield "send_queue_depth", "gauge", {"page": page}, stats["depth"]
+        yield "send_rate_limit", "gauge", {"page": page}, stats["rate"]
+
+        for priority in ("interactive", "bulk"):
+            yield "send_scheduler_total", "counter", {"page": page, "priority": priority, "outcome": "granted"}, stats[priority]["granted"]
+            yield "send_scheduler_total", "counter", {"page": page, "priority": priority, "outcome": "dropped"}, stats[priority]["dropped"]
+            yield "send_scheduler_wait_seconds_total", "counter", {"page": page, "priority": priority}, stats[priority]["wait_time"]
+
+    dedup = deduplicator.stats()
+
+    yield "webhook_dedup_checked_total", "counter", {}, dedup["checked"]
+
+    for tier in ("local", "shared"):
+        yield "webhook_duplicates_total", "counter", {"tier": tier}, dedup[tier + "_duplicates"]
+
+    batches = batch_stats.snapshot()
+
+    yield "batch_total", "counter", {"count": "batches"}, batches["batches"]
+    yield "batch_total", "counter", {"count": "events"}, batches["events"]
+    yield "batch_seconds_total", "counter", {"time": "wall"}, batches["wall_time"]
+    yield "batch_seconds_total", "counter", {"time": "events"}, batches["event_time"]
+
+    if notifier is not None:
+        notifications = notifier.stats()
+
+        for outcome in ("sent", "failed", "dropped"):
+            yield "notifications_total", "counter", {"outcome": outcome}, notifications[outcome]
+
+    for reason, dropped in log_stats().iteritems():
+        yield "log_records_dropped_total", "counter", {"reason": reason}, dropped
+
+    checked_at = advisory_cache.checked_at
+
+    if checked_at is not None:
+        yield "advisory_snapshot_age_seconds", "gauge", {}, time.time() - checked_at
+
+
+add_collector(collect_stats)
+
+
 def main():
     app.run()
 
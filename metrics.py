@@ -0,0 +1,300 @@
+"""
+In-process metrics for the hot path: counters and fixed-bucket latency
+histograms, rendered in the Prometheus text format by the /metrics route.
+
+Each series is a few integers behind a lock, so recording costs about as much
+as a dictionary update; nothing is sent anywhere until /metrics is scraped.
+Counters other modules already keep (cache hit rates, send scheduler state,
+notification counts) are read at scrape time through collectors instead of
+being counted twice.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from debug import logger
+import threading
+import time
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "travel_bot_"
+
+# HELP text of the metrics recorded here or read through collectors
+DESCRIPTIONS = {
+    "stage_seconds": "Time spent in each stage of handling a message.",
+    "send_seconds": "Send API call latency per endpoint, one observation per call made.",
+    "send_errors_total": "Send API calls that failed, per endpoint and status.",
+    "webhook_events_total": "Messaging events received, per kind.",
+    "nlu_cache_total": "Wit lookups per cache outcome.",
+    "nlu_cache_time_saved_seconds_total": "Wit time saved by cache hits, what each hit's original call took.",
+    "nlu_wit_seconds_total": "Time spent waiting for Wit on cache misses.",
+    "session_token_cache_total": "Session token derivations per cache outcome.",
+    "session_cache_total": "In-process session lookups per outcome, and sessions evicted or expired.",
+    "session_cache_size": "Sessions held in process.",
+    "sender_actions_total": "Sender actions sent, and Send API calls saved by coalescing them.",
+    "send_queue_depth": "Sends waiting for the rate limiter.",
+    "send_rate_limit": "Current Send API calls per second allowed per page.",
+    "send_scheduler_total": "Rate limiter grants and drops per priority.",
+    "send_scheduler_wait_seconds_total": "Time spent waiting for the rate limiter per priority.",
+    "batch_total": "Webhook batches and events handled before answering.",
+    "batch_seconds_total": "Wall time and summed per-sender time of those batches.",
+    "notifications_total": "Advisory change notifications per outcome.",
+    "advisory_snapshot_age_seconds": "Seconds since the advisory snapshot was last checked.",
+    "log_records_dropped_total": "Log records not written, because the queue was full or by sampling.",
+    "webhook_dedup_checked_total": "Messaging events checked for redelivery.",
+    "webhook_duplicates_total": "Redelivered events dropped, per tier that recognized them."
+}
+
+
+class Histogram(object):
+    """
+    This class counts observations in cumulative buckets, Prometheus style.
+
+    Args:
+        buckets - Sorted bucket upper bounds.
+
+    Attributes:
+        _counts - The number of observations per bucket (not cumulative),
+            the last one being +Inf.
+        _sum - The sum of every observation.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        This function records one observation.
+
+        :param value: float
+        :return: None
+        """
+        i = bisect_left(self._buckets, value)
+
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """
+        This function returns the cumulative bucket counts.
+
+        :return: ([(upper bound, cumulative count)], count, sum)
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            running += count
+            cumulative.append((bound, running))
+
+        return cumulative, running, total
+
+
+class Counter(object):
+    """
+    This class is a thread-safe, monotonically increasing count.
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        return self._value
+
+
+class Registry(object):
+    """
+    This class holds every series by metric name and label values, and renders
+    them in the Prometheus text format.
+
+    Attributes:
+        _metrics - {name: (type, {label tuple: Histogram or Counter})}
+        _collectors - Callables returning (name, type, labels, value)
+            tuples, read at every render.
+
+    High Level Usage:
+        with registry.timer("wit"):
+            response = client.message(msg=text)
+
+        registry.increment("send_errors_total", endpoint="messages")
+        text = registry.render()
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        """
+        This function returns the histogram of a series, creating it if
+        needed.
+
+        :param name: The metric name, without the prefix
+        :param labels: Label values of the series
+        :return: Histogram
+        """
+        return self._series(name, "histogram", Histogram, labels)
+
+    def counter(self, name, **labels):
+        """
+        This function returns the counter of a series, creating it if needed.
+
+        :param name: The metric name, without the prefix
+        :param labels: Label values of the series
+        :return: Counter
+        """
+        return self._series(name, "counter", Counter, labels)
+
+    def increment(self, name, amount=1, **labels):
+        self.counter(name, **labels).increment(amount)
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        This function times the block it wraps into the stage_seconds
+        histogram of a stage, whether or not the block raises.
+
+        :param stage: The stage name
+        :param labels: Any other label values
+        :return: context manager
+        """
+        histogram = self.histogram("stage_seconds", stage=stage, **labels)
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            histogram.observe(time.time() - start)
+
+    def add_collector(self, collector):
+        """
+        This function adds a callable returning (name, type, labels, value)
+        tuples, for counters kept elsewhere. Collectors run on every
+        render; one that raises is logged and skipped.
+
+        :param collector: callable
+        :return: None
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        This function renders every series in the Prometheus text format.
+
+        :return: str
+        """
+        with self._lock:
+            metrics = [(name, kind, dict(series)) for name, (kind, series) in self._metrics.iteritems()]
+            collectors = list(self._collectors)
+
+        lines = []
+
+        for name, kind, series in sorted(metrics):
+            lines.extend(_header(name, kind))
+
+            for labels, metric in sorted(series.iteritems()):
+                if kind == "counter":
+                    lines.append(_sample(name, labels, metric.value()))
+                    continue
+
+                buckets, count, total = metric.snapshot()
+
+                for bound, cumulative in buckets:
+                    lines.append(_sample(name + "_bucket", labels + (("le", _number(bound)),), cumulative))
+
+                lines.append(_sample(name + "_count", labels, count))
+                lines.append(_sample(name + "_sum", labels, total))
+
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                ###
+                logger.exception("Metrics collector failed: %s", collector)
+                ###
+
+                continue
+
+            # every sample of a metric has to follow its header
+            grouped = OrderedDict()
+
+            for name, kind, labels, value in samples:
+                grouped.setdefault((name, kind), []).append(_sample(name, tuple(sorted(labels.iteritems())), value))
+
+            for (name, kind), group in grouped.iteritems():
+                lines.extend(_header(name, kind))
+                lines.extend(group)
+
+        return "\n".join(lines) + "\n"
+
+    def _series(self, name, kind, factory, labels):
+        key = tuple(sorted(labels.iteritems()))
+        entry = self._metrics.get(name)
+
+        # the common case, without the lock
+        if entry is not None and key in entry[1]:
+            return entry[1][key]
+
+        with self._lock:
+            entry = self._metrics.setdefault(name, (kind, {}))
+
+            return entry[1].setdefault(key, factory())
+
+
+def _header(name, kind):
+    lines = []
+
+    if name in DESCRIPTIONS:
+        lines.append("# HELP {}{} {}".format(PREFIX, name, DESCRIPTIONS[name]))
+
+    lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+
+    return lines
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return "{}{} {}".format(PREFIX, name, _number(value))
+
+    pairs = ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels)
+
+    return "{}{}{{{}}} {}".format(PREFIX, name, pairs, _number(value))
+
+
+def _escape(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(u"\n", u"\\n").replace(u'"', u'\\"').encode("utf-8")
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+timer = registry.timer
+increment = registry.increment
+observe = registry.observe
+add_collector = registry.add_collector
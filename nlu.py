@@ -0,0 +1,176 @@
+from cache import LRUCache
+from debug import logger
+from metrics import timer
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+
+NLU_CACHE_SIZE = int(os.environ.get("NLU_CACHE_SIZE", 5000))
+NLU_CACHE_TTL = int(os.environ.get("NLU_CACHE_TTL", 24 * 60 * 60))
+# bump whenever the Wit app is retrained, so stale entities are never served
+WIT_APP_VERSION = os.environ.get("WIT_APP_VERSION", "1")
+# fields of a Wit response that belong to one call rather than to the text
+REQUEST_FIELDS = ("msg_id", "_text")
+
+_WHITESPACE = re.compile(r"\s+", re.UNICODE)
+
+
+def normalize_message(text):
+    """
+    This function reduces a message to the form used as a cache key:
+    lowercase, whitespace collapsed and trailing punctuation dropped, so that
+    "Travel advisory for Mexico?" and "travel advisory for mexico" share an
+    entry.
+
+    :param text: A message (str or unicode)
+    :return: unicode
+    """
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE.sub(u" ", text).strip()
+
+    return text.rstrip(u"?!.,;: ")
+
+
+class CachedWitClient(object):
+    """
+    This class answers Wit message calls from a cache of normalized message
+    text -> Wit response. It has two tiers: an in-process LRU, and a shared
+    Redis tier with a ttl, so that every worker benefits from a question any
+    one of them has already sent to Wit. Keys include the Wit app version.
+
+    A miss returns the response exactly as Wit gave it. A hit returns the
+    cached entities with `_text` set to the message being answered, and
+    without a `msg_id`, since no Wit call was made for it.
+
+    Args:
+        client - A Wit client.
+        ds - A Redis instance, or None for the in-process tier only.
+        version - The Wit app version (see WIT_APP_VERSION).
+        size - The maximum number of entries in the in-process tier.
+        ttl - Seconds an entry lives in either tier.
+
+    Attributes:
+        _local - An LRUCache of normalized text -> (response, seconds the Wit
+            call took).
+        _stats - Hit/miss counters per tier, the time spent in Wit, and the
+            Wit time saved by hits.
+
+    High Level Usage:
+        wit = CachedWitClient(Wit(access_token=token), redis_store)
+        response = wit.message(msg=text, context={"session_id": token})
+    """
+
+    def __init__(self, client, ds=None, version=WIT_APP_VERSION, size=NLU_CACHE_SIZE, ttl=NLU_CACHE_TTL):
+        self._client = client
+        self._ds = ds
+        self._version = version
+        self._ttl = ttl
+        self._local = LRUCache(size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "wit_time": 0.0, "time_saved": 0.0}
+
+    def message(self, msg, context=None, **kwargs):
+        """
+        This function returns the Wit response for a message, asking Wit only
+        if neither tier has seen the (normalized) message before.
+
+        :param msg: The message text
+        :param context: The Wit context (not part of the cache key)
+        :return: Wit response
+        """
+        text = normalize_message(msg)
+        entry = self._local.get(text)
+
+        if entry is not None:
+            self._count("local_hits", saved=entry[1])
+            return dict(entry[0], _text=msg)
+
+        key = self._key(text)
+        entry = self._shared_get(key)
+
+        if entry is not None:
+            self._local.set(text, entry)
+            self._count("shared_hits", saved=entry[1])
+            return dict(entry[0], _text=msg)
+
+        start = time.time()
+
+        with timer("wit"):
+            response = self._client.message(msg=msg, context=context, **kwargs)
+
+        # each later hit saves as long as this call took
+        cached = dict((field, value) for field, value in response.iteritems() if field not in REQUEST_FIELDS)
+        entry = (cached, time.time() - start)
+        self._count("misses", wit_time=entry[1])
+
+        self._local.set(text, entry)
+        self._shared_set(key, entry)
+
+        return response
+
+    def stats(self):
+        """
+        This function returns the hit/miss counters, the time spent in Wit,
+        and the Wit time saved by cache hits (what each hit's original call
+        took).
+
+        :return: {}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        hits = stats["local_hits"] + stats["shared_hits"]
+        lookups = hits + stats["misses"]
+
+        stats["hit_rate"] = float(hits) / lookups if lookups else 0.0
+        stats["mean_wit_time"] = stats["wit_time"] / stats["misses"] if stats["misses"] else 0.0
+
+        return stats
+
+    def _key(self, text):
+        return "nlu:{}:{}".format(self._version, hashlib.sha1(text.encode("utf-8")).hexdigest())
+
+    def _shared_get(self, key):
+        if self._ds is None:
+            return None
+
+        try:
+            raw = self._ds.get(key)
+        except Exception:
+            ###
+            logger.exception("Could not read the shared NLU cache.")
+            ###
+
+            return None
+
+        if raw is None:
+            return None
+
+        entry = json.loads(raw)
+
+        return entry["response"], entry["wit_time"]
+
+    def _shared_set(self, key, entry):
+        if self._ds is None:
+            return
+
+        try:
+            self._ds.set(key, json.dumps({"response": entry[0], "wit_time": entry[1]}), ex=self._ttl)
+        except Exception:
+            ###
+            logger.exception("Could not write the shared NLU cache.")
+            ###
+
+    def _count(self, counter, wit_time=0.0, saved=0.0):
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats["wit_time"] += wit_time
+            self._stats["time_saved"] += saved
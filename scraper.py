@@ -1,7 +1,20 @@
 from bs4 import BeautifulSoup
-import urllib
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+from debug import logger
+from countries import CountryIndex
+from metrics import timer
+from store import pack_record, unpack_record, read_record, write_record
+from redis.exceptions import RedisError, WatchError
+from bisect import bisect_left
+import urllib2
+import codecs
+import hashlib
+import json
+import os
+import threading
 from datetime import datetime
-from time import mktime, time
+from time import mktime, time, sleep
 
 urls = {
     "general": "https://travel.gc.ca/travelling/advisories",
@@ -18,70 +31,348 @@ advisory_codes = {
     "Exercise normal security precautions": 1,
     "Exercise normal security precautions (with regional advisories)": 1
 }
+ADVISORY_CODE_MAX = max(advisory_codes.itervalues())
 
+# seconds between background refreshes of the advisory snapshot
+ADVISORY_TTL = float(os.environ.get("ADVISORY_TTL", 900))
+# "stream" only materializes the gradeX rows while the page is read, "soup"
+# builds the full BeautifulSoup tree first
+ADVISORY_PARSER = os.environ.get("ADVISORY_PARSER", "stream")
+STREAM_CHUNK_SIZE = 16384
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", 30))
+# the parsed advisory data is kept in this file, so that a newly started
+# worker can answer before its first scrape. Off ("") unless set; it should
+# be in a directory only the app's user can write to.
+ADVISORY_SNAPSHOT_PATH = os.environ.get("ADVISORY_SNAPSHOT_PATH", "")
+# with Redis, one process scrapes every ADVISORY_TTL seconds and shares the
+# snapshot; the others check for a new one every ADVISORY_SHARE_POLL seconds
+ADVISORY_SHARE = os.environ.get("ADVISORY_SHARE", "1") == "1"
+ADVISORY_SHARE_POLL = float(os.environ.get("ADVISORY_SHARE_POLL", 30))
+# after a failed shared scrape, nobody tries again for this many seconds,
+# doubled per consecutive failure up to ADVISORY_TTL
+ADVISORY_RETRY = float(os.environ.get("ADVISORY_RETRY", 60))
 
-def pull_data(url):
+
+def fetch(url, validators=None):
     """
-    Pulls the raw HTML from a given URL, and returns a BeautifulSoup object of the raw data.
+    Opens a URL with a conditional GET. The validators returned from one call
+    should be passed to the next, so that an unchanged page costs a 304 and no
+    body at all.
+
+    :param url: The URL to open
+    :param validators: {"etag": ..., "last_modified": ...} from a previous
+        fetch, or None
+    :return: (response, validators), where response is None if the page has
+        not changed since the validators were issued
     """
-    data = urllib.urlopen(url).read()
+    request = urllib2.Request(url)
 
-    return BeautifulSoup(data, "html.parser")
+    if validators:
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
 
+    try:
+        response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return None, validators
+        raise
 
-def advisory_general(sort=None):
+    headers = response.info()
+
+    return response, {
+        "etag": headers.getheader("ETag"),
+        "last_modified": headers.getheader("Last-Modified")
+    }
+
+
+def scrape_general(previous=None):
     """
-    Pulls the general advisory information for every country listed on the
-    Travel Advice and Advisory page.
+    Scrapes the general advisory information for every country listed on the
+    Travel Advice and Advisory page. This always goes out to the network, so
+    callers should normally use advisory_general, which answers from the
+    in-memory snapshot.
 
-    :param soup: a beautiful soup object representing the raw HTML page
-    :param sort:
-    :return: dictionary containing an overview of the travel advisory for
-        every country on the Canadian Travel Advisory page
+    When a previous snapshot is given, the request is conditional on it, and
+    only the rows whose last updated date changed are rebuilt.
+
+    :param previous: The AdvisorySnapshot currently being served, or None
+    :return: a new AdvisorySnapshot, or previous if the page has not changed
     """
-    soup = pull_data(urls["general"])
-    rows = soup.find_all("tr", class_="gradeX")
+    with timer("advisory_fetch"):
+        response, validators = fetch(urls["general"], previous.validators if previous else None)
+
+    if response is None:
+        ###
+        logger.info("Advisory page not modified.")
+        ###
+
+        return previous
+
+    try:
+        # the stream parser reads the body as it goes, so this includes the download
+        with timer("advisory_parse"):
+            countries = parse_general(response, previous=previous.countries if previous else None)
+    finally:
+        response.close()
+
+    if previous is None:
+        changed = None
+    else:
+        changed = set(key for key, country in countries.iteritems() if previous.countries.get(key) is not country)
+        changed.update(key for key in previous.countries if key not in countries)
+
+        ###
+        logger.info("Advisory page refreshed, %d countries changed.", len(changed))
+        ###
+
+    snapshot = AdvisorySnapshot(countries, validators=validators, changed=changed)
+    # off the request path, unless nothing has been loaded yet
+    snapshot.index.warm()
 
+    return snapshot
+
+
+def parse_general(source, parser=None, previous=None):
+    """
+    Parses the general advisory table out of a file-like object holding the
+    raw HTML page.
+
+    :param source: A file-like object with the raw (utf-8) HTML
+    :param parser: "stream" or "soup", defaults to ADVISORY_PARSER
+    :param previous: Country advisories from an earlier parse. Entries whose
+        row is unchanged are reused as is instead of being rebuilt.
+    :return: dictionary of country advisories keyed by lowercase name
+    """
+    if (parser or ADVISORY_PARSER) == "soup":
+        rows = general_rows_soup(BeautifulSoup(source.read(), "html.parser"))
+    else:
+        rows = general_rows_stream(source)
+
+    previous = previous or {}
     countries = {}
 
     for row in rows:
-        # grab the most important information
-        key_info = row.find_all("td")
-        # get name
-        name = key_info[1].a.get_text()
-
-        countries[name.lower()] = organize_general_advisory(key_info)
-
-    # sorting (note: this converts the dictionary to a list -> dictionaries
-    # cannot be sorted ... duh!)
-    if sort == "name":
-        return sorted(countries.itervalues(), key=(lambda v: v["name"]))
-    if sort == "advisory":
-        return sorted(countries.itervalues(), key=(lambda v: v["advisory_code"]), reverse=True)
-    if sort == "last_updated":
-        return sorted(countries.itervalues(), key=(lambda v: v["last_updated_absolute"]), reverse=True)
+        # row[1] is the country name
+        key = row[1].lower()
+        country = previous.get(key)
+
+        # the date only moves when the row does; checking the text as well is
+        # just as cheap and catches a silent edit
+        if country is None or country["last_updated"] != row[4] or country["advisory"] != row[3] or country["url"] != row[2]:
+            country = general_advisory(*row)
+
+        countries[key] = country
 
     return countries
 
 
-def organize_general_advisory(td):
+def general_rows_soup(soup):
+    """
+    Yields the (slug, name, url, advisory, last_updated) cells of every
+    gradeX row in a BeautifulSoup tree of the general advisory page.
+
+    :param soup: a beautiful soup object representing the raw HTML page
+    :return: generator of tuples
+    """
+    for row in soup.find_all("tr", class_="gradeX"):
+        td = row.find_all("td")
+
+        yield (td[0].get_text(), td[1].a.get_text(), td[1].a["href"], td[2].get_text(), td[-1].get_text())
+
+
+def general_rows_stream(source, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the (slug, name, url, advisory, last_updated) cells of every
+    gradeX row while the page is read in chunks. Nothing outside those rows
+    is kept in memory.
+
+    :param source: A file-like object with the raw (utf-8) HTML
+    :param chunk_size: Number of bytes to read at a time
+    :return: generator of tuples
     """
-    This function takes all of the td elements for a specific country in the
-    general advisory format and return a dictionary with the information
-    organized.
+    parser = GeneralAdvisoryParser()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    while True:
+        chunk = source.read(chunk_size)
+
+        if not chunk:
+            break
+
+        parser.feed(decoder.decode(chunk))
+
+        for row in parser.pop_rows():
+            yield row
+
+    parser.feed(decoder.decode("", final=True))
+    parser.close()
+
+    for row in parser.pop_rows():
+        yield row
+
+
+class GeneralAdvisoryParser(HTMLParser):
+    """
+    This class is an event-based parser for the general advisory table. It
+    tracks just enough state to collect the text of each td in a gradeX row
+    (and the first link of each td), and discards everything else as soon as
+    it is seen.
+
+    Attributes:
+        _rows - Completed rows waiting to be collected through pop_rows.
+        _cells - The cells of the gradeX row being read, or None.
+        _cell - The cell being read as [text, link text, href, in link], or
+            None.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._rows = []
+        self._cells = None
+        self._cell = None
+
+    def pop_rows(self):
+        """
+        This function returns the rows completed so far and forgets them.
+
+        :return: list of tuples
+        """
+        rows, self._rows = self._rows, []
+
+        return rows
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self._end_row()
 
-    :param td: The td elements that were scraped for a particular country
+            for name, value in attrs:
+                if name == "class" and value and "gradeX" in value.split():
+                    self._cells = []
+        elif self._cells is None:
+            return
+        elif tag == "td":
+            self._end_cell()
+            self._cell = [[], [], None, False]
+        elif tag == "a" and self._cell is not None and self._cell[2] is None:
+            self._cell[2] = dict(attrs).get("href", "")
+            self._cell[3] = True
+
+    def handle_endtag(self, tag):
+        if self._cells is None:
+            return
+
+        if tag == "a" and self._cell is not None:
+            self._cell[3] = False
+        elif tag == "td":
+            self._end_cell()
+        elif tag == "tr" or tag == "table":
+            self._end_row()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell[0].append(data)
+
+            if self._cell[3]:
+                self._cell[1].append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u"&{}".format(name))
+
+    def handle_charref(self, name):
+        if name[:1] in ("x", "X"):
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._cells.append(self._cell)
+            self._cell = None
+
+    def _end_row(self):
+        if self._cells is None:
+            return
+
+        self._end_cell()
+        cells, self._cells = self._cells, None
+
+        if len(cells) >= 3:
+            self._rows.append((
+                u"".join(cells[0][0]),
+                u"".join(cells[1][1]),
+                cells[1][2],
+                u"".join(cells[2][0]),
+                u"".join(cells[-1][0])
+            ))
+
+
+def advisory_general(sort=None):
+    """
+    Returns the general advisory information for every country listed on the
+    Travel Advice and Advisory page, from the in-memory snapshot.
+
+    :param sort: "name", "advisory" or "last_updated" for a sorted list
+    :return: dictionary containing an overview of the travel advisory for
+        every country on the Canadian Travel Advisory page
+    """
+    snapshot = advisory_cache.get()
+
+    # the orderings are built once per snapshot (see AdvisoryViews)
+    if sort in AdvisoryViews.orderings:
+        return snapshot.views.sorted(sort)
+
+    return snapshot.countries
+
+
+def advisories_by_code(code):
+    """
+    Returns the advisory summaries of every country with a given advisory
+    code (e.g. 4 for "Avoid all travel"), sorted by name.
+
+    :param code: An advisory code, 1 to ADVISORY_CODE_MAX
+    :return: [{}]
+    """
+    return advisory_cache.get().views.by_code(code)
+
+
+def advisories_changed_since(since):
+    """
+    Returns the advisory summaries of every country updated after a given
+    time, most recently updated first.
+
+    :param since: A time in seconds since Epoch
+    :return: [{}]
+    """
+    return advisory_cache.get().views.changed_since(since)
+
+
+def general_advisory(slug, name, url, advisory, last_updated):
+    """
+    This function builds the advisory dictionary for a single country from
+    the text of its cells in the general advisory table.
+
+    :param slug: The text of the first cell
+    :param name: The country name
+    :param url: The country page link
+    :param advisory: The advisory text
+    :param last_updated: The last updated date string
     :return: {}
     """
     return {
-        "slug": td[0].get_text(),
-        "name": td[1].a.get_text(),
-        "url": td[1].a["href"],
-        "advisory": td[2].get_text(),
-        "advisory_code": advisory_codes[td[2].get_text()],
-        "advisory_code_max": max(advisory_codes.itervalues(), key=lambda v: v),
-        "last_updated": td[-1].get_text(),
-        "last_updated_absolute": date_to_absolute(td[-1].get_text())
+        "slug": slug,
+        "name": name,
+        "url": url,
+        "advisory": advisory,
+        "advisory_code": advisory_codes[advisory],
+        "advisory_code_max": ADVISORY_CODE_MAX,
+        "last_updated": last_updated,
+        "last_updated_absolute": date_to_absolute(last_updated)
     }
 
 
@@ -98,13 +389,674 @@ def date_to_absolute(date):
 
 def advisory_country(country):
     """
-    Pulls a country-specific advisory summary from the Travel Advice and
-    Advisory page.
+    Returns a country-specific advisory summary from the in-memory snapshot
+    of the Travel Advice and Advisory page. The country may be given by name
+    (in any case, with or without accents), slug or common alias.
 
     :param country: a string that represents a country name
     :return: {}
     """
-    return advisory_general()[country.lower()]
+    snapshot = advisory_cache.get()
+    key = snapshot.index.lookup(country)
+
+    if key is None:
+        raise KeyError(country)
+
+    return snapshot.countries[key]
+
+
+def advisory_candidates(country, limit=3):
+    """
+    Returns the country-specific advisory summaries best matching a country
+    name, closest first. Misspelled names are matched within a couple of
+    typos; exact names, slugs and aliases have distance 0.
+
+    :param country: a string that represents a country name
+    :param limit: the maximum number of candidates
+    :return: [({}, distance)]
+    """
+    snapshot = advisory_cache.get()
+
+    return [(snapshot.countries[key], distance) for key, distance in snapshot.index.resolve(country, limit)]
+
+
+def extract_countries(text):
+    """
+    Returns the country-specific advisory summaries of every country named
+    in a message, in order of appearance.
+
+    :param text: a message
+    :return: [{}]
+    """
+    snapshot = advisory_cache.get()
+
+    return [snapshot.countries[key] for key in snapshot.index.extract(text)]
+
+
+def snapshot_version(countries):
+    """
+    This function derives a version string from the content of a set of
+    country advisories, so that two scrapes of an unchanged page always
+    produce the same version. Every field is hashed, since every field is
+    served under the version as an ETag.
+
+    :param countries: A dictionary of country advisories
+    :return: str
+    """
+    digest = hashlib.sha1()
+
+    for key in sorted(countries):
+        digest.update(json.dumps([key, countries[key]], sort_keys=True, separators=(",", ":")))
+        digest.update("\n")
+
+    return digest.hexdigest()
+
+
+class AdvisorySnapshot(object):
+    """
+    This class holds one parsed copy of the general advisory page. Snapshots
+    are never modified once published; a refresh builds a new one and swaps
+    it in, so readers always see a consistent set of countries.
+
+    Args:
+        countries - A dictionary of country advisories keyed by lowercase
+            country name.
+        loaded_at - The time (in seconds since Epoch) the data was scraped.
+        validators - The HTTP validators the page was served with (see
+            fetch).
+        changed - The keys that were added, changed or removed compared to
+            the snapshot this one replaces, or None if everything is new.
+
+    Attributes:
+        version - A content-derived version string (see snapshot_version).
+        index - A CountryIndex resolving free-form names to country keys.
+        views - The AdvisoryViews of the countries.
+    """
+
+    def __init__(self, countries, loaded_at=None, validators=None, changed=None):
+        self.countries = countries
+        self.loaded_at = loaded_at if loaded_at is not None else time()
+        self.validators = validators or {}
+        self.changed = changed
+        self.version = snapshot_version(countries)
+        self.index = CountryIndex(countries)
+        self.views = AdvisoryViews(countries)
+
+
+def snapshot_record(snapshot, checked_at=None):
+    """
+    This function reduces an advisory snapshot to a record of plain values
+    (see store). Only the cell text of each row is kept; everything else is
+    derived again by snapshot_from_record.
+
+    :param snapshot: An AdvisorySnapshot
+    :param checked_at: When the source was last checked
+    :return: {}
+    """
+    return {
+        "version": snapshot.version,
+        "loaded_at": snapshot.loaded_at,
+        "checked_at": checked_at,
+        "validators": snapshot.validators,
+        "rows": [
+            (country["slug"], country["name"], country["url"], country["advisory"], country["last_updated"])
+            for country in snapshot.countries.itervalues()
+        ]
+    }
+
+
+def snapshot_from_record(record, previous=None):
+    """
+    This function rebuilds an advisory snapshot from a record made by
+    snapshot_record. Entries whose row is unchanged since `previous` are
+    reused, as in parse_general.
+
+    :param record: {}
+    :param previous: The AdvisorySnapshot currently being served, or None
+    :return: AdvisorySnapshot
+    """
+    old = previous.countries if previous is not None else {}
+    countries = {}
+
+    for row in record["rows"]:
+        # JSON gives back lists
+        row = tuple(row)
+        # row[1] is the country name
+        key = row[1].lower()
+        country = old.get(key)
+
+        if country is None or (country["slug"], country["name"], country["url"], country["advisory"], country["last_updated"]) != row:
+            country = general_advisory(*row)
+
+        countries[key] = country
+
+    if previous is None:
+        changed = None
+    else:
+        changed = set(key for key, country in countries.iteritems() if old.get(key) is not country)
+        changed.update(key for key in old if key not in countries)
+
+    snapshot = AdvisorySnapshot(countries, loaded_at=record["loaded_at"], validators=record["validators"], changed=changed)
+
+    # e.g. written with different advisory codes
+    if snapshot.version != record["version"]:
+        raise ValueError("Snapshot version mismatch.")
+
+    return snapshot
+
+
+def save_snapshot(snapshot, checked_at=None, path=None):
+    """
+    This function persists an advisory snapshot to a snapshot file.
+
+    :param snapshot: An AdvisorySnapshot
+    :param checked_at: When the source was last checked
+    :param path: The file path, defaults to ADVISORY_SNAPSHOT_PATH
+    :return: the number of bytes written
+    """
+    return write_record(path or ADVISORY_SNAPSHOT_PATH, snapshot_record(snapshot, checked_at))
+
+
+def load_snapshot(path=None):
+    """
+    This function loads an advisory snapshot persisted by save_snapshot.
+
+    :param path: The file path, defaults to ADVISORY_SNAPSHOT_PATH
+    :return: (AdvisorySnapshot, checked_at), or (None, None) if there is no
+        usable file
+    """
+    path = path or ADVISORY_SNAPSHOT_PATH
+
+    try:
+        record = read_record(path)
+
+        if record is None:
+            return None, None
+
+        snapshot = snapshot_from_record(record)
+    except Exception:
+        ###
+        logger.exception("Could not load advisory snapshot file %s.", path)
+        ###
+
+        return None, None
+
+    ###
+    logger.info("Loaded %d countries from snapshot file %s.", len(snapshot.countries), path)
+    ###
+
+    return snapshot, record["checked_at"]
+
+
+class AdvisoryViews(object):
+    """
+    This class holds the orderings and indexes of a set of country advisories
+    that queries need, built once per snapshot. Every query is a slice or a
+    bisection, so it costs O(log n + k) for k results instead of a sort over
+    every country.
+
+    Args:
+        countries - A dictionary of country advisories keyed by lowercase
+            country name.
+
+    Attributes:
+        _sorted - {ordering: [country advisory]} for each of `orderings`.
+        _by_code - {advisory code: [country advisory]} sorted by name.
+        _times - The negated last_updated_absolute of each country in the
+            "last_updated" ordering, ascending, for bisection.
+
+    High Level Usage:
+        views = AdvisoryViews(countries)
+        views.by_code(4)
+        views.changed_since(time() - 24 * 60 * 60)
+    """
+
+    orderings = {
+        "name": (lambda v: v["name"], False),
+        "advisory": (lambda v: v["advisory_code"], True),
+        "last_updated": (lambda v: v["last_updated_absolute"], True)
+    }
+
+    def __init__(self, countries):
+        self._sorted = {}
+        self._by_code = {}
+
+        for ordering, (key, reverse) in self.orderings.iteritems():
+            self._sorted[ordering] = sorted(countries.itervalues(), key=key, reverse=reverse)
+
+        for country in self._sorted["name"]:
+            self._by_code.setdefault(country["advisory_code"], []).append(country)
+
+        self._times = [-country["last_updated_absolute"] for country in self._sorted["last_updated"]]
+
+    def sorted(self, ordering):
+        """
+        This function returns every country in one of the precomputed
+        orderings.
+
+        :param ordering: "name", "advisory" or "last_updated"
+        :return: [{}]
+        """
+        return list(self._sorted[ordering])
+
+    def by_code(self, code):
+        """
+        This function returns the countries with an advisory code, sorted by
+        name.
+
+        :param code: An advisory code
+        :return: [{}]
+        """
+        return list(self._by_code.get(code, ()))
+
+    def changed_since(self, since):
+        """
+        This function returns the countries updated after a time, most
+        recently updated first.
+
+        :param since: A time in seconds since Epoch
+        :return: [{}]
+        """
+        return self._sorted["last_updated"][:bisect_left(self._times, -since)]
+
+
+class AdvisorySnapshotCache(object):
+    """
+    This class keeps the most recent AdvisorySnapshot in memory and refreshes
+    it on a background thread every `ttl` seconds. Refreshes are single-flight:
+    if one thread is already scraping, any other thread asking for a refresh
+    waits for that result instead of starting a second scrape.
+
+    Args:
+        loader - A callable taking the current AdvisorySnapshot (or None) and
+            returning either a new AdvisorySnapshot or the same one if
+            nothing changed (see scrape_general).
+        ttl - Seconds between background refreshes.
+
+    Attributes:
+        _snapshot - The currently published AdvisorySnapshot (or None).
+        _checked_at - When the source was last checked, changed or not.
+        _error - The exception raised by the last scrape, or None if it
+            succeeded.
+        _listeners - Callables run as listener(previous, snapshot) on the
+            refreshing thread whenever a new snapshot is published.
+        _refresh_lock - Held for the duration of a scrape.
+        _refresher_pid - The process the background thread was started in.
+            gunicorn forks workers, and threads do not survive a fork, so the
+            thread is (re)started lazily in whichever process reads first.
+
+    High Level Usage:
+        cache = AdvisorySnapshotCache(scrape_general)
+        countries = cache.get().countries
+    """
+
+    def __init__(self, loader, ttl=ADVISORY_TTL):
+        self._loader = loader
+        self._ttl = ttl
+        self._snapshot = None
+        self._checked_at = None
+        self._error = None
+        self._listeners = []
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._refresher_pid = None
+
+    def get(self):
+        """
+        This function returns the current snapshot, scraping synchronously only
+        if nothing has been loaded yet.
+
+        :return: AdvisorySnapshot
+        """
+        self._ensure_refresher()
+
+        snapshot = self._snapshot
+
+        if snapshot is None:
+            snapshot = self.refresh()
+
+        return snapshot
+
+    def refresh(self):
+        """
+        This function scrapes the page and publishes a new snapshot. If a
+        scrape is already in flight, it waits for that one to finish and
+        returns its result instead, or the previous snapshot if that scrape
+        failed.
+
+        :return: AdvisorySnapshot
+        :raises Exception: whatever the scrape raised, if there is no
+            previous snapshot to return
+        """
+        if self._refresh_lock.acquire(False):
+            try:
+                previous = self._snapshot
+
+                try:
+                    self._snapshot = self._loader(previous)
+                except Exception as e:
+                    self._error = e
+                    raise
+
+                self._error = None
+                self._checked_at = time()
+            finally:
+                self._refresh_lock.release()
+
+            if self._snapshot is not previous:
+                self._notify(previous, self._snapshot)
+        else:
+            # someone else is scraping, wait for them
+            with self._refresh_lock:
+                error = self._error
+
+            # on a cold start there is nothing to fall back on
+            if self._snapshot is None and error is not None:
+                raise error
+
+        return self._snapshot
+
+    def seed(self, snapshot, checked_at=None):
+        """
+        This function publishes a snapshot obtained some other way than the
+        loader (e.g. load_snapshot), without notifying listeners. The
+        background refresh is scheduled `ttl` seconds after checked_at.
+
+        :param snapshot: An AdvisorySnapshot, or None to do nothing
+        :param checked_at: When the snapshot's source was last checked
+        :return: None
+        """
+        if snapshot is None:
+            return
+
+        self._snapshot = snapshot
+        self._checked_at = checked_at if checked_at is not None else snapshot.loaded_at
+
+    def use_loader(self, loader, ttl):
+        """
+        This function replaces the loader and the refresh interval, e.g. to
+        switch to a SharedSnapshotLoader once a Redis connection exists. It
+        must be called before the first get.
+
+        :param loader: A loader callable (see Args)
+        :param ttl: Seconds between background refreshes
+        :return: None
+        """
+        self._loader = loader
+        self._ttl = ttl
+
+    def add_listener(self, listener):
+        """
+        This function registers a callable to be run as
+        listener(previous, snapshot) each time a new snapshot is published.
+        previous is None for the first snapshot.
+
+        :param listener: A callable
+        :return: None
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, previous, snapshot):
+        for listener in self._listeners:
+            try:
+                listener(previous, snapshot)
+            except Exception:
+                ###
+                logger.exception("Advisory snapshot listener failed.")
+                ###
+
+    def _ensure_refresher(self):
+        if self._refresher_pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._refresher_pid == os.getpid():
+                return
+
+            thread = threading.Thread(target=self._run, name="advisory-refresher")
+            thread.daemon = True
+            thread.start()
+
+            self._refresher_pid = os.getpid()
+
+    def _run(self):
+        if self._snapshot is not None:
+            # a seeded snapshot is published before its fuzzy index is built
+            self._snapshot.index.warm()
+
+        # a seeded snapshot may already be due for a refresh
+        delay = self._ttl if self._checked_at is None else max(0, self._checked_at + self._ttl - time())
+
+        while True:
+            sleep(delay)
+            delay = self._ttl
+
+            try:
+                self.refresh()
+            except Exception:
+                ###
+                logger.exception("Advisory refresh failed, serving the previous snapshot.")
+                ###
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def checked_at(self):
+        return self._checked_at
+
+
+class SharedSnapshotLoader(object):
+    """
+    This class is an AdvisorySnapshotCache loader that shares one snapshot
+    between every process using the same Redis. The snapshot is kept in Redis
+    as a blob (in the store format) next to its version and the time the
+    source was last checked. Whenever that check is older than `ttl`, the
+    process holding the refresh lock scrapes and publishes; every other
+    process only reads, and only reads the blob when the version key differs
+    from the copy it already has. So the upstream site sees one fetch per
+    `ttl` no matter how many workers and dynos run.
+
+    A failed scrape sets a backoff key, so that processes with a snapshot to
+    serve wait `retry` seconds (doubled per consecutive failure) before the
+    next attempt rather than trying again at every poll.
+
+    If Redis cannot be reached, the process scrapes on its own. A scrape that
+    succeeded but could not be published is served all the same.
+
+    Args:
+        ds - A Redis instance.
+        scrape - The loader doing the actual work (see scrape_general).
+        ttl - Seconds between scrapes across all processes.
+        name - The key prefix.
+        lock_ttl - Seconds the refresh lock is held at most.
+        retry - Seconds to wait after the first failed scrape.
+
+    Attributes:
+        _owner - The value identifying this process in the lock.
+
+    High Level Usage:
+        advisory_cache.use_loader(SharedSnapshotLoader(redis_store, scrape_general), ADVISORY_SHARE_POLL)
+    """
+
+    def __init__(self, ds, scrape, ttl=ADVISORY_TTL, name="advisories", lock_ttl=FETCH_TIMEOUT * 2, retry=ADVISORY_RETRY):
+        self._ds = ds
+        self._scrape = scrape
+        self._ttl = ttl
+        self._name = name
+        self._lock_ttl = lock_ttl
+        self._retry = retry
+        self._owner = "{}:{}".format(os.getpid(), id(self))
+
+    def __call__(self, previous):
+        """
+        This function returns the shared snapshot, refreshing it first if it
+        is due and no other process is already doing so.
+
+        :param previous: The AdvisorySnapshot this process is serving, or
+            None
+        :return: AdvisorySnapshot (previous if nothing changed)
+        """
+        try:
+            version, checked_at, backoff = self._ds.mget(self._key("version"), self._key("checked_at"), self._key("backoff"))
+            snapshot = previous
+
+            if version is not None and (previous is None or version != previous.version):
+                snapshot = self._read(previous)
+
+            if snapshot is not None and checked_at is not None and time() - float(checked_at) < self._ttl:
+                return snapshot
+
+            # the last scrape failed; keep serving what we have for now
+            if snapshot is not None and backoff is not None:
+                return snapshot
+
+            if self._acquire():
+                try:
+                    return self._refresh(snapshot)
+                finally:
+                    self._release()
+
+            if snapshot is None:
+                # nothing to serve yet, so wait for whoever is scraping
+                snapshot = self._wait()
+        except RedisError:
+            ###
+            logger.exception("Shared advisory snapshot unavailable, scraping locally.")
+            ###
+
+            return self._scrape(previous)
+
+        return snapshot if snapshot is not None else self._scrape(previous)
+
+    def _refresh(self, snapshot):
+        try:
+            refreshed = self._scrape(snapshot)
+        except Exception:
+            self._back_off()
+            raise
+
+        try:
+            with self._ds.pipeline() as pipe:
+                if refreshed is not snapshot:
+                    pipe.set(self._key("snapshot"), pack_record(snapshot_record(refreshed)))
+                    pipe.set(self._key("version"), refreshed.version)
+
+                pipe.set(self._key("checked_at"), repr(time()))
+                pipe.delete(self._key("failures"), self._key("backoff"))
+                pipe.execute()
+        except RedisError:
+            # the scrape is good; the others will get the next one
+            ###
+            logger.exception("Could not publish the shared advisory snapshot.")
+            ###
+
+        return refreshed
+
+    def _back_off(self):
+        try:
+            failures = self._ds.incr(self._key("failures"))
+            delay = min(self._ttl, self._retry * 2 ** (failures - 1))
+            self._ds.set(self._key("backoff"), failures, px=int(delay * 1000))
+        except RedisError:
+            ###
+            logger.exception("Could not record the failed advisory scrape.")
+            ###
+
+            return
+
+        ###
+        logger.warning("Advisory scrape failed %d times in a row, next attempt in %.0fs.", failures, delay)
+        ###
+
+    def _read(self, previous):
+        data = self._ds.get(self._key("snapshot"))
+        record = unpack_record(data, "shared advisory snapshot") if data is not None else None
+
+        if record is None:
+            return previous
+
+        try:
+            snapshot = snapshot_from_record(record, previous)
+        except Exception:
+            ###
+            logger.exception("Could not load the shared advisory snapshot.")
+            ###
+
+            return previous
+
+        snapshot.index.warm()
+
+        ###
+        logger.info("Loaded shared advisory snapshot %s.", snapshot.version)
+        ###
+
+        return snapshot
+
+    def _wait(self):
+        deadline = time() + self._lock_ttl
+
+        while time() < deadline:
+            sleep(0.25)
+
+            if self._ds.exists(self._key("version")):
+                return self._read(None)
+
+        return None
+
+    def _acquire(self):
+        return bool(self._ds.set(self._key("lock"), self._owner, px=int(self._lock_ttl * 1000), nx=True))
+
+    def _release(self):
+        lock = self._key("lock")
+
+        try:
+            with self._ds.pipeline() as pipe:
+                pipe.watch(lock)
+
+                # it may have expired and been taken over
+                if pipe.get(lock) != self._owner:
+                    return
+
+                pipe.multi()
+                pipe.delete(lock)
+                pipe.execute()
+        except WatchError:
+            pass
+        except RedisError:
+            # it expires on its own
+            ###
+            logger.exception("Could not release the advisory refresh lock.")
+            ###
+
+    def _key(self, kind):
+        return "{}:{}".format(self._name, kind)
+
+
+advisory_cache = AdvisorySnapshotCache(scrape_general)
+
+
+def share_advisories(ds):
+    """
+    This function makes advisory_cache share its snapshot with every other
+    process using the same Redis (see SharedSnapshotLoader), unless
+    ADVISORY_SHARE is off.
+
+    :param ds: A Redis instance
+    :return: None
+    """
+    if ADVISORY_SHARE:
+        advisory_cache.use_loader(SharedSnapshotLoader(ds, scrape_general), ADVISORY_SHARE_POLL)
+
+
+def _persist(previous, snapshot):
+    save_snapshot(snapshot, advisory_cache.checked_at)
+
+
+if ADVISORY_SNAPSHOT_PATH:
+    advisory_cache.seed(*load_snapshot())
+    advisory_cache.add_listener(_persist)
 
 
 def main():
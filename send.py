@@ -1,12 +1,58 @@
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from cache import LRUCache
+from debug import logger
+from metrics import increment, observe
 import requests
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import threading
+import time
 
 
 IMAGE_ENDPOINT = "https://canadiantravelassistant.herokuapp.com/{}"
-FB_API_ENDPOINT = "https://graph.facebook.com/v{}/me/{}?access_token={}"
+# overridable so that load tests can point at a local stand-in
+FB_API_ENDPOINT = os.environ.get("FB_API_ENDPOINT", "https://graph.facebook.com/v{}/me/{}?access_token={}")
 FB_API_VERSION = os.environ["FB_API_VERSION"]
 FB_ACCESS_TOKEN = os.environ["FB_ACCESS_TOKEN"]
 
+# keep-alive connections held open to the Graph API
+SEND_POOL_SIZE = int(os.environ.get("SEND_POOL_SIZE", 10))
+SEND_CONNECT_TIMEOUT = float(os.environ.get("SEND_CONNECT_TIMEOUT", 3.05))
+SEND_READ_TIMEOUT = float(os.environ.get("SEND_READ_TIMEOUT", 10))
+# retries on connection errors and 5xx responses, with exponential backoff
+# (throttling is left to the SendScheduler)
+SEND_RETRIES = int(os.environ.get("SEND_RETRIES", 3))
+SEND_BACKOFF = float(os.environ.get("SEND_BACKOFF", 0.25))
+# calls per second per page token, and how many may go out at once after a
+# quiet spell
+SEND_RATE = float(os.environ.get("SEND_RATE", 100))
+SEND_BURST = float(os.environ.get("SEND_BURST", 50))
+# throttling halves the rate, down to this floor, and pauses sends for the
+# Retry-After time or this many seconds
+SEND_MIN_RATE = float(os.environ.get("SEND_MIN_RATE", 1))
+SEND_THROTTLE_PAUSE = float(os.environ.get("SEND_THROTTLE_PAUSE", 1))
+SEND_THROTTLE_RETRIES = int(os.environ.get("SEND_THROTTLE_RETRIES", 2))
+# a bulk send still waiting for its turn after this many seconds is dropped
+SEND_BULK_MAX_WAIT = float(os.environ.get("SEND_BULK_MAX_WAIT", 60))
+# so is a reply, much sooner, so that a long throttling pause fails the
+# webhook instead of holding every webhook thread
+SEND_INTERACTIVE_MAX_WAIT = float(os.environ.get("SEND_INTERACTIVE_MAX_WAIT", 5))
+
+# replies to users go ahead of notifications and other background sends
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Graph API error codes meaning the page is being rate limited
+THROTTLE_CODES = frozenset([4, 17, 32, 613])
+# typing_on is held back this long, and dropped if the reply is sent first
+SEND_TYPING_DELAY = float(os.environ.get("SEND_TYPING_DELAY", 0.3))
+# a repeated sender action within this many seconds is dropped
+SEND_ACTION_WINDOW = float(os.environ.get("SEND_ACTION_WINDOW", 15))
+
 
 def send_message(recipient, message):
     """
@@ -30,33 +76,39 @@ def send_message(recipient, message):
 
 def send_typing(recipient):
     """
-    This function sends a "typing on" indicator to the Facebook Send API.
+    This function sends a "typing on" indicator to the Facebook Send API,
+    through the sender action dispatcher.
 
     :param recipient: Facebook ID
-    :return: response
+    :return: response, or None if the indicator was deferred or dropped
     """
-    data = {
-        "recipient": {
-            "id": recipient
-        },
-        "sender_action": "typing_on"
-    }
-
-    return send("messages", data)
+    return sender_actions.typing_on(recipient)
 
 
 def send_mark_seen(recipient):
     """
-    This function sends a "seen" indicator to the Facebook Send API.
+    This function sends a "seen" indicator to the Facebook Send API, through
+    the sender action dispatcher.
 
     :param recipient: Facebook ID
+    :return: response, or None if the indicator was dropped
+    """
+    return sender_actions.mark_seen(recipient)
+
+
+def send_sender_action(recipient, action):
+    """
+    This function sends a sender action to the Facebook Send API right away.
+
+    :param recipient: Facebook ID
+    :param action: "typing_on", "typing_off" or "mark_seen"
     :return: response
     """
     data = {
         "recipient": {
             "id": recipient
         },
-        "sender_action": "mark_seen"
+        "sender_action": action
     }
 
     return send("messages", data)
@@ -76,34 +128,84 @@ def send_attachment(recipient, message, submessage, image, link):
         "recipient": {
             "id": recipient
         },
-        "message": {
-            "attachment": {
-                "type": "template",
-                "payload": {
-                    "template_type": "generic",
-                    "elements": [
-                        {
-                            "title": message,
-                            "subtitle": submessage,
-                            "image_url": IMAGE_ENDPOINT.format(image),
-                            "buttons": [
-                                {
-                                    "type": "web_url",
-                                    "url": link,
-                                    "title": "Read More"
-                                },
-                                {
-                                    "type": "element_share"
-                                }
-                            ]
-                        }
-                    ]
-                }
+        "message": attachment_message(message, submessage, image, link)
+    }
+
+    return send("messages", data)
+
+
+def attachment_message(message, submessage, image, link, postbacks=()):
+    """
+    This function builds the message object of an attachment.
+
+    :param message: A message string
+    :param submessage: A submessage string
+    :param image: An image URL
+    :param link: The "Read More" URL
+    :param postbacks: (title, payload) of each extra postback button (the
+        template allows one more)
+    :return: {}
+    """
+    buttons = [
+        {
+            "type": "web_url",
+            "url": link,
+            "title": "Read More"
+        },
+        {
+            "type": "element_share"
+        }
+    ]
+
+    for title, payload in postbacks:
+        buttons.append({
+            "type": "postback",
+            "title": title,
+            "payload": payload
+        })
+
+    return {
+        "attachment": {
+            "type": "template",
+            "payload": {
+                "template_type": "generic",
+                "elements": [
+                    {
+                        "title": message,
+                        "subtitle": submessage,
+                        "image_url": IMAGE_ENDPOINT.format(image),
+                        "buttons": buttons
+                    }
+                ]
             }
         }
     }
 
-    return send("messages", data)
+
+def serialize_message(message):
+    """
+    This function serializes a message object once, so that it can be sent to
+    any number of recipients with send_serialized.
+
+    :param message: A message object (see attachment_message)
+    :return: JSON str
+    """
+    return json.dumps(message, separators=(",", ":"))
+
+
+def send_serialized(recipient, message, priority=PRIORITY_INTERACTIVE):
+    """
+    This function sends a message serialized by serialize_message to the
+    Facebook Send API. Only the recipient is added to it.
+
+    :param recipient: Facebook ID
+    :param message: JSON str
+    :param priority: PRIORITY_INTERACTIVE or PRIORITY_BULK
+    :return: response
+    """
+    body = '{"recipient":{"id":%s},"message":%s}' % (json.dumps(recipient), message)
+
+    return post("messages", body, recipient, priority)
 
 
 def define_greeting(message):
@@ -139,6 +241,486 @@ def define_call_to_action(message):
     return send("thread_settings", data)
 
 
+def create_http_session():
+    """
+    This function creates the HTTP session used for every Facebook API call.
+    Its connection pool keeps connections to the Graph API alive between
+    calls, and failed calls are retried with backoff. Read timeouts are not
+    retried, since the message may already have been delivered.
+
+    :return: requests.Session
+    """
+    retry = Retry(
+        total=SEND_RETRIES,
+        read=0,
+        backoff_factor=SEND_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        method_whitelist=frozenset(["POST"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SEND_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+http = create_http_session()
+
+
+class SenderActionDispatcher(object):
+    """
+    This class collapses redundant sender actions per recipient. Messenger
+    shows typing_on until the next message (or about 20 seconds), so:
+
+    + typing_on is held back for `typing_delay` seconds and dropped if a
+      reply goes out first, which is the common case when the answer is
+      already cached;
+    + typing_on is dropped while one is already pending or showing;
+    + mark_seen is dropped if it was sent less than `window` seconds ago.
+
+    Held back indicators are sent by a single scheduler thread, started in
+    whichever process first defers one. A reply waits for a typing_on that
+    is already on its way, so the indicator never arrives after the message
+    and stays on.
+
+    Args:
+        typing_delay - Seconds to hold back typing_on (0 sends it at once).
+        window - Seconds during which a repeated action is dropped (0 turns
+            coalescing off).
+        maxsize - The maximum number of recipients tracked.
+
+    Attributes:
+        _recipients - An LRUCache of recipient -> {"typing_at", "seen_at",
+            "pending", "lock"}. "pending" is the token of the typing_on
+            held back, and "lock" is held while an action is being sent.
+        _pending - A heap of (due time, token, recipient) of the held back
+            typing_on, cancelled ones included.
+        _stats - Counters of actions sent and Send API calls saved.
+    """
+
+    def __init__(self, typing_delay=SEND_TYPING_DELAY, window=SEND_ACTION_WINDOW, maxsize=10000):
+        self._typing_delay = typing_delay
+        self._window = window
+        self._recipients = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = []
+        self._tokens = itertools.count(1)
+        self._pid = None
+        self._stats = {"sent": 0, "saved_typing_on": 0, "saved_mark_seen": 0}
+
+    def typing_on(self, recipient):
+        """
+        This function shows the typing indicator to a recipient, unless it is
+        already showing or about to be.
+
+        :param recipient: Facebook ID
+        :return: response, or None if the indicator was deferred or dropped
+        """
+        if self._typing_delay > 0:
+            self._ensure_started()
+
+        with self._lock:
+            state = self._state(recipient)
+
+            if state["pending"] is not None or self._recent(state["typing_at"]):
+                self._stats["saved_typing_on"] += 1
+                return None
+
+            if self._typing_delay > 0:
+                state["pending"] = next(self._tokens)
+                heapq.heappush(self._pending, (time.time() + self._typing_delay, state["pending"], recipient))
+                self._wakeup.notify()
+                return None
+
+            state["typing_at"] = time.time()
+            self._stats["sent"] += 1
+
+        with state["lock"]:
+            return self._send(recipient, "typing_on")
+
+    def mark_seen(self, recipient):
+        """
+        This function marks the last message of a recipient as seen, unless
+        that was just done.
+
+        :param recipient: Facebook ID
+        :return: response, or None if the action was dropped
+        """
+        with self._lock:
+            state = self._state(recipient)
+
+            if self._recent(state["seen_at"]):
+                self._stats["saved_mark_seen"] += 1
+                return None
+
+            state["seen_at"] = time.time()
+            self._stats["sent"] += 1
+
+        return self._send(recipient, "mark_seen")
+
+    def replied(self, recipient):
+        """
+        This function records that a message is being sent to a recipient. A
+        pending typing_on is cancelled, and the next one will be sent, since
+        Messenger hides the indicator when the message arrives.
+
+        :param recipient: Facebook ID
+        :return: None
+        """
+        with self._lock:
+            state = self._recipients.get(recipient)
+
+            if state is None:
+                return
+
+            if state["pending"] is not None:
+                state["pending"] = None
+                self._stats["saved_typing_on"] += 1
+
+            state["typing_at"] = None
+
+        # let a typing_on already being sent reach Messenger first
+        with state["lock"]:
+            pass
+
+    def stats(self):
+        """
+        This function returns the counters of actions sent and Send API calls
+        saved.
+
+        :return: {}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats["saved"] = stats["saved_typing_on"] + stats["saved_mark_seen"]
+
+        return stats
+
+    @staticmethod
+    def _send(recipient, action):
+        try:
+            return send_sender_action(recipient, action)
+        except SendDropped:
+            # an indicator that has to wait that long is not worth failing
+            # the message over
+            ###
+            logger.info("Dropped %s for: %s", action, recipient, extra={"sender": recipient})
+            ###
+
+            return None
+
+    def _deferred_typing_on(self, recipient, token):
+        with self._lock:
+            state = self._recipients.get(recipient)
+
+            # cancelled by a reply, or forgotten, in the meantime
+            if state is None or state["pending"] != token:
+                return
+
+        with state["lock"]:
+            # checked again, now that no reply can start in between
+            with self._lock:
+                if state["pending"] != token:
+                    return
+
+                state["pending"] = None
+                state["typing_at"] = time.time()
+                self._stats["sent"] += 1
+
+            try:
+                self._send(recipient, "typing_on")
+            except Exception:
+                ###
+                logger.exception("Could not send typing indicator to: %s", recipient, extra={"sender": recipient})
+                ###
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # whatever a parent process had pending is not ours to send
+            self._pending = []
+
+            thread = threading.Thread(target=self._run, name="sender-actions")
+            thread.daemon = True
+            thread.start()
+
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending or self._pending[0][0] > time.time():
+                    self._wakeup.wait(self._pending[0][0] - time.time() if self._pending else None)
+
+                _, token, recipient = heapq.heappop(self._pending)
+
+            self._deferred_typing_on(recipient, token)
+
+    def _state(self, recipient):
+        state = self._recipients.get(recipient)
+
+        if state is None:
+            state = {"typing_at": None, "seen_at": None, "pending": None, "lock": threading.Lock()}
+            self._recipients.set(recipient, state)
+
+        return state
+
+    def _recent(self, at):
+        return at is not None and time.time() - at < self._window
+
+
+sender_actions = SenderActionDispatcher()
+
+
+class SendDropped(Exception):
+    """
+    This exception is raised when a send waited longer than allowed for its
+    turn, and was dropped.
+    """
+
+
+class SendScheduler(object):
+    """
+    This class paces the calls made with one page token. Calls take a token
+    from a token bucket refilled at `rate` per second; a call finding the
+    bucket empty waits in a priority queue, so interactive replies go ahead
+    of any bulk sends already waiting.
+
+    The rate adapts to the Graph API: a throttling response halves it (down
+    to `min_rate`) and pauses every send for the Retry-After time, and each
+    successful call wins a little of it back, up to `rate`.
+
+    Args:
+        rate - Calls per second.
+        burst - The bucket size: how many calls may go out at once after a
+            quiet spell.
+        min_rate - The lowest rate throttling can bring it down to.
+
+    Attributes:
+        _tokens - Tokens in the bucket as of _updated_at.
+        _waiting - A heap of [priority, sequence, cancelled] entries, one per
+            waiting call, so equal priorities are served in arrival order.
+        _paused_until - No call is let through before this time.
+        _stats - Grants, wait time and drops per priority, and the number of
+            throttling responses.
+
+    High Level Usage:
+        limiter = SendScheduler(100)
+        limiter.acquire(PRIORITY_BULK, timeout=60)
+        response = http.post(...)
+        limiter.throttled(retry_after) if throttled(response) else limiter.succeeded()
+    """
+
+    names = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, min_rate=SEND_MIN_RATE):
+        self._max_rate = rate
+        self._rate = rate
+        self._min_rate = min(min_rate, rate)
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.time()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._depth = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stats = dict((name, {"granted": 0, "wait_time": 0.0, "max_wait": 0.0, "dropped": 0}) for name in self.names.itervalues())
+        self._stats["throttled"] = 0
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        This function blocks until the caller may make a call.
+
+        :param priority: PRIORITY_INTERACTIVE or PRIORITY_BULK
+        :param timeout: Seconds to wait at most, or None to wait for as long
+            as it takes
+        :return: seconds waited
+        :raises SendDropped: if the timeout ran out first, or a throttling
+            pause would outlast it
+        """
+        start = time.time()
+        deadline = start + timeout if timeout is not None else None
+        entry = [priority, next(self._sequence), False]
+        stats = self._stats[self.names[priority]]
+
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            self._depth += 1
+
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+
+                    if self._waiting[0] is entry and now >= self._paused_until and self._tokens >= 1:
+                        break
+
+                    # no point waiting for a pause that outlasts the deadline
+                    if deadline is not None and (now >= deadline or self._paused_until > deadline):
+                        entry[2] = True
+                        stats["dropped"] += 1
+
+                        if now < deadline:
+                            raise SendDropped("Sends are paused for another {:.1f}s.".format(self._paused_until - now))
+
+                        raise SendDropped("Waited {:.1f}s for a send slot.".format(now - start))
+
+                    if self._waiting[0] is entry:
+                        # until the pause ends or the next token comes in
+                        delay = max(self._paused_until - now, (1 - self._tokens) / self._rate)
+                    else:
+                        # until whoever is ahead goes
+                        delay = None
+
+                    if deadline is not None:
+                        delay = deadline - now if delay is None else min(delay, deadline - now)
+
+                    self._condition.wait(delay)
+
+                heapq.heappop(self._waiting)
+                self._tokens -= 1
+            finally:
+                self._depth -= 1
+
+                # drop the entries of callers that gave up
+                while self._waiting and self._waiting[0][2]:
+                    heapq.heappop(self._waiting)
+
+                self._condition.notify_all()
+
+            waited = time.time() - start
+            stats["granted"] += 1
+            stats["wait_time"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+
+        return waited
+
+    def throttled(self, retry_after=None):
+        """
+        This function records a throttling response: the rate is halved, and
+        nothing is sent until the pause is over.
+
+        :param retry_after: Seconds the Graph API asked to wait, if it did
+        :return: None
+        """
+        with self._condition:
+            self._rate = max(self._min_rate, self._rate / 2)
+            self._paused_until = max(self._paused_until, time.time() + (retry_after or SEND_THROTTLE_PAUSE))
+            self._tokens = 0.0
+            self._stats["throttled"] += 1
+            rate = self._rate
+
+        ###
+        logger.warning("Graph API throttling, sending at %.1f/s.", rate)
+        ###
+
+    def succeeded(self):
+        """
+        This function records a successful call, winning back some of the
+        rate lost to throttling.
+
+        :return: None
+        """
+        if self._rate >= self._max_rate:
+            return
+
+        with self._condition:
+            self._rate = min(self._max_rate, self._rate + self._max_rate / 100)
+
+    def stats(self):
+        """
+        This function returns the queue depth, the current rate, and grants,
+        wait time and drops per priority.
+
+        :return: {}
+        """
+        with self._condition:
+            stats = dict((key, dict(value) if isinstance(value, dict) else value) for key, value in self._stats.iteritems())
+            stats["depth"] = self._depth
+            stats["rate"] = self._rate
+
+        for name in self.names.itervalues():
+            granted = stats[name]["granted"]
+            stats[name]["mean_wait"] = stats[name]["wait_time"] / granted if granted else 0.0
+
+        return stats
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler(token):
+    """
+    This function returns the SendScheduler of a page token; rate limits
+    apply per page.
+
+    :param token: Page application token string from Facebook
+    :return: SendScheduler
+    """
+    with _schedulers_lock:
+        if token not in _schedulers:
+            _schedulers[token] = SendScheduler()
+
+        return _schedulers[token]
+
+
+def scheduler_stats():
+    """
+    This function returns the stats of every page's SendScheduler, keyed by
+    a digest of the page token.
+
+    :return: {}
+    """
+    with _schedulers_lock:
+        schedulers = _schedulers.items()
+
+    return dict((hashlib.sha1(token).hexdigest()[:8], limiter.stats()) for token, limiter in schedulers)
+
+
+def throttled(response):
+    """
+    This function tells whether a Graph API response means the page is being
+    rate limited.
+
+    :param response: response
+    :return: bool
+    """
+    if response.status_code == 429:
+        return True
+
+    if response.status_code < 400:
+        return False
+
+    try:
+        return response.json().get("error", {}).get("code") in THROTTLE_CODES
+    except ValueError:
+        return False
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
 def send(platform, data):
     """
     This function makes a Facebook API POST call.
@@ -147,10 +729,52 @@ def send(platform, data):
     :param data: A JSON object
     :return: response
     """
+    return post(platform, json.dumps(data), data["recipient"]["id"] if "message" in data else None)
+
+
+def post(platform, body, recipient=None, priority=PRIORITY_INTERACTIVE):
+    """
+    This function POSTs an already serialized JSON body to a Facebook
+    endpoint, when the page's SendScheduler lets it. Calls that get
+    throttled are tried again after the pause.
+
+    :param platform: The desired Facebook endpoint
+    :param body: JSON str
+    :param recipient: The Facebook ID a message is sent to, if body is one
+    :param priority: PRIORITY_INTERACTIVE or PRIORITY_BULK
+    :return: response
+    :raises SendDropped: if the send would wait longer than
+        SEND_INTERACTIVE_MAX_WAIT or SEND_BULK_MAX_WAIT for its turn
+    """
     u = endpoint(platform, FB_ACCESS_TOKEN)
-    h = {"Content-Type": "application/json"}
+    limiter = scheduler(FB_ACCESS_TOKEN)
+
+    if recipient is not None:
+        sender_actions.replied(recipient)
+
+    for attempt in range(SEND_THROTTLE_RETRIES + 1):
+        limiter.acquire(priority, SEND_BULK_MAX_WAIT if priority == PRIORITY_BULK else SEND_INTERACTIVE_MAX_WAIT)
+        start = time.time()
+
+        try:
+            response = http.post(u, data=body, timeout=(SEND_CONNECT_TIMEOUT, SEND_READ_TIMEOUT))
+        except requests.RequestException:
+            observe("send_seconds", time.time() - start, endpoint=platform)
+            increment("send_errors_total", endpoint=platform, status="connection")
+            raise
+
+        observe("send_seconds", time.time() - start, endpoint=platform)
+
+        if response.status_code >= 400:
+            increment("send_errors_total", endpoint=platform, status=response.status_code)
+
+        if not throttled(response):
+            limiter.succeeded()
+            break
+
+        limiter.throttled(retry_after(response))
 
-    return requests.post(u, json=data, headers=h)
+    return response
 
 
 def endpoint(target, token):
@@ -1,8 +1,19 @@
+from cache import LRUCache
 import time
 import hashlib
+import hmac
+import os
 import redis
 
 
+# tokens are derived with HMAC under this key when it is set, so they cannot
+# be computed from the (public) page-scoped user ID. Changing it orphans
+# every existing session.
+SESSION_TOKEN_KEY = os.environ.get("SESSION_TOKEN_KEY")
+SESSION_TOKEN_HASH = os.environ.get("SESSION_TOKEN_HASH", "sha224")
+SESSION_TOKEN_CACHE_SIZE = int(os.environ.get("SESSION_TOKEN_CACHE_SIZE", 10000))
+
+
 class FacebookBotRedisSessionManager(object):
     """
     This class is used to manage the Facebook Bot user sessions on a Redis
@@ -10,25 +21,32 @@ class FacebookBotRedisSessionManager(object):
     Redis interactions.
 
     Args:
-        url - A URL string representing the location of the active Redis
-            instance.
+        ds - A Redis instance.
+        token_key - A secret key. When given, session tokens are derived with
+            HMAC instead of the unkeyed triple hash.
+        token_hash - The name of the hashlib algorithm used to derive tokens.
+        token_cache_size - The number of derived tokens kept in memory.
 
     Attributes:
-        _hash_algorithm - The class-wide hashing algorithm used to hash the
-            user-bot IDs into session tokens.
+        _hash_algorithm - The hashing algorithm used to hash the user-bot IDs
+            into session tokens.
         _ds - A Redis instance, to be used for all redis instance
             accessed through the python interface. It should be accessed
             through the ds property.
+        _tokens - An LRUCache of user-bot ID -> session token, so each token
+            is derived once per sender rather than on every lookup.
 
     High Level Usage:
         manager = RedisSessionManager(redis_datastore)
         session = manager.create_session(fb_id)
     """
 
-    _hash_algorithm = hashlib.sha224
-
-    def __init__(self, ds):
+    def __init__(self, ds, token_key=SESSION_TOKEN_KEY, token_hash=SESSION_TOKEN_HASH,
+                 token_cache_size=SESSION_TOKEN_CACHE_SIZE):
         self._ds = ds
+        self._token_key = token_key
+        self._hash_algorithm = getattr(hashlib, token_hash)
+        self._tokens = LRUCache(token_cache_size)
 
     def create_session(self, id_, **kwargs):
         """
@@ -42,16 +60,14 @@ class FacebookBotRedisSessionManager(object):
             used to create the unique session.
         :return: session object
         """
-        token = self._generate_session_token(id_)
+        token = self.get_session_token(id_)
+        now = time.time()
         # set redis hash - required
-        self.ds.hset(token, "id", id_)
-        self.ds.hset(token, "c_at", time.time())
-        self.ds.hset(token, "u_at", time.time())
+        fields = {"id": id_, "c_at": now, "u_at": now}
         # optional
-        for key, value in kwargs.iteritems():
-            self.ds.hset(token, key, value)
+        fields.update(kwargs)
 
-        return self.ds.hgetall(token)
+        return self._write_and_read(token, fields)
 
     def update_session(self, id_, **kwargs):
         """
@@ -61,16 +77,30 @@ class FacebookBotRedisSessionManager(object):
         :param id_: A string representing the unique user-bot relationship, to
             used to create the unique session.
         :param kwargs: A dictionary representing the fields to modify.
-        :return: 1/0 (success/error)
+        :return: session object
         """
         token = self.get_session_token(id_)
         # update redis hash values
-        for key, value in kwargs.iteritems():
-            self.ds.hset(token, key, value)
+        fields = dict(kwargs)
         # updated now
-        self.ds.hset(token, "u_at", time.time())
+        fields["u_at"] = time.time()
+
+        return self._write_and_read(token, fields)
 
-        return self.ds.hgetall(token)
+    def _write_and_read(self, token, fields):
+        """
+        This function writes a set of fields to a session hash and reads the
+        whole hash back in one MULTI/EXEC round trip.
+
+        :param token: A string representing the session token for the session.
+        :param fields: A dictionary of the fields to write.
+        :return: session object
+        """
+        pipe = self.ds.pipeline(transaction=True)
+        pipe.hmset(token, fields)
+        pipe.hgetall(token)
+
+        return pipe.execute()[-1]
 
     def delete_session(self, id_):
         """
@@ -98,38 +128,73 @@ class FacebookBotRedisSessionManager(object):
         :param token: A string representing the session token for the session.
         :return: session object
         """
-        if self.ds.exists(token):
-            return self.ds.hgetall(token)
-        return None
+        # a missing hash reads back as empty, so no separate EXISTS is needed
+        return self.ds.hgetall(token) or None
+
+    def get_sessions(self, tokens):
+        """
+        This function is used to return the session objects for several
+        session tokens at once, in a single pipelined round trip.
+
+        :param tokens: A list of session token strings.
+        :return: list of session objects (None where no session exists), in
+            the same order as tokens
+        """
+        if not tokens:
+            return []
+
+        pipe = self.ds.pipeline(transaction=False)
+
+        for token in tokens:
+            pipe.hgetall(token)
+
+        return [session or None for session in pipe.execute()]
 
     def get_session_token(self, id_):
         """
         This function is used to retrieve the session token associated with a
-        particular user. This is done by simply implementing the session token
-        generating method. This merely calls _generate_session_token, but it
-        allows for some separation at a higher level.
+        particular user. Tokens are derived by _generate_session_token the
+        first time a user is seen and answered from memory afterwards.
 
         :param id_: A string representing the unique user-bot relationship, to
             used to create the unique session.
         :return: token
         """
-        return self._generate_session_token(id_)
+        token = self._tokens.get(id_)
+
+        if token is None:
+            token = self._generate_session_token(id_)
+            self._tokens.set(id_, token)
+
+        return token
 
     def _generate_session_token(self, id_):
         """
-        This function is used to generate a session token in redis by hashing
-        the id_ using the SHA224 algorithm 3 times recursively.
+        This function is used to generate a session token in redis. With a
+        token key, this is an HMAC of the id_; without one, the id_ is hashed
+        3 times recursively.
 
         :param id_: A string representing the unique user-bot relationship, to
             used to create the unique session.
         :return: token
         """
+        if self._token_key:
+            return hmac.new(self._token_key, id_, self._hash_algorithm).hexdigest()
+
         a = self._hash_algorithm(id_).hexdigest()
         b = self._hash_algorithm(a).hexdigest()
         c = self._hash_algorithm(b).hexdigest()
 
         return c
 
+    def token_cache_stats(self):
+        """
+        This function returns the hit/miss counters of the token cache.
+
+        :return: {}
+        """
+        return self._tokens.stats()
+
     @property
     def ds(self):
         return self._ds
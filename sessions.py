@@ -1,37 +1,266 @@
+from cache import LRUCache
+from session import FacebookBotRedisSessionManager
+import os
 import time
 
 
-sessions = {}
+# sessions idle for this many seconds are dropped
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", 7 * 24 * 60 * 60))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 100000))
+# seconds a session is kept in the in-process tier in front of Redis (0 turns
+# the tier off)
+SESSION_L1_TTL = float(os.environ.get("SESSION_L1_TTL", 0))
+SESSION_L1_MAX = int(os.environ.get("SESSION_L1_MAX", 10000))
 
 
-def find_or_create_session(id_):
+def _encode(value):
     """
-    This function returns the client session with Wit context included if one
-    exists, or it returns a newly created session
+    This function converts a field value the way the Redis client does, so
+    that sessions read back identically from either backend.
 
-    :param id_: A Facebook ID
+    :param value: A field value
     :return: str
     """
-    new_session = False
-    session_id = ""
-
-    # search the global sessions for the given Facebook ID
-    for key in sessions.iterkeys():
-        if sessions[key]["id"] == id_:
-            session_id += key
-
-    # if no session exists, let's create one
-    if session_id is "":
-        new_session = True
-        # the session is created by taking th current epoch time in seconds,
-        # and concatenating the given Facebook ID
-        session_id += str(int(time.time())) + id_
-        sessions[session_id] = {
-            "id": id_,
-            "context": {}
-        }
-
-    return session_id, new_session
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class FacebookBotMemorySessionManager(FacebookBotRedisSessionManager):
+    """
+    This class manages the Facebook Bot user sessions in process memory,
+    behind the same interface as FacebookBotRedisSessionManager. It can stand
+    in for Redis when none is configured, or serve as the local tier of a
+    FacebookBotTieredSessionManager.
+
+    Sessions are indexed by token, and tokens are memoized per user-bot ID,
+    so every lookup is O(1). Sessions idle for longer than `ttl` expire, and
+    once `maxsize` sessions are held the least recently used one is evicted.
+
+    As the local tier of a FacebookBotTieredSessionManager, pass
+    sliding=False: a session then expires `ttl` seconds after it was stored,
+    however often it is read, so updates made by other processes are picked
+    up.
+
+    Args:
+        ttl - Seconds a session may go unused before it expires.
+        maxsize - The maximum number of sessions held.
+        sliding - Whether reading a session restarts its ttl.
+
+    Attributes:
+        _sessions - An LRUCache of session token -> session object.
+
+    High Level Usage:
+        manager = FacebookBotMemorySessionManager()
+        session = manager.create_session(fb_id)
+    """
+
+    def __init__(self, ttl=SESSION_IDLE_TTL, maxsize=SESSION_MAX, sliding=True, **kwargs):
+        super(FacebookBotMemorySessionManager, self).__init__(None, **kwargs)
+        self._sessions = LRUCache(maxsize, ttl=ttl, refresh_on_get=sliding)
+
+    def create_session(self, id_, **kwargs):
+        """
+        This function is used to create a new session for a particular user.
+
+        :param id_: A string representing the unique user-bot relationship, to
+            used to create the unique session.
+        :return: session object
+        """
+        now = time.time()
+        fields = {"id": id_, "c_at": now, "u_at": now}
+        fields.update(kwargs)
+
+        return self.put_session(self.get_session_token(id_), fields, replace=True)
+
+    def update_session(self, id_, **kwargs):
+        """
+        This function is used to update field in a session object given a
+        particular user-bot ID.
+
+        :param id_: A string representing the unique user-bot relationship, to
+            used to create the unique session.
+        :param kwargs: A dictionary representing the fields to modify.
+        :return: session object
+        """
+        fields = dict(kwargs)
+        fields["u_at"] = time.time()
+
+        return self.put_session(self.get_session_token(id_), fields)
+
+    def put_session(self, token, fields, replace=False):
+        """
+        This function is used to write fields into the session stored under a
+        token, creating it if needed.
+
+        :param token: A string representing the session token for the session.
+        :param fields: A dictionary of the fields to write.
+        :param replace: Drop any fields already stored
+        :return: session object
+        """
+        session = {} if replace else self._sessions.get(token) or {}
+        session = dict(session)
+
+        for key, value in fields.iteritems():
+            session[key] = _encode(value)
+
+        self._sessions.set(token, session)
+
+        return dict(session)
+
+    def delete_session(self, id_):
+        """
+        This function is used to delete a particular session given a user-bot
+        ID.
+
+        :param id_: A string representing the unique user-bot relationship, to
+            used to create the unique session.
+        :return: 1/0 (success/error)
+        """
+        return 0 if self._sessions.pop(self.get_session_token(id_)) is None else 1
+
+    def get_session(self, token):
+        """
+        This function is used to return a session object given a particular
+        session token.
+
+        :param token: A string representing the session token for the session.
+        :return: session object
+        """
+        session = self._sessions.get(token)
+
+        return dict(session) if session is not None else None
+
+    def get_sessions(self, tokens):
+        """
+        This function is used to return the session objects for several
+        session tokens at once.
+
+        :param tokens: A list of session token strings.
+        :return: list of session objects (None where no session exists), in
+            the same order as tokens
+        """
+        return [self.get_session(token) for token in tokens]
+
+    def forget_session(self, token):
+        """
+        This function is used to drop a session from memory by token.
+
+        :param token: A string representing the session token for the session.
+        :return: None
+        """
+        self._sessions.pop(token)
+
+    def session_cache_stats(self):
+        """
+        This function returns the hit/miss/eviction counters of the store.
+
+        :return: {}
+        """
+        return self._sessions.stats()
+
+
+class FacebookBotTieredSessionManager(object):
+    """
+    This class puts a FacebookBotMemorySessionManager in front of a
+    FacebookBotRedisSessionManager. Reads are answered from memory when
+    possible, writes go to Redis first and then to memory. The local tier
+    should have a short, fixed ttl (sliding=False), since other processes may update the same
+    session in Redis.
+
+    Args:
+        local - A FacebookBotMemorySessionManager.
+        remote - A FacebookBotRedisSessionManager.
+
+    High Level Usage:
+        manager = FacebookBotTieredSessionManager(
+            FacebookBotMemorySessionManager(ttl=60, sliding=False), FacebookBotRedisSessionManager(redis_store))
+    """
+
+    def __init__(self, local, remote):
+        self._local = local
+        self._remote = remote
+
+    def create_session(self, id_, **kwargs):
+        session = self._remote.create_session(id_, **kwargs)
+        self._local.put_session(self.get_session_token(id_), session, replace=True)
+
+        return session
+
+    def update_session(self, id_, **kwargs):
+        session = self._remote.update_session(id_, **kwargs)
+        self._local.put_session(self.get_session_token(id_), session, replace=True)
+
+        return session
+
+    def delete_session(self, id_):
+        self._local.delete_session(id_)
+
+        return self._remote.delete_session(id_)
+
+    def get_session(self, token):
+        session = self._local.get_session(token)
+
+        if session is None:
+            session = self._remote.get_session(token)
+
+            if session is not None:
+                self._local.put_session(token, session, replace=True)
+
+        return session
+
+    def get_sessions(self, tokens):
+        sessions = self._local.get_sessions(tokens)
+        missing = [i for i, session in enumerate(sessions) if session is None]
+
+        if missing:
+            # one pipelined round trip for everything the local tier lacked
+            for i, session in zip(missing, self._remote.get_sessions([tokens[i] for i in missing])):
+                if session is not None:
+                    self._local.put_session(tokens[i], session, replace=True)
+                    sessions[i] = session
+
+        return sessions
+
+    def get_session_token(self, id_):
+        return self._remote.get_session_token(id_)
+
+    def token_cache_stats(self):
+        return self._remote.token_cache_stats()
+
+    def session_cache_stats(self):
+        return self._local.session_cache_stats()
+
+    @property
+    def ds(self):
+        return self._remote.ds
+
+
+def create_session_manager(ds):
+    """
+    This function returns the session manager to use for a Redis instance:
+    the in-memory manager if there is no Redis, the tiered manager if
+    SESSION_L1_TTL is set, and the Redis manager otherwise.
+
+    :param ds: A Redis instance, or None
+    :return: session manager
+    """
+    if ds is None:
+        return FacebookBotMemorySessionManager()
+
+    remote = FacebookBotRedisSessionManager(ds)
+
+    if SESSION_L1_TTL > 0:
+        # a fixed ttl, so a session read all the time is still refreshed from Redis
+        local = FacebookBotMemorySessionManager(ttl=SESSION_L1_TTL, maxsize=SESSION_L1_MAX, sliding=False)
+
+        return FacebookBotTieredSessionManager(local, remote)
+
+    return remote
 
 
 def main():
@@ -0,0 +1,320 @@
+"""
+Local HTTP stand-ins for the services the bot talks to, so that scrapers,
+load tests and benchmarks can run without touching travel.gc.ca or Facebook.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+import json
+import os
+import threading
+import time
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StandIn(object):
+    """
+    This class runs a request handler class on 127.0.0.1 from a background
+    thread.
+    """
+
+    name = "stand-in"
+
+    def _listen(self, handler, port):
+        self._server = _ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever, name=self.name)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def url(self, path=""):
+        return "http://127.0.0.1:{}{}".format(self._server.server_port, path)
+
+
+class FixtureServer(_StandIn):
+    """
+    This class serves fixture pages over HTTP on 127.0.0.1, from a background
+    thread. Pages are looked up by request path; anything else is a 404.
+
+    Args:
+        pages - A dictionary mapping request paths (e.g. "/destinations/mexico")
+            to the raw bytes to serve.
+        port - The port to listen on (0 picks a free one).
+        delay - Seconds to wait before answering, to stand in for a slow
+            upstream.
+
+    Attributes:
+        requests - The paths requested so far, in order.
+
+    High Level Usage:
+        server = FixtureServer({"/destinations/mexico": html}).start()
+        urllib2.urlopen(server.url("/destinations/mexico"))
+        server.stop()
+    """
+
+    name = "fixture-server"
+
+    def __init__(self, pages, port=0, delay=0):
+        self.pages = pages
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+        fixtures = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                with fixtures._lock:
+                    fixtures.requests.append(self.path)
+
+                time.sleep(fixtures.delay)
+
+                body = fixtures.pages.get(self.path.split("?", 1)[0])
+
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._listen(Handler, port)
+
+    @classmethod
+    def from_directory(cls, path, prefix="/"):
+        """
+        This function builds a FixtureServer serving every file in a
+        directory, at prefix + file name (without the extension).
+
+        :param path: A directory of saved pages
+        :param prefix: The request path prefix for every page
+        :return: FixtureServer
+        """
+        pages = {}
+
+        for name in os.listdir(path):
+            with open(os.path.join(path, name), "rb") as f:
+                pages[prefix + os.path.splitext(name)[0]] = f.read()
+
+        return cls(pages)
+
+
+class SendAPIServer(_StandIn):
+    """
+    This class stands in for the Facebook Graph API on 127.0.0.1, from a
+    background thread. Every POST is recorded and answered like the Send API
+    answers a successful call, after `latency` seconds.
+
+    Args:
+        latency - Seconds to wait before answering.
+        respond - A callable taking (path, body) and returning (status,
+            JSON-serializable payload) to answer with instead, or None to
+            answer normally. Used to simulate errors and rate limits.
+        port - The port to listen on (0 picks a free one).
+
+    Attributes:
+        received - (path, body) of every POST so far, in order.
+
+    High Level Usage:
+        server = SendAPIServer(latency=0.05).start()
+        os.environ["FB_API_ENDPOINT"] = server.endpoint()
+    """
+
+    name = "send-api"
+
+    def __init__(self, latency=0, respond=None, port=0):
+        self.latency = latency
+        self.respond = respond
+        self.received = []
+        self._lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # keep-alive, like the Graph API; the response goes out in several
+            # small writes, which Nagle would hold back for a delayed ACK
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))) or "{}")
+
+                with api._lock:
+                    api.received.append((self.path.split("?", 1)[0], body))
+                    count = len(api.received)
+
+                time.sleep(api.latency)
+
+                answer = api.respond(self.path, body) if api.respond is not None else None
+
+                if answer is None:
+                    recipient = body.get("recipient", {}).get("id")
+                    answer = (200, {"recipient_id": recipient, "message_id": "mid.{}".format(count)})
+
+                data = json.dumps(answer[1])
+
+                self.send_response(answer[0])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._listen(Handler, port)
+
+    def endpoint(self):
+        """
+        This function returns the endpoint template to use as
+        FB_API_ENDPOINT.
+
+        :return: str
+        """
+        return self.url("/v{}/me/{}?access_token={}")
+
+
+class WitServer(_StandIn):
+    """
+    This class stands in for the Wit message endpoint (set WIT_URL to its
+    url()). It answers like a Wit app with a single "country" entity: the
+    country is whatever follows the last " for " in the message, so
+    "travel advisory for Mexcio?" gives "Mexcio", and a message without one
+    has no entities.
+
+    Args:
+        latency - Seconds to wait before answering.
+        port - The port to listen on (0 picks a free one).
+
+    Attributes:
+        received - The messages asked about so far, in order.
+
+    High Level Usage:
+        server = WitServer(latency=0.2).start()
+        os.environ["WIT_URL"] = server.url()
+    """
+
+    name = "wit"
+
+    def __init__(self, latency=0, port=0):
+        self.latency = latency
+        self.received = []
+        self._lock = threading.Lock()
+
+        wit = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                message = query.get("q", [""])[0].decode("utf-8")
+
+                with wit._lock:
+                    wit.received.append(message)
+
+                time.sleep(wit.latency)
+
+                entities = {}
+
+                if u" for " in message:
+                    value = message.rsplit(u" for ", 1)[1].strip(u" ?!.")
+                    entities["country"] = [{"confidence": 0.9, "type": "value", "value": value}]
+
+                data = json.dumps({"msg_id": str(len(wit.received)), "_text": message, "entities": entities})
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._listen(Handler, port)
+
+
+def synthetic_advisories_page(count=230):
+    """
+    This function renders a page shaped like the general advisory page, for
+    when no saved copy of the real page is at hand.
+
+    :param count: Number of country rows
+    :return: str (utf-8)
+    """
+    from scraper import advisory_codes
+
+    advisories = sorted(advisory_codes)
+    filler = u"<p class=\"filler\">{}</p>\n".format(u"Lorem ipsum dolor sit amet. " * 20)
+    rows = []
+
+    for i in range(count):
+        name = u"Country {} C\u00f4te".format(i)
+        rows.append(
+            u"<tr class=\"gradeX\"><td>C{0:03d}</td>"
+            u"<td><a href=\"/destinations/country-{0}\">{1}</a></td>"
+            u"<td>{2}</td><td>2017-{3:02d}-{4:02d} 10:{5:02d}:00</td></tr>\n".format(
+                i, name, advisories[i % len(advisories)], i % 12 + 1, i % 28 + 1, i % 60)
+        )
+
+    page = (
+        u"<!DOCTYPE html><html><head><title>Travel Advice and Advisories</title>"
+        u"<script>var menu = {\"a\": \"<td>\"};</script></head><body>\n"
+        + filler * 150
+        + u"<table id=\"reportlist\"><thead><tr><th>Code</th><th>Country</th><th>Advisory</th>"
+        u"<th>Last updated</th></tr></thead><tbody>\n"
+        + u"".join(rows)
+        + u"</tbody></table>\n"
+        + filler * 150
+        + u"</body></html>"
+    )
+
+    return page.encode("utf-8")
+
+
+def synthetic_destination_page(name, regions=3):
+    """
+    This function renders a page shaped like a country destination page,
+    with the sections destinations.sections looks for.
+
+    :param name: The country name
+    :param regions: Number of regional advisories
+    :return: str (utf-8)
+    """
+    regional = u"".join(
+        u"<h3>Region {0} - Avoid non-essential travel</h3><p>Details for region {0} of {1}.</p>".format(i, name)
+        for i in range(regions)
+    )
+
+    page = (
+        u"<!DOCTYPE html><html><head><title>{0}</title></head><body>"
+        u"<div id=\"advisories\">{1}</div>"
+        u"<div id=\"entry-exit\"><p>Canadians need a passport to enter {0}.</p></div>"
+        u"<div id=\"health\"><p>Get vaccinated before travelling to {0}.</p></div>"
+        u"</body></html>".format(name, regional)
+    )
+
+    return page.encode("utf-8")
@@ -0,0 +1,135 @@
+"""
+A compact, versioned binary format for the parsed advisory data, so that a
+freshly started worker can answer from disk (or from a copy another process
+shared in Redis) instead of scraping first.
+
+    header  magic (4 bytes), format version (uint16), payload length
+            (uint32), payload crc32 (uint32), all big-endian
+    payload zlib-compressed JSON of a record of plain values
+
+The checksum only catches truncation and corruption; it does not make the
+data trustworthy. The payload is JSON so that decoding it never runs code,
+and files not owned by this process's user are ignored. Files are replaced
+atomically, so a reader never sees a partial write.
+"""
+
+from debug import logger
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+
+MAGIC = "TASN"
+# 1 was marshal
+FORMAT_VERSION = 2
+
+_HEADER = struct.Struct(">4sHII")
+
+
+def pack_record(record):
+    """
+    This function encodes a record in the snapshot format.
+
+    :param record: A dictionary of JSON-serializable values
+    :return: str
+    """
+    payload = zlib.compress(json.dumps(record, separators=(",", ":")), 6)
+
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def unpack_record(data, source="snapshot"):
+    """
+    This function decodes a record encoded by pack_record. Truncated, corrupt
+    or differently versioned data is treated as absent.
+
+    :param data: str
+    :param source: Where the data came from, for the log
+    :return: the record, or None
+    """
+    if len(data) < _HEADER.size:
+        return None
+
+    magic, version, length, checksum = _HEADER.unpack_from(data)
+    payload = data[_HEADER.size:]
+
+    if magic != MAGIC or version != FORMAT_VERSION:
+        ###
+        logger.warning("Ignoring %s: format %r %s.", source, magic, version)
+        ###
+
+        return None
+
+    if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+        ###
+        logger.warning("Ignoring corrupt %s.", source)
+        ###
+
+        return None
+
+    try:
+        return json.loads(zlib.decompress(payload))
+    except ValueError:
+        ###
+        logger.warning("Ignoring undecodable %s.", source)
+        ###
+
+        return None
+
+
+def write_record(path, record):
+    """
+    This function writes a record to a snapshot file, replacing any previous
+    one atomically: the data goes to a temporary file in the same directory,
+    which is then renamed over the old one.
+
+    :param path: The snapshot file path
+    :param record: A dictionary of JSON-serializable values
+    :return: the number of bytes written
+    """
+    data = pack_record(record)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp, path)
+    except Exception:
+        os.remove(temp)
+        raise
+
+    return len(data)
+
+
+def read_record(path):
+    """
+    This function reads a record back from a snapshot file, in a single read.
+    A file owned by another user (say, planted in a shared directory) is
+    ignored.
+
+    :param path: The snapshot file path
+    :return: the record, or None if the file is missing or unusable
+    """
+    try:
+        with open(path, "rb") as f:
+            owner = os.fstat(f.fileno()).st_uid
+
+            if owner != os.getuid():
+                ###
+                logger.warning("Ignoring snapshot file %s: owned by uid %d.", path, owner)
+                ###
+
+                return None
+
+            data = f.read()
+    except IOError:
+        return None
+
+    return unpack_record(data, "snapshot file {}".format(path))
@@ -0,0 +1,273 @@
+from debug import logger
+from send import SendDropped
+from workers import WorkerPool
+import os
+import threading
+import time
+
+
+# threads sending notifications, apart from the threads answering webhooks
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 8))
+# subscribers read from Redis (and sent by one thread) at a time
+NOTIFY_BATCH = int(os.environ.get("NOTIFY_BATCH", 500))
+
+# postback payload prefixes, followed by the country key
+SUBSCRIBE = "SUBSCRIBE:"
+UNSUBSCRIBE = "UNSUBSCRIBE:"
+
+
+def changed_advisories(previous, snapshot):
+    """
+    This function returns the countries whose advisory level or last updated
+    date differ between two snapshots. Countries that appeared or disappeared
+    are left out, since nobody can be subscribed to a change there.
+
+    :param previous: The AdvisorySnapshot that was replaced, or None
+    :param snapshot: The new AdvisorySnapshot
+    :return: sorted list of country keys
+    """
+    if previous is None:
+        return []
+
+    keys = snapshot.changed if snapshot.changed is not None else snapshot.countries.keys()
+    changed = []
+
+    for key in keys:
+        old = previous.countries.get(key)
+        new = snapshot.countries.get(key)
+
+        if old is None or new is None:
+            continue
+
+        if old["advisory_code"] != new["advisory_code"] or old["last_updated_absolute"] != new["last_updated_absolute"]:
+            changed.append(key)
+
+    return sorted(changed)
+
+
+class SubscriptionStore(object):
+    """
+    This class keeps who is subscribed to which country, as one Redis set of
+    Facebook IDs per country.
+
+    Args:
+        ds - A Redis instance.
+        name - The key prefix.
+
+    High Level Usage:
+        subscriptions = SubscriptionStore(redis_store)
+        subscriptions.subscribe("mexico", fb_id)
+        for recipients in subscriptions.batches("mexico", 500):
+            ...
+    """
+
+    def __init__(self, ds, name="subs"):
+        self._ds = ds
+        self._name = name
+
+    def subscribe(self, key, recipient):
+        """
+        This function subscribes a user to a country.
+
+        :param key: The country key
+        :param recipient: Facebook ID
+        :return: True if the user was not subscribed yet
+        """
+        return self._ds.sadd(self._key(key), recipient) == 1
+
+    def unsubscribe(self, key, recipient):
+        """
+        This function unsubscribes a user from a country.
+
+        :param key: The country key
+        :param recipient: Facebook ID
+        :return: True if the user was subscribed
+        """
+        return self._ds.srem(self._key(key), recipient) == 1
+
+    def unsubscribe_all(self, keys, recipient):
+        """
+        This function unsubscribes a user from every country given, in one
+        round trip.
+
+        :param keys: The country keys
+        :param recipient: Facebook ID
+        :return: list of the keys the user was subscribed to
+        """
+        keys = list(keys)
+        pipe = self._ds.pipeline(transaction=False)
+
+        for key in keys:
+            pipe.srem(self._key(key), recipient)
+
+        return [key for key, removed in zip(keys, pipe.execute()) if removed]
+
+    def count(self, key):
+        """
+        This function returns the number of subscribers to a country.
+
+        :param key: The country key
+        :return: int
+        """
+        return self._ds.scard(self._key(key))
+
+    def batches(self, key, size=NOTIFY_BATCH):
+        """
+        This function walks the subscribers of a country with SSCAN, so that
+        no single call has to return tens of thousands of them. SSCAN may
+        return a member twice; each is yielded once.
+
+        :param key: The country key
+        :param size: The number of members to ask for per call
+        :return: generator of lists of Facebook IDs
+        """
+        seen = set()
+        cursor = 0
+
+        while True:
+            cursor, members = self._ds.sscan(self._key(key), cursor, count=size)
+            members = [member for member in members if member not in seen]
+            seen.update(members)
+
+            if members:
+                yield members
+
+            if cursor == 0:
+                break
+
+    def claim(self, version, previous, ttl=24 * 60 * 60):
+        """
+        This function claims the notifications for a change from one
+        snapshot version to another, so that only one of the processes
+        seeing that change sends them. Processes that come from different
+        versions see different changes, and claim them separately.
+
+        :param version: The new snapshot version
+        :param previous: The snapshot version it replaced
+        :param ttl: Seconds the claim is kept
+        :return: True if this call made the claim
+        """
+        return bool(self._ds.set(self._key("notified:{}:{}".format(previous, version)), os.getpid(), ex=ttl, nx=True))
+
+    def _key(self, key):
+        return u"{}:{}".format(self._name, key)
+
+
+class AdvisoryNotifier(object):
+    """
+    This class tells subscribers when their country's advisory changes. It is
+    registered as an advisory snapshot listener. For every changed country,
+    the subscribers are read in batches and each batch is sent by a bounded
+    pool of its own, so a fan-out to tens of thousands of users never
+    occupies the threads answering webhooks. The pool's queue is bounded
+    too, so reading subscribers waits for sending to catch up.
+
+    Each notification is serialized once per country; only the recipient is
+    added per send.
+
+    Args:
+        store - A SubscriptionStore.
+        render - A callable returning the serialized notification for a
+            country advisory.
+        send - A callable taking (recipient, serialized message) and
+            returning the response.
+        workers - The number of sending threads.
+        batch - The number of subscribers per batch.
+
+    Attributes:
+        _scanner - A single thread reading subscribers, one country at a
+            time.
+        _pool - The sending threads.
+        _stats - Counters of notifications sent and failed.
+
+    High Level Usage:
+        notifier = AdvisoryNotifier(subscriptions, render, send_serialized)
+        advisory_cache.add_listener(notifier.notify)
+    """
+
+    def __init__(self, store, render, send, workers=NOTIFY_WORKERS, batch=NOTIFY_BATCH):
+        self._store = store
+        self._render = render
+        self._send = send
+        self._batch = batch
+        self._scanner = WorkerPool(1, "notify-scan")
+        self._pool = WorkerPool(workers, "notify", maxsize=workers * 2)
+        self._lock = threading.Lock()
+        self._stats = {"changes": 0, "sent": 0, "failed": 0, "dropped": 0, "time": 0.0}
+
+    def notify(self, previous, snapshot):
+        """
+        This function starts notifying the subscribers of every country that
+        changed between two snapshots, unless another process already has.
+
+        :param previous: The AdvisorySnapshot that was replaced, or None
+        :param snapshot: The new AdvisorySnapshot
+        :return: list of Tasks, one per changed country
+        """
+        changed = changed_advisories(previous, snapshot)
+
+        if not changed or not self._store.claim(snapshot.version, previous.version):
+            return []
+
+        return [self._scanner.submit(self._fan_out, key, snapshot.countries[key]) for key in changed]
+
+    def stats(self):
+        """
+        This function returns the notification counters.
+
+        :return: {}
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _fan_out(self, key, advisory):
+        start = time.time()
+        message = self._render(advisory)
+        tasks = [self._pool.submit(self._send_batch, recipients, message) for recipients in self._store.batches(key, self._batch)]
+        sent = failed = dropped = 0
+
+        for task in tasks:
+            batch_sent, batch_failed, batch_dropped = task.result()
+            sent += batch_sent
+            failed += batch_failed
+            dropped += batch_dropped
+
+        elapsed = time.time() - start
+
+        with self._lock:
+            self._stats["changes"] += 1
+            self._stats["sent"] += sent
+            self._stats["failed"] += failed
+            self._stats["dropped"] += dropped
+            self._stats["time"] += elapsed
+
+        ###
+        logger.info(u"Notified %d subscribers of %s (%d failed, %d dropped) in %.1fs.", sent, advisory["name"], failed, dropped, elapsed)
+        ###
+
+        return sent, failed + dropped
+
+    def _send_batch(self, recipients, message):
+        sent = failed = dropped = 0
+
+        for recipient in recipients:
+            try:
+                response = self._send(recipient, message)
+            except SendDropped:
+                # the page is busy or throttled; counted, not logged one by one
+                dropped += 1
+                continue
+            except Exception:
+                ###
+                logger.exception("Could not notify: %s", recipient, extra={"sender": recipient})
+                ###
+
+                failed += 1
+                continue
+
+            if response.status_code < 400:
+                sent += 1
+            else:
+                failed += 1
+
+        return sent, failed, dropped
@@ -0,0 +1,451 @@
+from debug import logger
+from Queue import Queue
+from redis.exceptions import WatchError
+from time import sleep
+import hashlib
+import json
+import os
+import threading
+
+
+class Task(object):
+    """
+    This class is a handle on a unit of work submitted to a WorkerPool. It can
+    be waited on for the result, or ignored.
+
+    Attributes:
+        _done - Set once the work has run (successfully or not).
+        _result - The return value of the work.
+        _error - The exception raised by the work, if any.
+    """
+
+    def __init__(self, fn, args, kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        """
+        This function runs the work and records its outcome.
+
+        :return: None
+        """
+        try:
+            self._result = self._fn(*self._args, **self._kwargs)
+        except Exception as e:
+            self._error = e
+
+            ###
+            logger.exception("Task %s failed.", getattr(self._fn, "__name__", self._fn))
+            ###
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        This function blocks until the work has run.
+
+        :param timeout: Seconds to wait, or None to wait forever
+        :return: True if the work has run
+        """
+        self._done.wait(timeout)
+
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        This function waits for the work and returns its result, re-raising
+        any exception it raised.
+
+        :param timeout: Seconds to wait, or None to wait forever
+        :return: the return value of the work
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("Task did not finish in time.")
+
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+
+class WorkerPool(object):
+    """
+    This class is a fixed-size pool of daemon threads draining a shared
+    queue. The queue can be bounded, in which case submit blocks once it is
+    full, so a burst of work cannot grow memory without limit.
+
+    Args:
+        size - The number of worker threads.
+        name - A name prefix for the worker threads.
+        maxsize - The maximum number of queued tasks (0 for unbounded).
+
+    Attributes:
+        _pid - The process the threads were started in. Threads do not
+            survive a fork, so they are started lazily on first submit in
+            whichever process that happens.
+
+    High Level Usage:
+        pool = WorkerPool(8, "fetch")
+        task = pool.submit(fetch, url)
+        body = task.result()
+    """
+
+    def __init__(self, size, name="worker", maxsize=0):
+        self._size = size
+        self._name = name
+        self._queue = Queue(maxsize)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        This function queues fn(*args, **kwargs) to run on a worker thread.
+
+        :param fn: A callable
+        :return: Task
+        """
+        self._ensure_started()
+
+        task = Task(fn, args, kwargs)
+        self._queue.put(task)
+
+        return task
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._threads = []
+
+            for i in range(self._size):
+                thread = threading.Thread(target=self._run, name="{}-{}".format(self._name, i))
+                thread.daemon = True
+                thread.start()
+
+                self._threads.append(thread)
+
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._queue.get().run()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+
+class KeyedWorkerPool(object):
+    """
+    This class is a pool of single-threaded lanes. Work submitted with the
+    same key always lands on the same lane, so it runs in submission order,
+    while work for different keys runs in parallel.
+
+    Args:
+        size - The number of lanes (and threads).
+        name - A name prefix for the worker threads.
+        maxsize - The maximum number of queued tasks per lane (0 for
+            unbounded).
+
+    High Level Usage:
+        pool = KeyedWorkerPool(4, "events")
+        pool.submit(sender, handle, event)
+    """
+
+    def __init__(self, size, name="worker", maxsize=0):
+        self._lanes = [WorkerPool(1, "{}-{}".format(name, i), maxsize) for i in range(size)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        This function queues fn(*args, **kwargs) behind any earlier work
+        submitted with the same key.
+
+        :param key: A hashable key, e.g. a sender ID
+        :param fn: A callable
+        :return: Task
+        """
+        return self._lanes[hash(key) % len(self._lanes)].submit(fn, *args, **kwargs)
+
+    @property
+    def size(self):
+        return len(self._lanes)
+
+    @property
+    def depth(self):
+        return sum(lane.depth for lane in self._lanes)
+
+
+class EventQueue(object):
+    """
+    This class queues events in process memory and hands each one to a
+    handler on a KeyedWorkerPool, in order per key.
+
+    Args:
+        handler - A callable taking one event.
+        workers - The number of worker threads.
+        name - A name prefix for the worker threads.
+
+    High Level Usage:
+        queue = EventQueue(handle_event, 4)
+        queue.put(sender, event)
+    """
+
+    def __init__(self, handler, workers, name="events"):
+        self._handler = handler
+        self._pool = KeyedWorkerPool(workers, name)
+
+    def put(self, key, event):
+        """
+        This function queues an event behind earlier events with the same key.
+
+        :param key: A hashable key, e.g. a sender ID
+        :param event: The event
+        :return: None
+        """
+        self._pool.submit(key, self._handler, event)
+
+    @property
+    def depth(self):
+        return self._pool.depth
+
+
+class RedisEventQueue(object):
+    """
+    This class queues JSON-serializable events in Redis lists, so any process
+    can enqueue and any process can work the queue. Events are spread over
+    `shards` lists by key. Each shard is drained by exactly one consumer at a
+    time (whoever holds the shard's lock), which keeps events for the same
+    key in order across every process.
+
+    An event being handled is parked in a per-shard processing list, so if
+    its consumer dies, the next lock holder puts it back at the front of the
+    queue, in one transaction. While an event is being handled, a heartbeat
+    thread keeps renewing the locks this process holds, so a slow handler
+    does not lose its shard to another process halfway through.
+
+    Args:
+        ds - A Redis instance.
+        handler - A callable taking one event.
+        shards - The number of shard lists (and consumer threads per
+            process).
+        name - The key prefix of the lists.
+        lock_ttl - Seconds a shard lock outlives its last renewal. Locks
+            are renewed every third of that.
+
+    Attributes:
+        _held - The shards whose lock this process holds.
+
+    High Level Usage:
+        queue = RedisEventQueue(redis_store, handle_event, 4)
+        queue.put(sender, event)
+    """
+
+    def __init__(self, ds, handler, shards, name="webhook", lock_ttl=30):
+        self._ds = ds
+        self._handler = handler
+        self._shards = shards
+        self._name = name
+        self._lock_ttl = lock_ttl
+        self._owner = "{}:{}".format(os.getpid(), id(self))
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._held = set()
+        self._held_lock = threading.Lock()
+
+    def put(self, key, event):
+        """
+        This function queues an event behind earlier events with the same key.
+
+        :param key: A hashable key, e.g. a sender ID
+        :param event: The event (JSON-serializable)
+        :return: None
+        """
+        self._ensure_started()
+        self._ds.lpush(self._key(self._shard(key), "queue"), json.dumps(event))
+
+    @property
+    def depth(self):
+        """
+        This function returns the number of events waiting in every shard,
+        like EventQueue.depth.
+
+        :return: int
+        """
+        pipe = self._ds.pipeline(transaction=False)
+
+        for shard in range(self._shards):
+            pipe.llen(self._key(shard, "queue"))
+
+        return sum(pipe.execute())
+
+    def _shard(self, key):
+        # hash() differs between processes for str keys on some platforms,
+        # so shard with a stable digest
+        return int(hashlib.md5(unicode(key).encode("utf-8")).hexdigest()[:8], 16) % self._shards
+
+    def _key(self, shard, kind):
+        return "{}:{}:{}".format(self._name, shard, kind)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            self._owner = "{}:{}".format(os.getpid(), id(self))
+            # locks held before a fork belong to the parent
+            self._held = set()
+
+            heartbeat = threading.Thread(target=self._heartbeat, name="{}-heartbeat".format(self._name))
+            heartbeat.daemon = True
+            heartbeat.start()
+
+            for shard in range(self._shards):
+                thread = threading.Thread(target=self._consume, args=(shard,), name="{}-consumer-{}".format(self._name, shard))
+                thread.daemon = True
+                thread.start()
+
+            self._pid = os.getpid()
+
+    def _hold(self, shard, held):
+        """
+        This function acquires the lock of a shard, or renews it if this
+        consumer already holds it.
+
+        :param shard: The shard number
+        :param held: Whether the lock was held after the last call
+        :return: True if the lock is held
+        """
+        lock = self._key(shard, "lock")
+        ttl = int(self._lock_ttl * 1000)
+
+        if not held:
+            return bool(self._ds.set(lock, self._owner, px=ttl, nx=True))
+
+        with self._ds.pipeline() as pipe:
+            try:
+                pipe.watch(lock)
+
+                if pipe.get(lock) != self._owner:
+                    return False
+
+                pipe.multi()
+                pipe.pexpire(lock, ttl)
+                pipe.execute()
+            except WatchError:
+                return False
+
+        return True
+
+    def _heartbeat(self):
+        while True:
+            sleep(self._lock_ttl / 3.0)
+
+            with self._held_lock:
+                shards = list(self._held)
+
+            for shard in shards:
+                try:
+                    held = self._hold(shard, True)
+                except Exception:
+                    ###
+                    logger.exception("Could not renew the lock of shard %d.", shard)
+                    ###
+
+                    continue
+
+                if not held:
+                    self._set_held(shard, False)
+
+                    ###
+                    logger.warning("Lost the lock of shard %d.", shard)
+                    ###
+
+    def _set_held(self, shard, held):
+        with self._held_lock:
+            if held:
+                self._held.add(shard)
+            else:
+                self._held.discard(shard)
+
+    def _recover(self, queue, processing):
+        """
+        This function puts the events a previous lock holder was handling
+        back at the front of the queue, in a single transaction, so a crash
+        halfway through neither loses nor duplicates them.
+
+        :param queue: The queue list key
+        :param processing: The processing list key
+        :return: None
+        """
+        with self._ds.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(processing)
+                    parked = pipe.lrange(processing, 0, -1)
+
+                    if not parked:
+                        pipe.reset()
+                        return
+
+                    pipe.multi()
+                    # the oldest is last, so it ends up at the front
+                    pipe.rpush(queue, *parked)
+                    pipe.delete(processing)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def _consume(self, shard):
+        queue = self._key(shard, "queue")
+        processing = self._key(shard, "processing")
+        held = False
+
+        while True:
+            try:
+                was_held, held = held, self._hold(shard, held)
+                self._set_held(shard, held)
+
+                if not held:
+                    sleep(1)
+                    continue
+
+                if not was_held:
+                    # finish what the previous lock holder was doing first
+                    self._recover(queue, processing)
+
+                raw = self._ds.brpoplpush(queue, processing, timeout=1)
+
+                if raw is None:
+                    continue
+
+                try:
+                    self._handler(json.loads(raw))
+                except Exception:
+                    ###
+                    logger.exception("Queued event failed.")
+                    ###
+
+                self._ds.delete(processing)
+            except Exception:
+                ###
+                logger.exception("Event queue consumer failed.")
+                ###
+
+                sleep(1)